@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+""" End to end benchmark of a refeed polling cycle against an in-process fake IMAP server.
+
+For each combination of --feeds and --history, a fresh state store and static directory are created, the fake folder is
+loaded with --history synthetic messages and an initial cycle is run, then --messages new messages are added and an
+incremental cycle is run. Each cycle is timed per stage, and the results are written as JSON, for example:
+
+    python3 bench/bench.py --feeds 1 8 --history 0 5000 --messages 500 --output bench_results.json
+"""
+
+# STDLIB
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Union
+import argparse
+import inspect
+import json
+import logging
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('refeed')))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+# 3RD PARTY
+import yaml
+
+# INTERNAL
+import config, store, mail, feed, filters, parse, tasker
+from fakeimap import FakeIMAPServer, FakeIMAPClient
+from synthetic import SyntheticMailbox
+
+class StageTimer():
+    """ Instanceable timer of the time spent in each stage of a cycle, summed over all threads.
+
+    Stages are timed by wrapping the functions that implement them (see wrap()). A call nested in another call of the same
+    stage is not counted twice.
+    """
+    def __init__(self) -> None:
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._restore = []
+
+    def reset(self) -> None:
+        with self._lock:
+            self.seconds.clear()
+            self.calls.clear()
+
+    def wrap(self, owner:object, name:str, stage:str) -> None:
+        original = inspect.getattr_static(owner, name)
+        if isinstance(original, classmethod):
+            func = original.__func__
+            wrapped = classmethod(self._timed(func, stage))
+        elif isinstance(original, staticmethod):
+            wrapped = staticmethod(self._timed(original.__func__, stage))
+        else:
+            wrapped = self._timed(original, stage)
+        setattr(owner, name, wrapped)
+        self._restore.append((owner, name, original))
+
+    def restore(self) -> None:
+        for owner, name, original in reversed(self._restore):
+            setattr(owner, name, original)
+        self._restore = []
+
+    def _timed(self, func:Callable, stage:str) -> Callable:
+        def timed(*args, **kwargs):
+            active = getattr(self._local, 'active', None)
+            if active is None:
+                active = self._local.active = set()
+            if stage in active:
+                return func(*args, **kwargs)
+            active.add(stage)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                active.discard(stage)
+                with self._lock:
+                    self.seconds[stage] += elapsed
+                    self.calls[stage] += 1
+        timed.__wrapped__ = func
+        return timed
+
+    def report(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        with self._lock:
+            return {stage: {'calls': self.calls[stage], 'seconds': round(self.seconds[stage], 6)} for stage in sorted(self.seconds)}
+
+def instrument(timer:StageTimer) -> None:
+    mail._IMAPPool.client = FakeIMAPClient
+    timer.wrap(mail._IMAPPool, 'connect', 'connect')
+    timer.wrap(FakeIMAPClient, 'select_folder', 'select')
+    timer.wrap(FakeIMAPClient, 'search', 'search')
+    timer.wrap(FakeIMAPClient, 'fetch', 'fetch')
+    timer.wrap(parse.MailParse, 'parse_batch', 'parse')
+    timer.wrap(filters.FilterPlan, 'select', 'filter')
+    timer.wrap(filters.FilterPlan, 'matches', 'filter')
+    timer.wrap(feed.Feed, '__init__', 'load')
+    timer.wrap(feed.Feed, 'add_entries_from_dict_if_new', 'build')
+    timer.wrap(feed.Feed, 'generate_feed', 'write')
+    timer.wrap(feed.Feed, '_commit', 'persist')
+    timer.wrap(mail.SyncState, 'commit', 'checkpoint')
+
+def write_config(workdir:Path, feeds:int, args:argparse.Namespace) -> Path:
+    def feed_filters(i:int) -> Union[Dict[str, Dict[str, str]], None]: 
+        if not args.filters: 
+            return None
+        elif args.topic_filters: # each feed takes the messages with one word in their subject, as when splitting a folder by topic
+            return {'subject': {'AND': SyntheticMailbox.vocabulary[i % len(SyntheticMailbox.vocabulary)]}, 'from_': {'EXCLUDE': '(?i)spam@'}}
+        return {'subject': {'OR': 'digest'}, 'from_': {'EXCLUDE': '(?i)spam@'}}
+
+    raw = {
+        'app': {
+            'log_level': 'WARNING',
+            'wait_to_update': 5,
+            'push': False,
+            'max_workers': args.max_workers,
+            'max_workers_per_account': args.max_workers_per_account,
+            'max_in_flight_messages': args.max_in_flight_messages,
+            'max_in_flight_bytes': args.max_in_flight_bytes,
+            'partial_fetch': args.partial_fetch,
+            'max_part_bytes': args.max_part_bytes,
+            **({'parse_workers': args.parse_workers} if args.parse_workers is not None else {}),
+            'paths': {'data': str(workdir.joinpath('data')), 'static': str(workdir.joinpath('static')), 'log': str(workdir.joinpath('log', 'root.log'))}
+        },
+        'accounts': {
+            'bench': {
+                'server': {'host': 'imap.bench.invalid', 'port': 993, 'ssl': True},
+                'auth': {'auth_type': 'login', 'user': 'bench', 'password': 'bench'}
+            }
+        },
+        'feeds': {
+            'bench-{}'.format(i): {
+                'folder': 'INBOX',
+                'account_name': 'bench',
+                'max_entries': args.max_entries,
+                'formats': args.formats,
+                'feed_info': {'protocol': 'https://', 'fqdn': 'bench.example.com', 'author-name': 'Bench', 'language': 'en'},
+                **({'filters': feed_filters(i)} if args.filters else {})
+            } for i in range(feeds)
+        }
+    }
+    path = workdir.joinpath('config.yaml')
+    path.write_text(yaml.safe_dump(raw))
+    return path
+
+def reset_state(config_path:Path) -> None:
+    mail._IMAPPool.close_all()
+    mail.SyncState.pending.clear()
+    store._store = None
+    config.paths['config'] = config_path
+    config.PullConfig(force=True)
+    tasker._Tasks.make_run_dirs()
+
+def run_cycle(timer:StageTimer, phase:str, feeds:int, history:int, messages:int, size:int) -> Dict[str, object]:
+    timer.reset()
+    started = time.perf_counter()
+    results = tasker._Tasks.generate_feeds_from_new_mail()
+    wall = time.perf_counter() - started
+    return {
+        'phase': phase,
+        'feeds': feeds,
+        'history': history,
+        'messages': messages,
+        'bytes': size,
+        'failed': sorted(feed_name for feed_name, result in results.items() if result is not True),
+        'wall_seconds': round(wall, 6),
+        'messages_per_second': round(messages * feeds / wall, 2) if (wall > 0) and (messages > 0) else None,
+        'stages': timer.report()
+    }
+
+def run_scenario(timer:StageTimer, feeds:int, history:int, args:argparse.Namespace) -> List[Dict[str, object]]:
+    workdir = Path(tempfile.mkdtemp(prefix='refeed-bench-'))
+    try:
+        reset_state(write_config(workdir, feeds, args))
+        FakeIMAPServer.reset(args.latency / 1000)
+        mailbox_args = dict(body_size=args.body_size, structures=args.structures, attachment_ratio=args.attachment_ratio,
+            attachment_size=args.attachment_size, match_ratio=args.match_ratio, seed=args.seed)
+
+        size = FakeIMAPServer.append('INBOX', SyntheticMailbox(history, start_uid=1, **mailbox_args).messages())
+        runs = [run_cycle(timer, 'initial', feeds, history, history, size)]
+        size = FakeIMAPServer.append('INBOX', SyntheticMailbox(args.messages, start_uid=history + 1, **mailbox_args).messages())
+        runs.append(run_cycle(timer, 'incremental', feeds, history, args.messages, size))
+        return runs
+    finally:
+        mail._IMAPPool.close_all()
+        parse.MailParse.shutdown()
+        if not args.keep:
+            shutil.rmtree(str(workdir), ignore_errors=True)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark refeed polling cycles against an in-process fake IMAP server.')
+    parser.add_argument('--feeds', type=int, nargs='+', default=[1, 4], help='feed counts to benchmark, all on one folder')
+    parser.add_argument('--history', type=int, nargs='+', default=[0, 1000], help='messages already in the folder before the measured incremental cycle')
+    parser.add_argument('--messages', type=int, default=200, help='new messages in the incremental cycle')
+    parser.add_argument('--body-size', type=int, default=4096, help='approximate bytes per text part')
+    parser.add_argument('--structures', nargs='+', choices=SyntheticMailbox.structures, default=list(SyntheticMailbox.structures))
+    parser.add_argument('--attachment-ratio', type=float, default=0.1)
+    parser.add_argument('--attachment-size', type=int, default=32768)
+    parser.add_argument('--match-ratio', type=float, default=0.5, help='share of messages selected by the filters')
+    parser.add_argument('--no-filters', dest='filters', action='store_false', help='benchmark feeds without filters')
+    parser.add_argument('--topic-filters', action='store_true', help='give each feed a different subject filter instead of the same one')
+    parser.add_argument('--formats', nargs='+', default=['atom', 'rss', 'json'])
+    parser.add_argument('--max-entries', type=int, default=200)
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--max-workers-per-account', type=int, default=2)
+    parser.add_argument('--max-in-flight-messages', type=int, default=500)
+    parser.add_argument('--max-in-flight-bytes', type=int, default=64 * 1024 * 1024)
+    parser.add_argument('--no-partial-fetch', dest='partial_fetch', action='store_false', help='fetch whole messages instead of their text part')
+    parser.add_argument('--max-part-bytes', type=int, default=None)
+    parser.add_argument('--parse-workers', type=int, default=None, help='mail parsing processes, 0 to parse in the feed threads (default: as refeed)')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated round trip per IMAP command, in milliseconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help='keep the temporary state and static directories')
+    parser.add_argument('--output', type=Path, default=None, help='write JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
+    timer = StageTimer()
+    instrument(timer)
+    runs = []
+    try:
+        for feeds in args.feeds:
+            for history in args.history:
+                for run in run_scenario(timer, feeds, history, args):
+                    runs.append(run)
+                    print('{phase:>11} feeds={feeds} history={history} messages={messages}: {wall_seconds:.3f}s'.format(**run), file=sys.stderr)
+    finally:
+        timer.restore()
+
+    results = {
+        'meta': {
+            'started': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': {name: (str(value) if isinstance(value, Path) else value) for name, value in vars(args).items()}
+        },
+        'runs': runs
+    }
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        args.output.write_text(output + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+# STDLIB
+from email.parser import BytesHeaderParser
+from email.message import Message
+from email import policy, message_from_bytes
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+import re
+import threading
+import time
+
+# 3RD PARTY
+from imapclient.response_types import BodyData
+
+class _Message():
+    __slots__ = ('uid', 'raw', 'internaldate', 'headers', 'header_end', 'values', 'structure', 'parsed')
+
+    def __init__(self, uid:int, raw:bytes, internaldate:datetime) -> None:
+        self.uid = uid
+        self.raw = raw
+        self.internaldate = internaldate
+        end = raw.find(b'\r\n\r\n')
+        if end == -1:
+            end = raw.find(b'\n\n')
+        self.header_end = end if end != -1 else len(raw)
+        self.headers = _header_parser.parsebytes(raw[:self.header_end])
+        self.values = {}
+        self.structure = None
+        self.parsed = None
+
+    def header_fields(self, fields:List[str]) -> bytes:
+        wanted = {field.upper() for field in fields}
+        lines = []
+        for name, value in self.headers.raw_items():
+            if name.upper() in wanted:
+                lines.append('{}: {}\r\n'.format(name, value).encode('utf-8', 'surrogateescape'))
+        return b''.join(lines) + b'\r\n'
+
+    def header_value(self, field:str) -> str:
+        # cached (as are the parsed message and its structure), so the fake server's own search cost stays out of the measurements
+        field = field.upper()
+        if field not in self.values:
+            self.values[field] = '\n'.join(str(value) for value in self.headers.get_all(field, [])).casefold()
+        return self.values[field]
+
+    def message(self) -> Message:
+        if self.parsed is None: 
+            self.parsed = message_from_bytes(self.raw)
+        return self.parsed
+
+    def bodystructure(self) -> BodyData:
+        if self.structure is None: 
+            self.structure = BodyData.create(self._structure_of(self.message()))
+        return self.structure
+
+    def section(self, section:str) -> bytes:
+        """ Returns the encoded content of a part, by part specifier (e.g. '1' or '2.1').
+        """
+        part = self.message()
+        for number in section.split('.'): 
+            if part.is_multipart(): 
+                part = part.get_payload()[int(number) - 1]
+            elif number != '1': 
+                return b''
+        return self._payload(part)
+
+    def _structure_of(self, part:Message) -> tuple:
+        if part.is_multipart(): 
+            return tuple(self._structure_of(child) for child in part.get_payload()) + (
+                part.get_content_subtype().upper().encode('ascii'), (b'BOUNDARY', part.get_boundary().encode('ascii')), None, None, None)
+        payload = self._payload(part)
+        params = tuple(item.encode('utf-8') for name, value in (part.get_params() or [])[1:] for item in (name.upper(), str(value)))
+        fields = (part.get_content_maintype().upper().encode('ascii'), part.get_content_subtype().upper().encode('ascii'), params or None, None, None, 
+            part.get('Content-Transfer-Encoding', '7BIT').upper().encode('ascii'), len(payload))
+        if part.get_content_maintype() == 'text': 
+            fields += (payload.count(b'\n'),)
+        disposition = part.get_content_disposition()
+        filename = part.get_filename()
+        return fields + (None, (disposition.encode('ascii'), (b'FILENAME', filename.encode('utf-8')) if filename else None) if disposition else None, None, None)
+
+    def _payload(self, part:Message) -> bytes:
+        return part.get_payload().encode('ascii', 'surrogateescape')
+
+class FakeIMAPServer():
+    """ An uninstanced, in-process stand-in for an IMAP server, holding folders of messages shared by all FakeIMAPClient connections.
+
+    latency is added to every command, to model the round trip to a real server.
+    """
+    folders = {}  # folder: {uid: _Message}
+    uidvalidity = 1
+    capabilities = (b'IMAP4REV1', b'IDLE', b'ENABLE', b'UIDPLUS')
+    latency = 0.0
+    _lock = threading.Lock()
+
+    @classmethod
+    def reset(cls, latency:float=0.0) -> None:
+        with cls._lock:
+            cls.folders = {}
+            cls.latency = latency
+
+    @classmethod
+    def append(cls, folder:str, messages:Iterable[Tuple[int, bytes, datetime]]) -> int:
+        """ Add (uid, RFC822 bytes, internal date) messages to folder, returns the number of bytes added.
+        """
+        size = 0
+        with cls._lock:
+            folder_messages = cls.folders.setdefault(folder, {})
+            for uid, raw, internaldate in messages:
+                folder_messages[uid] = _Message(uid, raw, internaldate)
+                size += len(raw)
+        return size
+
+class FakeIMAPClient():
+    """ Implements the subset of imapclient.IMAPClient used by refeed against FakeIMAPServer.
+
+    Accepts the same constructor arguments as IMAPClient (and ignores them), so it can replace imapclient.IMAPClient directly (see mail._IMAPPool.client).
+    """
+    def __init__(self, host:str, port:Union[int, None]=None, use_uid:bool=True, ssl:bool=True, stream:bool=False, timeout:Union[float, None]=None, **kwargs) -> None:
+        self.host = host
+        self.selected = None
+        self._round_trip()
+
+    def _round_trip(self) -> None:
+        if FakeIMAPServer.latency > 0:
+            time.sleep(FakeIMAPServer.latency)
+
+    def login(self, username:str, password:str) -> bytes:
+        self._round_trip()
+        return b'Logged in'
+
+    def oauth2_login(self, user:str, access_token:str, mech:str='XOAUTH2', vendor:Union[str, None]=None) -> bytes:
+        return self.login(user, access_token)
+
+    def logout(self) -> bytes:
+        self._round_trip()
+        return b'Logging out'
+
+    def shutdown(self) -> None:
+        pass
+
+    def noop(self) -> Tuple[bytes, list]:
+        self._round_trip()
+        return b'NOOP completed', []
+
+    def capabilities(self) -> Tuple[bytes, ...]:
+        return FakeIMAPServer.capabilities
+
+    def has_capability(self, capability:str) -> bool:
+        return capability.upper().encode('ascii') in FakeIMAPServer.capabilities
+
+    def enable(self, *capabilities:str) -> List[str]:
+        self._round_trip()
+        return [capability for capability in capabilities if self.has_capability(capability)]
+
+    def folder_exists(self, folder:str) -> bool:
+        self._round_trip()
+        return folder in FakeIMAPServer.folders
+
+    def select_folder(self, folder:str, readonly:bool=False) -> Dict[bytes, object]:
+        self._round_trip()
+        messages = FakeIMAPServer.folders[folder]
+        self.selected = folder
+        return {
+            b'EXISTS': len(messages),
+            b'UIDVALIDITY': FakeIMAPServer.uidvalidity,
+            b'UIDNEXT': max(messages, default=0) + 1,
+            b'READ-WRITE': not readonly
+        }
+
+    def search(self, criteria:Union[str, list]='ALL', charset:Union[str, None]=None) -> List[int]:
+        self._round_trip()
+        if isinstance(criteria, str):
+            criteria = criteria.split()
+        messages = FakeIMAPServer.folders[self.selected]
+        uid_max = max(messages, default=0)
+        return [uid for uid, message in sorted(messages.items()) if self._matches_all(message, list(criteria), uid_max)]
+
+    def fetch(self, messages:Iterable[int], data:List[str]) -> Dict[int, Dict[bytes, object]]:
+        self._round_trip()
+        folder = FakeIMAPServer.folders[self.selected]
+        response = {}
+        for seq, uid in enumerate(messages, start=1):
+            message = folder.get(int(uid))
+            if message is None:
+                continue
+            items = {b'SEQ': seq}
+            for item in data:
+                item = item.upper()
+                if item == 'RFC822':
+                    items[b'RFC822'] = message.raw
+                elif item.startswith('BODY.PEEK[HEADER.FIELDS'):
+                    fields = re.search(r'\((.*)\)', item).group(1).split()
+                    items['BODY[HEADER.FIELDS ({})]'.format(' '.join(fields)).encode('ascii')] = message.header_fields(fields)
+                elif item == 'BODYSTRUCTURE':
+                    items[b'BODYSTRUCTURE'] = message.bodystructure()
+                elif item.startswith('BODY.PEEK['):
+                    section, start, length = re.fullmatch(r'BODY\.PEEK\[([0-9.]+)\](?:<(\d+)\.(\d+)>)?', item).groups()
+                    content = message.section(section)
+                    if start is None: 
+                        items['BODY[{}]'.format(section).encode('ascii')] = content
+                    else: 
+                        items['BODY[{}]<{}>'.format(section, start).encode('ascii')] = content[int(start):int(start) + int(length)]
+                elif item == 'INTERNALDATE':
+                    items[b'INTERNALDATE'] = message.internaldate
+                elif item == 'RFC822.SIZE':
+                    items[b'RFC822.SIZE'] = len(message.raw)
+                else:
+                    raise ValueError('FakeIMAPClient does not support FETCH item {}'.format(item))
+            response[int(uid)] = items
+        return response
+
+    def _matches_all(self, message:_Message, criteria:List[object], uid_max:int) -> bool:
+        tokens = iter(criteria)
+        for token in tokens:
+            if not self._matches(message, token, tokens, uid_max):
+                return False
+        return True
+
+    def _matches(self, message:_Message, token:object, tokens:Iterator[object], uid_max:int) -> bool:
+        if isinstance(token, (list, tuple)):
+            return self._matches_all(message, list(token), uid_max)
+        key = str(token).upper()
+        if key == 'ALL':
+            return True
+        elif key == 'NOT':
+            return not self._matches(message, next(tokens), tokens, uid_max)
+        elif key == 'OR':
+            first = self._matches(message, next(tokens), tokens, uid_max)
+            second = self._matches(message, next(tokens), tokens, uid_max)
+            return first or second
+        elif key == 'UID':
+            return self._in_uid_set(message.uid, str(next(tokens)), uid_max)
+        elif key == 'SINCE':
+            since = next(tokens)
+            return message.internaldate.date() >= (since.date() if isinstance(since, datetime) else since)
+        elif key == 'BEFORE':
+            before = next(tokens)
+            return message.internaldate.date() < (before.date() if isinstance(before, datetime) else before)
+        elif key in ('FROM', 'TO', 'CC', 'BCC', 'SUBJECT'):
+            return str(next(tokens)).casefold() in message.header_value(key)
+        elif key == 'HEADER':
+            field = str(next(tokens))
+            return str(next(tokens)).casefold() in message.header_value(field)
+        raise ValueError('FakeIMAPClient does not support SEARCH key {}'.format(key))
+
+    def _in_uid_set(self, uid:int, uid_set:str, uid_max:int) -> bool:
+        for part in uid_set.split(','):
+            start, _, end = part.partition(':')
+            start = uid_max if start == '*' else int(start)
+            end = start if end == '' else (uid_max if end == '*' else int(end))
+            if min(start, end) <= uid <= max(start, end):
+                return True
+        return False
+
+_header_parser = BytesHeaderParser(policy=policy.default)
@@ -0,0 +1,95 @@
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+# STDLIB
+from email.message import EmailMessage
+from email.utils import format_datetime, make_msgid
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Sequence, Tuple, Union
+import random
+
+class SyntheticMailbox():
+    """ Instanceable, reproducible generator of synthetic mail messages for the benchmarks.
+
+    Messages are built with the stdlib email package from a fixed vocabulary, so the same seed always gives the same bytes.
+    A match_ratio share of messages is sent by news@example.com with 'digest' in the subject (see bench.py's filters),
+    and a small share by spam@example.com, so filters have something to select and exclude.
+
+    :param count: number of messages
+    :param body_size: approximate size in bytes of each text part
+    :param structures: MIME structures to cycle through at random, from SyntheticMailbox.structures
+    :param attachment_ratio: share of messages that get a binary attachment (turning them into multipart/mixed)
+    :param attachment_size: size in bytes of each attachment
+    :param match_ratio: share of messages the benchmark filters should select
+    :param seed: random seed
+    :param start_uid: uid of the first message
+    """
+    structures = ('plain', 'html', 'alternative', 'mixed')
+    vocabulary = ('mail', 'feed', 'update', 'server', 'weekly', 'release', 'notes', 'project', 'meeting', 'report', 'status', 'change',
+        'review', 'build', 'deploy', 'issue', 'thread', 'reply', 'summary', 'digest', 'draft', 'invoice', 'order', 'account')
+    senders = ('alice@example.org', 'bob@example.net', 'carol@example.com', 'dave@example.org', 'eve@example.net')
+
+    def __init__(self, count:int, body_size:int=4096, structures:Union[Sequence[str], None]=None, attachment_ratio:float=0.1,
+            attachment_size:int=32768, match_ratio:float=0.5, seed:int=0, start_uid:int=1) -> None:
+        self.count = count
+        self.body_size = body_size
+        self.use_structures = tuple(structures or self.structures)
+        self.attachment_ratio = attachment_ratio
+        self.attachment_size = attachment_size
+        self.match_ratio = match_ratio
+        self.seed = seed
+        self.start_uid = start_uid
+
+    def messages(self) -> Iterator[Tuple[int, bytes, datetime]]:
+        """ Yields (uid, RFC822 bytes, internal date) per message, with internal dates spread over the last day.
+        """
+        rng = random.Random('{}-{}'.format(self.seed, self.start_uid))
+        now = datetime.now(timezone.utc)
+        for i in range(self.count):
+            uid = self.start_uid + i
+            date = now - timedelta(seconds=(self.count - i) * 86400 / (self.count + 1))
+            yield uid, self.message(rng, uid, date), date
+
+    def message(self, rng:random.Random, uid:int, date:datetime) -> bytes:
+        msg = EmailMessage()
+        roll = rng.random()
+        if roll < self.match_ratio:
+            msg['From'] = 'News Letter <news@example.com>'
+            msg['Subject'] = 'Weekly digest #{}: {}'.format(uid, self._words(rng, 6))
+        elif roll < self.match_ratio + 0.05:
+            msg['From'] = 'Not Spam <spam@example.com>'
+            msg['Subject'] = 'SPAM {}'.format(self._words(rng, 6))
+        else:
+            msg['From'] = rng.choice(self.senders)
+            msg['Subject'] = self._words(rng, 8).capitalize()
+        msg['To'] = 'Some One <some@one.com>'
+        msg['Date'] = format_datetime(date)
+        msg['Message-ID'] = make_msgid(str(uid), 'bench.example.com')
+
+        text = self._text(rng)
+        structure = rng.choice(self.use_structures)
+        if structure == 'plain':
+            msg.set_content(text)
+        elif structure == 'html':
+            msg.set_content(self._html(text), subtype='html')
+        else: # alternative, or mixed which is made mixed by its attachment below
+            msg.set_content(text)
+            msg.add_alternative(self._html(text), subtype='html')
+        if (structure == 'mixed') or (rng.random() < self.attachment_ratio):
+            msg.add_attachment(rng.randbytes(self.attachment_size) if hasattr(rng, 'randbytes') else bytes(rng.getrandbits(8) for _ in range(self.attachment_size)),
+                maintype='application', subtype='octet-stream', filename='attachment-{}.bin'.format(uid))
+        return msg.as_bytes()
+
+    def _words(self, rng:random.Random, count:int) -> str:
+        return ' '.join(rng.choice(self.vocabulary) for _ in range(count))
+
+    def _text(self, rng:random.Random) -> str:
+        lines = []
+        size = 0
+        while size < self.body_size:
+            line = self._words(rng, 12)
+            lines.append(line)
+            size += len(line) + 1
+        return '\n'.join(lines) + '\n'
+
+    def _html(self, text:str) -> str:
+        return '<html><body>{}</body></html>\n'.format(''.join('<p>{}</p>\n'.format(line) for line in text.splitlines()))
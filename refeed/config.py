@@ -1,78 +1,131 @@
 #Author: = 'Ethan Djeric <me@ethandjeric.com>'
 
 #STDLIB
-from typing import List, Dict, Union, Tuple, DefaultDict
-from abc import ABC
+from typing import List, Dict, Union, Tuple, Mapping, NamedTuple
+from types import MappingProxyType
 import logging
-from collections import defaultdict
 from pathlib import Path 
+import hashlib
+import threading
+import os
 import re
 
 # 3RD PARTY
 import yaml
 
+# INTERNAL
+import filters
+
+default_paths = {
+    "config": Path(__file__).parents[1].joinpath('run', 'config.yaml').resolve(),
+    "log": Path(__file__).parents[1].joinpath('run', 'log', 'root.log').resolve(),
+    "data": Path(__file__).parents[1].joinpath('run', 'data').resolve(),
+    "static": Path(__file__).parents[1].joinpath('run', 'static').resolve()
+}
+# whether each path in paths is a directory that tasker should create
+paths_flag_dir = {"config": False, "log": False, "data": True, "static": True}
+
 class ConfigData():
-    def __init__(self, config_path:Path): 
-        logging.debug('Entering ConfigContext.__init__')
+    """ Parses and validates a loaded config.yaml. Only used to build a ConfigSnapshot, see PullConfig().
+
+    :param raw: the contents of config.yaml
+    """
+    def __init__(self, raw:bytes): 
+        logging.debug('Entering ConfigData.__init__')
         try: 
-            with config_path.open() as f:
-                self.yaml = (yaml.safe_load(f))
-                logging.debug('Loaded config.yaml')
+            self.yaml = yaml.safe_load(raw)
+            logging.debug('Loaded config.yaml')
         except Exception as e:
             raise UserConfigError from e
+        if not isinstance(self.yaml, dict): 
+            raise UserConfigError('config.yaml is empty or not a mapping')
+        # an empty app section is the same as none, so the getters can look keys up in it
+        app = self.yaml['app'] = self.yaml.get('app') or {}
+        if not isinstance(app, dict): 
+            raise UserConfigError('[app] value is not a mapping')
+        if not isinstance(app.get('paths') or {}, dict): 
+            raise UserConfigError('[app][paths] value is not a mapping')
         
-        default_paths = {
-            "config": Path(__file__).parents[1].joinpath('run', 'config.yaml').resolve(),
-            "log": Path(__file__).parents[1].joinpath('run', 'log', 'root.log').resolve(),
-            "data": Path(__file__).parents[1].joinpath('run', 'data').resolve(),
-            "static": Path(__file__).parents[1].joinpath('run', 'static').resolve()
-        }
-        self.paths = {**default_paths, **self.yaml['app']['paths']}
-        self.alt_cache = yaml['app'].get('alternate_cache', 25)
-        self.wait_to_update = yaml['app'].get('wait_to_update', 15)
+        self.paths = {**default_paths, **{str(name): Path(path) for name, path in (app.get('paths') or {}).items()}}
+        self.alt_cache = self._count(app.get('alternate_cache', 25), '[app][alternate_cache]')
+
+    @classmethod
+    def _count(cls, value:object, name:str) -> int: 
+        try: 
+            value = int(value)
+        except (TypeError, ValueError) as e: 
+            raise UserConfigError('{} value is not an int of at least 0'.format(name)) from e
+        if value < 0: 
+            raise UserConfigError('{} value is not an int of at least 0'.format(name))
+        return value
+
+    def _feed(self, feed_name:str) -> Dict[str, object]: 
+        """ Returns the settings of feed_name, raising UserConfigError if they are not a mapping.
+        """
+        feed = self.yaml['feeds'][feed_name]
+        if not isinstance(feed, dict): 
+            raise UserConfigError('[feeds][{}] value is not a mapping'.format(feed_name))
+        return feed
     
     def f_names(self) -> List[str]:
         try: 
-            for e in self.yaml['feeds']:
-                yield str(e)
-        except KeyError as e:
+            feeds = self.yaml['feeds']
+            if not isinstance(feeds, dict): 
+                raise TypeError('[feeds] value is not a mapping')
+            return [str(e) for e in feeds]
+        except (KeyError, TypeError) as e:
             logging.critical('No feed names found in config.yaml, raising UserConfigError.', exc_info=True)
             raise UserConfigError() from e
 
     def f_account_name(self, feed_name:str) -> Union[str, type(None)]:
         try: 
-            return str(loaded_yaml['feeds'][feed_name]['account_name'])
+            return str(self._feed(feed_name)['account_name'])
         except KeyError as e:
             logging.error('No matching account name found for {}, raising UserConfigError'.format(feed_name), exc_info=True)
             raise UserConfigError() from e
          
     def f_folder(self, feed_name:str) -> str: 
         try: 
-            return str(loaded_yaml['feeds'][feed_name]['folder'])
+            return str(self._feed(feed_name)['folder'])
         except KeyError: # return default value
             logging.warning('No folder found for {}, using default value "INBOX"'.format(feed_name), exc_info=True)
             return 'INBOX'
  
-    def f_filters(self, feed_name:str) -> Union[Dict[str, Dict[str, re.Pattern]], None]: 
-        """ Returns filters as compiled regex patterns. 
+    def f_filters(self, feed_name:str) -> Union[Dict[str, Dict[str, List[re.Pattern]]], None]: 
+        """ Returns filters as compiled regex patterns, as {property: {operator: [patterns]}}. 
+
+        Each operator takes a regex or a list of regexes, and operator names are case insensitive.
         """
         try:
-            filters = loaded_yaml['feeds'][feed_name]['filters']
+            yaml_filters = self._feed(feed_name)['filters']
         except KeyError: 
             logging.warning("No filters found in config.yaml for {}, is this correct?".format(feed_name), exc_info=True)
             return None
+        if yaml_filters is None: 
+            return None
+        if not isinstance(yaml_filters, dict): 
+            raise UserConfigError('[feeds][{}][filters] value is not a mapping'.format(feed_name))
 
         ret_filters = {}
-        for property_, pfilters in filters.items(): 
+        for property_, pfilters in yaml_filters.items(): 
             if not isinstance(pfilters, dict): 
                 exceptmsg = "filters from mail property {} in feed {} are not returned from yaml object as a dict: Check YAML formatting".format(property_, feed_name)
-                logging.exceptiopn(exceptmsg) 
+                logging.error(exceptmsg) 
                 raise UserConfigError(exceptmsg) 
-            try:
-                ret_filters[str(property_)] = {str(rule):re.compile(str(regex)) for (rule,regex) in pfilters.items()}  
-            except re.error as e: 
-                logging.exception("Invalid regex in filters for mail property: {} in feed {}".format(mailprop, feed_name))
-                raise UserConfigError() from e
+            ret_filters[str(property_)] = {}
+            for rule, regexes in pfilters.items(): 
+                rule = str(rule).upper()
+                if rule not in filters.OPERATORS: 
+                    exceptmsg = "Unknown filter operation {} for mail property {} in feed {}, expected one of {}".format(rule, property_, feed_name, filters.OPERATORS)
+                    logging.error(exceptmsg)
+                    raise UserConfigError(exceptmsg)
+                if not isinstance(regexes, list): 
+                    regexes = [regexes]
+                try:
+                    ret_filters[str(property_)].setdefault(rule, []).extend(re.compile(str(regex)) for regex in regexes)
+                except re.error as e: 
+                    logging.exception("Invalid regex in filters for mail property: {} in feed {}".format(property_, feed_name))
+                    raise UserConfigError() from e
         return ret_filters
 
     def f_info(self, feed_name:str) -> Dict[str, str]:
@@ -84,18 +137,112 @@ class ConfigData():
             'logo': 'logo.png' 
         }
         try:
-            yaml_info = loaded_yaml['feeds'][feed_name]['feed_info']
+            yaml_info = self._feed(feed_name)['feed_info']
         except KeyError:
             logging.warning('No heading in config.yaml called feed_info found, using default values for all settings', exc_info=True)
+            yaml_info = {}
+        yaml_info = yaml_info or {}
+        if not isinstance(yaml_info, dict): 
+            raise UserConfigError('[feeds][{}][feed_info] value is not a mapping'.format(feed_name))
         # From PEP448: merges two dicts using unpacking operator 
         return {**default_info, **yaml_info} 
 
     def f_alternate_cache(self, feed_name:str) -> int: 
         try:
-            retvar = loaded_yaml['feeds'][feed_name]['alternate_cache']
+            retvar = self._feed(feed_name)['alternate_cache']
+        except KeyError:
+            logging.info('No setting alternate cache found for feed {}, using app value {}'.format(feed_name, self.alt_cache))
+            return self.alt_cache
+        return self._count(retvar, '[feeds][{}][alternate_cache]'.format(feed_name))
+ 
+    def f_max_entries(self, feed_name:str) -> int: 
+        """ How many of the newest entries to keep in the feed.
+        """
+        try:
+            retvar = self._feed(feed_name)['max_entries']
         except KeyError:
-            logging.info('No setting alternate cache found for feed {}, using default value 25'.format(feed_name), exc_info=True)
-            return 25
+            return 200
+
+        if (not isinstance(retvar, int)) or (retvar < 1):
+            logging.exception('[feeds][{}][max_entries] value is not a positive int'.format(feed_name))
+            raise UserConfigError('[feeds][{}][max_entries] value is not a positive int'.format(feed_name))
+        return retvar
+
+    def f_max_age(self, feed_name:str) -> Union[int, None]: 
+        """ How many days to keep entries in the feed for, or None to keep them until they are pushed out by max_entries.
+        """
+        try:
+            retvar = self._feed(feed_name)['max_age']
+        except KeyError:
+            return None
+
+        if (not isinstance(retvar, int)) or (retvar < 1):
+            logging.exception('[feeds][{}][max_age] value is not a positive int'.format(feed_name))
+            raise UserConfigError('[feeds][{}][max_age] value is not a positive int'.format(feed_name))
+        return retvar
+ 
+    def f_interval(self, feed_name:str) -> int: 
+        """ How many minutes to wait between polls of the feed, before adaptive backoff (see a_schedule()). Default: [app][wait_to_update]
+        """
+        try:
+            retvar = self._feed(feed_name)['interval']
+        except KeyError:
+            return self.a_wait_to_update()
+
+        if (not isinstance(retvar, int)) or (retvar < 1):
+            logging.exception('[feeds][{}][interval] value is not a positive int'.format(feed_name))
+            raise UserConfigError('[feeds][{}][interval] value is not a positive int'.format(feed_name))
+        return retvar
+
+    def f_formats(self, feed_name:str) -> List[str]: 
+        """ Which documents to publish the feed as: any of 'atom' (<feed_name>.xml), 'rss' (<feed_name>.rss) and 'json' (<feed_name>.json).
+        """
+        try:
+            retvar = self._feed(feed_name)['formats']
+        except KeyError:
+            return ['atom']
+
+        valid = ['atom', 'rss', 'json']
+        if (not isinstance(retvar, list)) or any(str(fmt).casefold() not in valid for fmt in retvar):
+            logging.exception('[feeds][{}][formats] must be a list of {}'.format(feed_name, valid))
+            raise UserConfigError('[feeds][{}][formats] must be a list of {}'.format(feed_name, valid))
+        return [str(fmt).casefold() for fmt in retvar]
+ 
+    def ac_names(self) -> List[str]: 
+        try: 
+            return [str(e) for e in self.yaml['accounts']]
+        except (KeyError, TypeError) as e:
+            logging.critical('No accounts found in config.yaml, raising UserConfigError.', exc_info=True)
+            raise UserConfigError() from e
+
+    def ac_server_options(self, account_name:str) -> Dict[str, Union[str, bool, int]]: 
+        """ Returns keyword arguments for IMAPClient (host, port, ssl, stream). 
+        """
+        try: 
+            server = dict(self.yaml['accounts'][account_name]['server'])
+            server['host']
+        except (KeyError, TypeError) as e:
+            logging.error('No server host found for account {}, raising UserConfigError'.format(account_name), exc_info=True)
+            raise UserConfigError() from e
+        return server
+
+    def ac_auth_type(self, account_name:str) -> str: 
+        try: 
+            auth_type = str(self.yaml['accounts'][account_name]['auth']['auth_type'])
+        except KeyError: 
+            return 'login'
+        auth_type = {'oauth': 'oauth2_login'}.get(auth_type, auth_type)
+        if auth_type not in ('login', 'plain_login', 'oauth2_login', 'oauthbearer_login'): 
+            raise UserConfigError('[accounts][{}][auth][auth_type] {} is not supported'.format(account_name, auth_type))
+        return auth_type
+
+    def ac_credentials(self, account_name:str) -> Tuple[str, str]: 
+        try: 
+            auth = self.yaml['accounts'][account_name]['auth']
+            return (str(auth['user']), str(auth['password']))
+        except (KeyError, TypeError) as e:
+            logging.error('No user/password found for account {}, raising UserConfigError'.format(account_name), exc_info=True)
+            raise UserConfigError() from e
  
     def a_log_level(self) -> str:
         # See https://docs.python.org/3/library/logging.html#levels
@@ -108,7 +255,7 @@ class ConfigData():
         }
 
         try:
-            return encode_level[str(loaded_yaml['app']['log_level']).casefold()]
+            return encode_level[str(self.yaml['app']['log_level']).casefold()]
         except KeyError:
             logging.error('Either [app][log_level] is not set in config.yaml, or it is a bad value. Returning default log level (warning)')
             return 30
@@ -117,7 +264,7 @@ class ConfigData():
 
     def a_wait_to_update(self) -> str:
         try:
-            retvar = loaded_yaml['app']['wait_to_update']
+            retvar = self.yaml['app']['wait_to_update']
         except KeyError: 
             logging.warning('No setting wait_to_update found for refeed, using default value 15')
             retvar = 15
@@ -128,6 +275,442 @@ class ConfigData():
         else:
             return retvar
 
+    def a_push(self) -> bool:
+        """ Whether to keep IMAP IDLE sessions open and update feeds as mail arrives, instead of polling every wait_to_update minutes.
+        """
+        try:
+            retvar = self.yaml['app']['push']
+        except KeyError: 
+            return False
+
+        if not isinstance(retvar, bool):
+            logging.exception('[app][push] value is not a bool')
+            raise UserConfigError('[app][push] value is not a bool')
+        else:
+            return retvar
+
+    def a_max_workers(self) -> int:
+        """ How many feeds may be generated concurrently.
+        """
+        return self._a_positive_int('max_workers', 4)
+
+    def a_max_workers_per_account(self) -> int:
+        """ How many feeds fetching from the same account may be generated concurrently.
+        """
+        return self._a_positive_int('max_workers_per_account', 2)
+
+    def a_metrics(self) -> Dict[str, Union[Path, int, str, None]]:
+        """ Where to expose metrics: a Prometheus text file rewritten after each cycle, and/or a local HTTP endpoint. Both off by default.
+        """
+        metrics = (self.yaml.get('app') or {}).get('metrics') or {}
+        if not isinstance(metrics, dict): 
+            raise UserConfigError('[app][metrics] value is not a mapping')
+        textfile = metrics.get('textfile')
+        port = metrics.get('port')
+        if (port is not None) and ((not isinstance(port, int)) or not (0 < port < 65536)): 
+            raise UserConfigError('[app][metrics][port] value is not a valid port number')
+        return {
+            'textfile': Path(textfile) if textfile is not None else None,
+            'port': port,
+            'host': str(metrics.get('host', '127.0.0.1'))
+        }
+
+    def a_http(self) -> Dict[str, Union[int, str, None]]:
+        """ Where to serve the published feeds and alternate pages over HTTP from memory, see serve.FeedServer. Off by default.
+        """
+        http = (self.yaml.get('app') or {}).get('http') or {}
+        if not isinstance(http, dict): 
+            raise UserConfigError('[app][http] value is not a mapping')
+        port = http.get('port')
+        if (port is not None) and ((not isinstance(port, int)) or not (0 < port < 65536)): 
+            raise UserConfigError('[app][http][port] value is not a valid port number')
+        cache_bytes = http.get('cache_bytes', 64 * 1024 * 1024)
+        if isinstance(cache_bytes, bool) or (not isinstance(cache_bytes, int)) or (cache_bytes < 0): 
+            raise UserConfigError('[app][http][cache_bytes] value is not a positive int')
+        revalidate = http.get('revalidate', 5)
+        if isinstance(revalidate, bool) or (not isinstance(revalidate, (int, float))) or (revalidate < 0): 
+            raise UserConfigError('[app][http][revalidate] value is not a positive number')
+        return {
+            'port': port,
+            'host': str(http.get('host', '127.0.0.1')),
+            'cache_bytes': cache_bytes,
+            'revalidate': revalidate
+        }
+
+    def a_schedule(self) -> Dict[str, float]:
+        """ How polling intervals adapt: each poll of a feed that adds no entries (or fails) stretches its interval by backoff, 
+        up to max_backoff times the configured interval, and a poll that adds entries brings it back. Every delay is randomly 
+        shortened or lengthened by up to jitter (a fraction of it), so feeds and accounts are not all polled at the same moment.
+        """
+        schedule = (self.yaml.get('app') or {}).get('schedule') or {}
+        if not isinstance(schedule, dict): 
+            raise UserConfigError('[app][schedule] value is not a mapping')
+        retvar = {'backoff': schedule.get('backoff', 1.5), 'max_backoff': schedule.get('max_backoff', 4), 'jitter': schedule.get('jitter', 0.1)}
+        for key, value in retvar.items(): 
+            if isinstance(value, bool) or (not isinstance(value, (int, float))): 
+                raise UserConfigError('[app][schedule][{}] value is not a number'.format(key))
+        if (retvar['backoff'] < 1) or (retvar['max_backoff'] < 1): 
+            raise UserConfigError('[app][schedule] backoff and max_backoff must be at least 1')
+        if not (0 <= retvar['jitter'] < 1): 
+            raise UserConfigError('[app][schedule][jitter] must be at least 0 and less than 1')
+        return {key: float(value) for key, value in retvar.items()}
+
+    def a_shard(self) -> Dict[str, Union[bool, str, int, None]]:
+        """ Whether to share the feeds with other refeed workers using the same state store (data path), holding each for lease 
+        seconds at a time. Off by default. worker_id defaults to <hostname>-<pid>.
+        """
+        shard = (self.yaml.get('app') or {}).get('shard') or {}
+        if not isinstance(shard, dict): 
+            raise UserConfigError('[app][shard] value is not a mapping')
+        enabled = shard.get('enabled', False)
+        if not isinstance(enabled, bool): 
+            raise UserConfigError('[app][shard][enabled] value is not a bool')
+        lease = shard.get('lease', 60)
+        if isinstance(lease, bool) or (not isinstance(lease, int)) or (lease < 3): 
+            raise UserConfigError('[app][shard][lease] value is not an int of at least 3')
+        worker_id = shard.get('worker_id')
+        return {'enabled': enabled, 'worker_id': str(worker_id) if worker_id is not None else None, 'lease': lease}
+
+    def a_parse_workers(self) -> int:
+        """ How many processes to parse fetched mail in, 0 to parse in the feed threads. Default: the number of CPUs, at most 4 
+        (0 on a single CPU, where a pool only adds overhead).
+        """
+        try:
+            retvar = self.yaml['app']['parse_workers']
+        except KeyError: 
+            cpus = os.cpu_count() or 1
+            return min(4, cpus) if cpus > 1 else 0
+
+        if (not isinstance(retvar, int)) or (retvar < 0):
+            logging.exception('[app][parse_workers] value is not a non-negative int')
+            raise UserConfigError('[app][parse_workers] value is not a non-negative int')
+        else:
+            return retvar
+
+    def a_parse_serial_below(self) -> int:
+        """ Fetch batches with fewer messages than this are parsed in the feed thread, as the process pool would only add overhead.
+        """
+        return self._a_positive_int('parse_serial_below', 20)
+
+    def a_max_in_flight_messages(self) -> int:
+        """ How many fetched messages or new entries a feed generation may hold in memory before handing them on or storing them.
+        """
+        return self._a_positive_int('max_in_flight_messages', 500)
+
+    def a_max_in_flight_bytes(self) -> int:
+        """ Like max_in_flight_messages, in bytes of message data or entry content. Default: 64 MiB
+        """
+        return self._a_positive_int('max_in_flight_bytes', 64 * 1024 * 1024)
+
+    def a_partial_fetch(self) -> bool:
+        """ Whether to fetch only the text part of each message (found from its BODYSTRUCTURE) instead of the whole message.
+        """
+        try:
+            retvar = self.yaml['app']['partial_fetch']
+        except KeyError: 
+            return True
+
+        if not isinstance(retvar, bool):
+            logging.exception('[app][partial_fetch] value is not a bool')
+            raise UserConfigError('[app][partial_fetch] value is not a bool')
+        else:
+            return retvar
+
+    def a_max_part_bytes(self) -> Union[int, None]:
+        """ With partial_fetch, fetch at most this many bytes of a text part, cutting longer bodies short. Default: no limit
+        """
+        if (self.yaml.get('app') or {}).get('max_part_bytes') is None: 
+            return None
+        return self._a_positive_int('max_part_bytes', None)
+
+    def _a_positive_int(self, key:str, default:int) -> int:
+        try:
+            retvar = self.yaml['app'][key]
+        except KeyError: 
+            return default
+
+        if (not isinstance(retvar, int)) or (retvar < 1):
+            logging.exception('[app][{}] value is not a positive int'.format(key))
+            raise UserConfigError('[app][{}] value is not a positive int'.format(key))
+        else:
+            return retvar
+
+class FeedConfig(NamedTuple): 
+    name: str
+    account_name: str
+    folder: str
+    filters: Union[Mapping[str, Mapping[str, Tuple[re.Pattern, ...]]], None]
+    filter_plan: filters.FilterPlan
+    info: Mapping[str, str]
+    alternate_cache: int
+    max_entries: int
+    max_age: Union[int, None]
+    formats: Tuple[str, ...]
+    interval: int
+
+class AccountConfig(NamedTuple): 
+    name: str
+    server_options: Mapping[str, Union[str, bool, int]]
+    auth_type: str
+    credentials: Tuple[str, str]
+
+class AppConfig(NamedTuple): 
+    log_level: int
+    wait_to_update: int
+    push: bool
+    max_workers: int
+    max_workers_per_account: int
+    metrics: Mapping[str, Union[Path, int, str, None]]
+    parse_workers: int
+    parse_serial_below: int
+    max_in_flight_messages: int
+    max_in_flight_bytes: int
+    partial_fetch: bool
+    max_part_bytes: Union[int, None]
+    schedule: Mapping[str, float]
+    shard: Mapping[str, Union[bool, str, int, None]]
+    http: Mapping[str, Union[int, str, None]]
+
+class ConfigSnapshot(NamedTuple):
+    """ An immutable, fully validated view of config.yaml. Filters are precompiled into a filters.FilterPlan per feed, and feeds and accounts indexed by name.
+    """
+    app: AppConfig
+    feeds: Mapping[str, FeedConfig]
+    accounts: Mapping[str, AccountConfig]
+    paths: Mapping[str, Path]
+    raw: dict
+
+    @classmethod
+    def build(cls, data:ConfigData) -> 'ConfigSnapshot': 
+        accounts = {}
+        for name in data.ac_names(): 
+            accounts[name] = AccountConfig(name, MappingProxyType(data.ac_server_options(name)), data.ac_auth_type(name), data.ac_credentials(name))
+
+        feeds = {}
+        for name in data.f_names(): 
+            account_name = data.f_account_name(name)
+            if account_name not in accounts: 
+                raise UserConfigError('Feed {} uses account {}, which is not defined under accounts'.format(name, account_name))
+            feed_filters = data.f_filters(name)
+            if feed_filters is not None: 
+                feed_filters = MappingProxyType({property_: MappingProxyType({rule: tuple(patterns) for rule, patterns in pfilters.items()}) 
+                    for property_, pfilters in feed_filters.items()})
+            try:
+                plan = filters.FilterPlan(feed_filters)
+            except ValueError as e: 
+                raise UserConfigError('[feeds][{}][filters] {}'.format(name, e)) from e
+            feeds[name] = FeedConfig(name, account_name, data.f_folder(name), feed_filters, plan, MappingProxyType(data.f_info(name)), 
+                data.f_alternate_cache(name), data.f_max_entries(name), data.f_max_age(name), tuple(data.f_formats(name)), data.f_interval(name))
+
+        app = AppConfig(data.a_log_level(), data.a_wait_to_update(), data.a_push(), data.a_max_workers(), data.a_max_workers_per_account(), 
+            MappingProxyType(data.a_metrics()), data.a_parse_workers(), data.a_parse_serial_below(), 
+            data.a_max_in_flight_messages(), data.a_max_in_flight_bytes(), data.a_partial_fetch(), data.a_max_part_bytes(), 
+            MappingProxyType(data.a_schedule()), MappingProxyType(data.a_shard()), 
+            MappingProxyType(data.a_http()))
+        return cls(app, MappingProxyType(feeds), MappingProxyType(accounts), MappingProxyType(data.paths), data.yaml)
+
+# The current snapshot and the (mtime, size, sha256) of the config.yaml it was built from. Only ever replaced whole by PullConfig.
+paths = dict(default_paths)
+loaded_yaml = None
+_snapshot = None
+_fingerprint = None
+_pull_lock = threading.Lock()
+
+def PullConfig(force:bool=False) -> bool: 
+    """ (Re)load config.yaml from paths["config"] if it changed, swapping in a new ConfigSnapshot. Returns True if the snapshot was replaced.
+
+    This is cheap enough to call often: unless force is set, the file is only read when its mtime or size changed,
+    and only parsed when its hash changed. If a changed config.yaml is invalid, the previous snapshot is kept.
+    """
+    global _snapshot, _fingerprint, loaded_yaml
+    with _pull_lock: 
+        config_path = Path(paths["config"])
+        try: 
+            stat = config_path.stat()
+        except OSError as e: 
+            if _snapshot is None: 
+                raise UserConfigError('Cannot read config file {}'.format(config_path)) from e
+            logging.error('Cannot stat config file {}, keeping current config'.format(config_path), exc_info=True)
+            return False
+        if (not force) and (_fingerprint is not None) and (_fingerprint[:2] == (stat.st_mtime_ns, stat.st_size)): 
+            return False
+
+        raw = config_path.read_bytes()
+        digest = hashlib.sha256(raw).hexdigest()
+        if (not force) and (_fingerprint is not None) and (_fingerprint[2] == digest): 
+            _fingerprint = (stat.st_mtime_ns, stat.st_size, digest)
+            return False
+
+        try: 
+            snapshot = ConfigSnapshot.build(ConfigData(raw))
+        except Exception as e: # not only UserConfigError: a value of a type no getter checks for must not stop refeed either
+            if _snapshot is None: 
+                if isinstance(e, UserConfigError): 
+                    raise
+                raise UserConfigError('config.yaml is invalid: {!r}'.format(e)) from e
+            logging.error('config.yaml changed but is invalid, keeping current config', exc_info=True)
+            _fingerprint = (stat.st_mtime_ns, stat.st_size, digest)
+            return False
+
+        paths.update({name: path for name, path in snapshot.paths.items() if name != 'config'})
+        loaded_yaml = snapshot.raw
+        _snapshot = snapshot
+        _fingerprint = (stat.st_mtime_ns, stat.st_size, digest)
+        logging.info('Loaded config from {}'.format(config_path))
+        return True
+
+def snapshot() -> ConfigSnapshot: 
+    """ Returns the current ConfigSnapshot, loading config.yaml first if needed. 
+    
+    Hold on to the returned snapshot for a consistent view across several lookups.
+    """
+    if _snapshot is None: 
+        PullConfig()
+    return _snapshot
+
+class ParseFeed(): 
+    """ Uninstanced class of accessors for the feeds in the current ConfigSnapshot.
+    """
+    @classmethod
+    def names(cls) -> Tuple[str, ...]: 
+        return tuple(snapshot().feeds)
+
+    @classmethod
+    def get(cls, feed_name:str) -> FeedConfig: 
+        try: 
+            return snapshot().feeds[feed_name]
+        except KeyError as e: 
+            raise UserConfigError('Feed {} is not defined in config.yaml'.format(feed_name)) from e
+
+    @classmethod
+    def account_name(cls, feed_name:str) -> str: 
+        return cls.get(feed_name).account_name
+
+    @classmethod
+    def folder(cls, feed_name:str) -> str: 
+        return cls.get(feed_name).folder
+
+    @classmethod
+    def filters(cls, feed_name:str) -> Union[Mapping[str, Mapping[str, Tuple[re.Pattern, ...]]], None]: 
+        return cls.get(feed_name).filters
+
+    @classmethod
+    def filter_plan(cls, feed_name:str) -> 'filters.FilterPlan': 
+        return cls.get(feed_name).filter_plan
+
+    @classmethod
+    def info(cls, feed_name:str) -> Mapping[str, str]: 
+        return cls.get(feed_name).info
+
+    @classmethod
+    def alternate_cache(cls, feed_name:str) -> int: 
+        return cls.get(feed_name).alternate_cache
+
+    @classmethod
+    def max_entries(cls, feed_name:str) -> int: 
+        return cls.get(feed_name).max_entries
+
+    @classmethod
+    def max_age(cls, feed_name:str) -> Union[int, None]: 
+        return cls.get(feed_name).max_age
+
+    @classmethod
+    def formats(cls, feed_name:str) -> Tuple[str, ...]: 
+        return cls.get(feed_name).formats
+
+    @classmethod
+    def interval(cls, feed_name:str) -> int: 
+        return cls.get(feed_name).interval
+
+class ParseAccount(): 
+    """ Uninstanced class of accessors for the accounts in the current ConfigSnapshot.
+    """
+    @classmethod
+    def names(cls) -> Tuple[str, ...]: 
+        return tuple(snapshot().accounts)
+
+    @classmethod
+    def get(cls, account_name:str) -> AccountConfig: 
+        try: 
+            return snapshot().accounts[account_name]
+        except KeyError as e: 
+            raise UserConfigError('Account {} is not defined in config.yaml'.format(account_name)) from e
+
+    @classmethod
+    def server_options(cls, account_name:str) -> Dict[str, Union[str, bool, int]]: 
+        return dict(cls.get(account_name).server_options)
+
+    @classmethod
+    def auth_type(cls, account_name:str) -> str: 
+        return cls.get(account_name).auth_type
+
+    @classmethod
+    def credentials(cls, account_name:str) -> Tuple[str, str]: 
+        return cls.get(account_name).credentials
+
+class ParseApp(): 
+    """ Uninstanced class of accessors for the app settings in the current ConfigSnapshot.
+    """
+    @classmethod
+    def log_level(cls) -> int: 
+        return snapshot().app.log_level
+
+    @classmethod
+    def wait_to_update(cls) -> int: 
+        return snapshot().app.wait_to_update
+
+    @classmethod
+    def push(cls) -> bool: 
+        return snapshot().app.push
+
+    @classmethod
+    def max_workers(cls) -> int: 
+        return snapshot().app.max_workers
+
+    @classmethod
+    def max_workers_per_account(cls) -> int: 
+        return snapshot().app.max_workers_per_account
+
+    @classmethod
+    def metrics(cls) -> Mapping[str, Union[Path, int, str, None]]: 
+        return snapshot().app.metrics
+
+    @classmethod
+    def parse_workers(cls) -> int: 
+        return snapshot().app.parse_workers
+
+    @classmethod
+    def parse_serial_below(cls) -> int: 
+        return snapshot().app.parse_serial_below
+
+    @classmethod
+    def max_in_flight_messages(cls) -> int: 
+        return snapshot().app.max_in_flight_messages
+
+    @classmethod
+    def max_in_flight_bytes(cls) -> int: 
+        return snapshot().app.max_in_flight_bytes
+
+    @classmethod
+    def partial_fetch(cls) -> bool: 
+        return snapshot().app.partial_fetch
+
+    @classmethod
+    def max_part_bytes(cls) -> Union[int, None]: 
+        return snapshot().app.max_part_bytes
+
+    @classmethod
+    def schedule(cls) -> Mapping[str, float]: 
+        return snapshot().app.schedule
+
+    @classmethod
+    def shard(cls) -> Mapping[str, Union[bool, str, int, None]]: 
+        return snapshot().app.shard
+
+    @classmethod
+    def http(cls) -> Mapping[str, Union[int, str, None]]: 
+        return snapshot().app.http
+
 class UserConfigError(Exception):
     """ To be raised if data returned from config.yaml does not match specifications
     """
@@ -2,290 +2,440 @@
 
 #STDLIB
 from __future__ import annotations # allow referecning Feed as a type from within Feed for __enter__
-import shelve
 from pathlib import Path
-from datetime import date, datetime
-from typing import Tuple, Dict
+from datetime import date, datetime, timedelta, timezone
+from typing import Tuple, Dict, Iterable, List, Union
 import random
 import string
+import hashlib
 import logging
 
-# 3RD PARTY 
-from mailparser import MailParser
-from mailparser.exceptions import MailParserReceivedParsingError
-from feedgen.feed import FeedGenerator
-
 # INTERNAL
 """ If we use the form `import x`, we can modify x.var. 
  However, with the form `from . import x`(relative or absolute), we cannot.
  The second form, where the namespace is modifies, it is equivalent to setting 
  the value of the import attrs to a module-specific global"""
-import config
+import config, store, mail
+from metrics import Metrics
+from shard import LeaseLost
+from render import FeedRender, FORMATS, CONTENT_TYPES
+from publish import Publisher
+
+class Entry():
+    """ Compact record of a single feed entry, as stored in the entries table of the state store. 
+    
+    Feed documents are assembled from the rendered fragments of each entry (atom, rss, json), which are rendered once 
+    by render.FeedRender and cached with the entry.
+    """
+    __slots__ = ('uid', 'entry_id', 'title', 'alt_id', 'link', 'content', 'content_type', 'updated', 'atom', 'rss', 'json')
+    columns = ', '.join(__slots__)
+
+    def __init__(self, uid:int, entry_id:str, title:str, alt_id:Union[str, None], link:Union[str, None], content:str, content_type:str, updated:float, 
+            atom:Union[str, None]=None, rss:Union[str, None]=None, json:Union[str, None]=None) -> None:
+        self.uid = uid
+        self.entry_id = entry_id
+        self.title = title
+        self.alt_id = alt_id
+        self.link = link
+        self.content = content
+        self.content_type = content_type
+        self.updated = updated
+        self.atom = atom
+        self.rss = rss
+        self.json = json
+
+    def render(self) -> None: 
+        for fmt, fragment in FeedRender.fragments(self).items(): 
+            setattr(self, fmt, fragment)
+
+    def as_row(self, feed_name:str) -> Tuple:
+        return (feed_name,) + tuple(getattr(self, name) for name in self.__slots__)
+
 
 class Feed():
     """ Instanceable class to manage a named feed including storage, retrieval and genration functions.
 
+    Only the last [feeds][feed_name][max_entries] entries, no older than [feeds][feed_name][max_age] days, are kept.
+    New entries are held in memory until [app][max_in_flight_messages] or [app][max_in_flight_bytes] is reached, then stored (see flush()).
+
+    Set checkpoint (see mail.MailFetch.take_checkpoint()) once the fetched mail is all added, and the next flush() stores it
+    with the entries, so a feed is stored in one transaction per cycle unless new entries pile up beyond the limits above.
+
+    In worker mode, nothing is stored unless this worker still holds the feed's lease, see flush().
+
     :param feed_name: a string containg a feed name present in config.Feed.names() 
+    :param leases: the shard.ShardLeases of this worker, in worker mode
     """
-    def __init__(self, feed_name:str) -> None:
+    def __init__(self, feed_name:str, leases:Union['shard.ShardLeases', None]=None) -> None:
         self.feed_name = feed_name
+        self.leases = leases
+        self.discarded = False
         self.alternates = {}
-        self.added_mail_uuids = []
-        self.written_mail_uuids = None
+        self.new_entries = []
+        self.rerendered_entries = []
+        self.pending_bytes = 0 # size of the content held by new_entries
+        self.checkpoint = None # the mail.SyncState checkpoint to store with the next flush()
+        self.seen = store.SeenIndex(self.feed_name, store.get().connection())
 
-        # Retrieve fg from shelf is it exists otherwise create it using config options
-        with shelve.open(str(Path(config.paths["data"]).joinpath('feeds.shelf'))) as shelf:
-            try:
-                self.fg = shelf[self.feed_name]
-            except KeyError as e:
-                if not self.feed_name in shelf:
-                    # Mandatory ATOM values
-                    fg_config = config.ParseFeed.info(self.feed_name)
-                    self.fg = FeedGenerator()
-                    self.fg.id('tag:{},{}/feeds/{}.xml'.format(fg_config['fqdn'], date.today(), feed_name))
-                    href_ = '{}{}/feeds/{}.xml'.format(fg_config['protocol'], fg_config['fqdn'], feed_name)
-                    self.fg.link(rel='self', type='application/atom+xml', href=href_)
-                    self.fg.title(feed_name)
-                    self.fg.subtitle('Feed generated from mail messages recieved at {} by refeed'.format(config.ParseFeed.account_name(self.feed_name)))
-                    self.fg.author(name=fg_config['author-name']) 
-
-                    # Optional values
-                    try: 
-                        self.fg.logo(str(Path(config.paths["static"]).joinpath(fg_config['logo'])))
-                    except KeyError: 
-                        pass
-
-                    try: 
-                        self.fg.language(fg_config['language'])
-                    except KeyError:
-                        pass
-                else:
-                    raise KeyError(e)
+        # Retrieve feed id and update time from state store if it exists otherwise create it
+        row = store.get().connection().execute('SELECT feed_id, updated FROM feeds WHERE name = ?', (self.feed_name,)).fetchone()
+        if row is not None: 
+            self.feed_id, self.updated = row
+        else: 
+            fg_config = config.ParseFeed.info(self.feed_name)
+            self.feed_id = 'tag:{},{}/feeds/{}.xml'.format(fg_config['fqdn'], date.today(), feed_name)
+            self.updated = datetime.now(timezone.utc).timestamp()
 
     # context manager
     def __enter__(self) -> Feed:
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback) -> None: 
-        self._dump_shelves()
+        try: 
+            self._commit()
+        except LeaseLost: 
+            logging.error('Lease on feed {} lost, new entries not stored'.format(self.feed_name))
+            self.discard()
 
-    def add_entries_from_dict_if_new(self, mails:Dict[int, MailParser]) -> bool:
+    def entries(self) -> List[Entry]: 
+        """ Returns the retained entries of the feed, newest first, including those added but not yet stored. 
+        """
+        max_entries = config.ParseFeed.max_entries(self.feed_name)
+        cutoff = self._age_cutoff()
+        rows = store.get().connection().execute('SELECT {} FROM entries WHERE feed = ? AND updated >= ? ORDER BY updated DESC, seq DESC LIMIT ?'.format(Entry.columns), 
+            (self.feed_name, cutoff, max_entries))
+        stored = [Entry(*row) for row in rows]
+        for entry in stored: 
+            if entry.atom is None: # stored before fragments were cached
+                entry.render()
+                self.rerendered_entries.append(entry)
+        return (list(reversed(self.new_entries)) + stored)[:max_entries]
+
+    def header(self) -> Dict[str, Union[str, float, None, Dict[str, str]]]:
+        """ Returns the feed level values for render.FeedRender.document from config.
+        """
+        fg_config = config.ParseFeed.info(self.feed_name)
+        try: 
+            logo = '{}{}/{}'.format(fg_config['protocol'], fg_config['fqdn'], fg_config['logo'])
+        except KeyError: 
+            logo = None
+        return {
+            'id': self.feed_id,
+            'title': self.feed_name,
+            'subtitle': 'Feed generated from mail messages recieved at {} by refeed'.format(config.ParseFeed.account_name(self.feed_name)),
+            'author': fg_config['author-name'],
+            'language': fg_config.get('language', 'en'),
+            'logo': logo,
+            'updated': self.updated,
+            'links': {fmt: '{}{}/feeds/{}{}'.format(fg_config['protocol'], fg_config['fqdn'], self.feed_name, suffix) for fmt, suffix in FORMATS.items()}
+        }
+
+    def add_entries_from_dict_if_new(self, mails:Dict[int, 'parse.ParsedMail']) -> int:
+        """ Add an entry per mail not already in the feed, returns how many were added.
+        """
+        added = 0
+        max_messages = config.ParseApp.max_in_flight_messages()
+        max_bytes = config.ParseApp.max_in_flight_bytes()
         try: 
-            for uuid, mail in mails:
-                if FeedTools.uuid_not_in_feed(self.feed_name, uuid):
+            for uuid, mail in mails.items():
+                if uuid not in self.seen:
                     self.add_entry((uuid, mail))
+                    added += 1
+                    if (len(self.new_entries) >= max_messages) or (self.pending_bytes >= max_bytes): 
+                        self.flush()
+        except LeaseLost: 
+            raise
         except (TypeError, ValueError): 
             logging.error('Given NoneType as mailobject to Feed, some error in mail with IMAP.', exc_info=True)
         except Exception: 
             logging.error('Unexpected error', exc_info=True)
+        finally: 
+            Metrics.inc('refeed_entries_added_total', added, feed=self.feed_name)
+        return added
 
-    def add_entry(self, mail:Tuple[int, MailParser]) -> None:
+    def add_entry(self, mail:Tuple[int, 'parse.ParsedMail']) -> None:
         random.seed(None, 2)
-        fe = self.fg.add_entry(order='prepend') 
         fg_config = config.ParseFeed.info(self.feed_name)
         
         # id
         try:
-            fe.id('tag:{},{}/feeds/{}.xml:{}'.format(fg_config['fqdn'], date.today(), self.feed_name,mail[0]))
-        except (AttributeError, MailParserReceivedParsingError): 
-            fe.id('tag:{},{}/feeds/{}.xml:ID_NOT_FOUND-{}'.format(fg_config['fqdn'], date.today(), self.feed_name, ''.join(random.choices(string.ascii_lowercase + string.digits, k=10))))
+            entry_id = 'tag:{},{}/feeds/{}.xml:{}'.format(fg_config['fqdn'], date.today(), self.feed_name,mail[0])
+        except AttributeError: 
+            entry_id = 'tag:{},{}/feeds/{}.xml:ID_NOT_FOUND-{}'.format(fg_config['fqdn'], date.today(), self.feed_name, ''.join(random.choices(string.ascii_lowercase + string.digits, k=10)))
 
         # title
         try: 
-            fe.title(mail[1].subject)
-        except (AttributeError, MailParserReceivedParsingError):
-            fe.title('SUBJECT_NOT_FOUND-{}'.format(''.join(random.choices(string.ascii_lowercase + string.digits, k=10))))
+            title = mail[1].subject
+        except AttributeError:
+            title = 'SUBJECT_NOT_FOUND-{}'.format(''.join(random.choices(string.ascii_lowercase + string.digits, k=10)))
         
         # alt link and body contents
         try:
-            alt_id = FeedTools.generate_unique_alt_id()
-            self.alternates[alt_id] = mail[1].body
-            alt_link = '{}{}/alt-html/{}.html'.format(fg_config['protocol'], fg_config['fqdn'], alt_id)
-            fe.link(rel='alternate', type='text/html', href=alt_link)
-            fe.contents(content=mail[1].body, src=alt_link, type='text/html')
-        except (AttributeError, MailParserReceivedParsingError):
-            fe.contents(content='MAIL_BODY_NOT_FOUND', type='text/plain')
+            content = mail[1].body
+            alt_id = FeedTools.alt_id(content)
+            self.alternates[alt_id] = content
+            alt_link = '{}{}/alt-html/{}'.format(fg_config['protocol'], fg_config['fqdn'], FeedTools.alt_relpath(alt_id))
+            content_type = 'html'
+        except AttributeError:
+            content, alt_id, alt_link, content_type = 'MAIL_BODY_NOT_FOUND', None, None, 'text'
 
         #update time
-        now = datetime.now() # entry and feed should match exactly, not be a few seconds off.
-        fe.updated(now)
-        self.fg.updated(now) 
+        now = datetime.now(timezone.utc).timestamp() # entry and feed should match exactly, not be a few seconds off.
+        entry = Entry(mail[0], entry_id, title, alt_id, alt_link, content, content_type, now)
+        entry.render()
+        self.new_entries.append(entry)
+        self.pending_bytes += len(content)
+        self.updated = now
 
         # cache uuids added to feed
-        self.added_mail_uuids.append(mail[0]) 
+        self.seen.add(mail[0])
 
     def generate_feed(self) -> None:
+        with Metrics.time('refeed_feed_write_seconds', feed=self.feed_name): 
+            self._generate_feed()
+
+    def _generate_feed(self) -> None:
         # generate htmls
         if self.alternates != {}:
             try: 
-                for alt_id, body in self.alternates.items():
-                    with Path(config.paths["static"]).joinpath('alt', '{}.html'.format(str(alt_id))).open(mode='w') as f:
-                        f.write(body)
+                self._write_alts()
             except Exception: # Exception gets *most* inbuilt exceptions, except KeyboardInterrupt, SystemInterrupt and some others which are out of scope
                 logging.error('Failed to write some html alt pages to file for new entries for feed {}'.format(self.feed_name), exc_info=True)
             finally:
                 logging.info('Successfully generated html alt pages: {} for feed {}'.format(list(self.alternates.keys()), self.feed_name))
-                FeedTools.cleanup_alts(self.feed_name, config.ParseFeed.alternate_cache(self.feed_name))
 
-        # generate xml
+        # generate feed documents from cached entry fragments, only rewriting the published files if they changed
         try: 
-           self.fg.atom_file(str(Path(config.paths["static"]).joinpath('feed', '{}.xml'.format(self.feed_name))))
-        except Exception: # TODO: Find out what fucking exceptions that feedgen actually raises, if any(not documented - check source)
-            logging.error('Failed to generate and write new copy of feed {} to file'.format(self.feed_name))
-        finally: 
-            self.written_mail_uuids = self.added_mail_uuids
+            header = self.header()
+            entries = self.entries()
+            for fmt in config.ParseFeed.formats(self.feed_name): 
+                document = FeedRender.document(fmt, header, [getattr(entry, fmt) for entry in entries])
+                Publisher.publish(Path(config.paths["static"]).joinpath('feed', '{}{}'.format(self.feed_name, FORMATS[fmt])), document.encode('utf-8'), CONTENT_TYPES[fmt])
+        except Exception:
+            logging.error('Failed to generate and write new copy of feed {} to file'.format(self.feed_name), exc_info=True)
 
-    def _dump_shelves(self) -> None:
-        with shelve.open(str(Path(config.paths["data"]).joinpath('feeds.shelf'))) as shelf:
-            shelf[self.feed_name] = self.fg
-            logging.info('Atom data for feed {} stored to disk'.format(self.feed_name))
-        
-        with shelve.open(str(Path(config.paths["data"]).joinpath('alternate_ids.shelf'))) as shelf:
-            try:
-                shelf[self.feed_name] = shelf[self.feed_name].extend(list(self.alternates.keys()))
-            except (KeyError, AttributeError): # feed alternates list does not exist yet
-                shelf[self.feed_name] = list(self.alternates.keys())
-                logging.info('Alt id data for feed {} stored to disk for first time'.format(self.feed_name))
-            finally: 
-                logging.info('Alt id data for feed {} stored back to disk'.format(self.feed_name))
-
-        with shelve.open(str(Path(config.paths["data"]).joinpath('mail_uuids.shelf'))) as shelf:
-            try: 
-                shelf[self.feed_name] = shelf[self.feed_name].extend(self.written_mail_uuids)
-            except (KeyError, AttributeError): # feed id list does not exist yet
-                shelf[self.feed_name] = self.written_mail_uuids
-                logging.info('Mail UUID data for feed {} stored to disk for first time'.format(self.feed_name))
-            except TypeError: 
-                if self.written_mail_uuids is None:
-                    logging.info('Failed to write mail UUIDs to shelf file for feed {}: Newly written mail UUID data is None. Feed._dump_shelves() was likely called without any new items beeing added to feed'.format(self.feed_name), exc_info=True)
-                else: 
-                    logging.error('Failed to write mail UUIDs to shelf file for feed {}: Newly written mail UUID is not None, some unexpected error has occured. '.format(self.feed_name), exc_info=True)
-            finally: 
-                logging.info('Mail UUID data for feed {} stored back to disk'.format(self.feed_name))                
+    def _write_alts(self) -> None: 
+        for alt_id, body in self.alternates.items():
+            alt_path = FeedTools.alt_path(alt_id)
+            if not alt_path.exists(): # alt ids are content addressed, so an existing page is identical
+                alt_path.parent.mkdir(parents=True, exist_ok=True)
+                Publisher.write_atomic(alt_path, body.encode('utf-8'))
+
+    def _age_cutoff(self) -> float: 
+        max_age = config.ParseFeed.max_age(self.feed_name)
+        if max_age is None: 
+            return 0
+        return (datetime.now(timezone.utc) - timedelta(days=max_age)).timestamp()
+
+    def flush(self) -> None:
+        """ Write the alternate pages of, and store the feed, its new entries, alternate ids, seen mail uuids and sync checkpoint
+        in a single state store transaction, which also drops entries beyond the feed's retention and evicts alternate pages 
+        beyond its alternate_cache. Pages no feed references any more are only deleted once the transaction is committed.
+
+        Stored entries are no longer held in memory; they are read back by entries() when the feed documents are generated.
+
+        Raises shard.LeaseLost, storing nothing, if leases is set and no longer holds the feed's lease.
+        """
+        if (self.leases is not None) and (not self.leases.owns(self.feed_name)): 
+            raise LeaseLost(self.feed_name)
+        self._write_alts()
+        with store.get().transaction() as conn: 
+            # checked again in the transaction, so the lease cannot be taken over between the check and the writes
+            if (self.leases is not None) and (not self.leases.holds(conn, self.feed_name)): 
+                raise LeaseLost(self.feed_name)
+            conn.execute('INSERT OR REPLACE INTO feeds (name, feed_id, updated) VALUES (?, ?, ?)', (self.feed_name, self.feed_id, self.updated))
+            conn.executemany('INSERT OR REPLACE INTO entries (feed, {}) VALUES (?, {})'.format(Entry.columns, ', '.join('?' * len(Entry.__slots__))), 
+                (entry.as_row(self.feed_name) for entry in self.new_entries))
+            for alt_id in self.alternates.keys(): 
+                conn.execute('INSERT OR REPLACE INTO alternates (alt_id, feed, seq) VALUES (?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM alternates WHERE feed = ?))', (alt_id, self.feed_name, self.feed_name))
+            conn.executemany('UPDATE entries SET atom = ?, rss = ?, json = ? WHERE feed = ? AND uid = ?', 
+                ((entry.atom, entry.rss, entry.json, self.feed_name, entry.uid) for entry in self.rerendered_entries))
+            self.seen.flush(conn)
+            if self.checkpoint is not None: 
+                mail.SyncState.write(conn, self.checkpoint)
+
+            # retention
+            conn.execute('DELETE FROM entries WHERE feed = ? AND updated < ?', (self.feed_name, self._age_cutoff()))
+            conn.execute('DELETE FROM entries WHERE feed = ? AND seq NOT IN (SELECT seq FROM entries WHERE feed = ? ORDER BY updated DESC, seq DESC LIMIT ?)', 
+                (self.feed_name, self.feed_name, config.ParseFeed.max_entries(self.feed_name)))
+            evicted = FeedTools.evict_alts(conn, self.feed_name, config.ParseFeed.alternate_cache(self.feed_name)) if self.alternates != {} else []
+        logging.info('{} new entries of feed {} stored to disk'.format(len(self.new_entries), self.feed_name))
+
+        FeedTools.unlink_alts(evicted)
+        if self.alternates != {}: 
+            # a shared page may have been evicted by another feed between writing it and our commit 
+            self._write_alts()
+        self.checkpoint = None
+        self.alternates = {}
+        self.new_entries = []
+        self.rerendered_entries = []
+        self.pending_bytes = 0
+
+    def discard(self) -> None:
+        """ Drop the entries, alternate pages and seen uids not stored yet, and store nothing more on exit.
+        """
+        self.discarded = True
+        self.checkpoint = None
+        self.alternates = {}
+        self.new_entries = []
+        self.rerendered_entries = []
+        self.pending_bytes = 0
+
+    def _commit(self) -> None:
+        if not self.discarded: 
+            self.flush()
 
 
 class FeedTools():
     """ A uninstanced class to contain misscellanious standalone class methods for feed mangement.
     """
-    @classmethod
-    def uuid_not_in_feed(cls, feed_name:str, uuid:int):
-        with shelve.open(str(Path(config.paths["data"]).joinpath('mail_uuids.shelf'))) as shelf:
-            try:
-                for uuids in shelf[feed_name]: 
-                    if uuid not in uuids: 
-                        return True
-                    else: 
-                        return False
-            except KeyError: # presume that this is first mail and no data is stored for feed
-                logging.warning('Could not find feed_name in mail_uuid.shelf when checking if mail uuid is in feed - this is a normal occurance if the feed has no mail entries in it yet. Returning True: uuid is not in feed yet')
-                return True
-                
+    # alt ids per batched query / delete
+    batch_size = 500
+    # feed_name: formats as last reconciled by this process, see reconcile_feeds()
+    _manifest = None
 
     @classmethod
-    def cleanup_alts(cls, feed_name:str, max_alts:int) -> None: 
-        with shelve.open(str((Path(config.paths["data"]).joinpath('alternates.shelf')))) as shelf: 
-            if not isinstance(shelf[feed_name], list):
-                raise TypeError('Alternate list in shelf for feed {} is not a list'.format(feed_name))
-            else: 
-                if len(shelf[feed_name]) > max_alts: 
-                    delete_ids = shelf[feed_name][:(len(shelf[feed_name]) - max_alts)]
-                    deleted_ids = []
-                    for alt_id in delete_ids:
-                        try:
-                            Path(config.paths["static"]).joinpath('alt', '{}.html'.format(alt_id)).unlink()
-                        except FileNotFoundError:
-                            logging.error('feed.FeedTools.cleanup_alts attempted to delete static/{}.html and failed'.format(alt_id), exc_info=True) 
-                        finally: 
-                            deleted_ids.append(alt_id) 
-                    shelf[feed_name] = [e for e in shelf[feed_name] if e not in deleted_ids] 
+    def evict_alts(cls, conn:'sqlite3.Connection', feed_name:str, max_alts:int) -> List[str]: 
+        """ Evict all but the newest max_alts alternate pages of a feed. Must be called inside a transaction, returns the alt 
+        ids no feed references any more, for unlink_alts() once it is committed.
+        
+        Walks the (feed, seq) index from the newest page, so the cost is O(max_alts + evicted pages) regardless of history size.
+        """
+        # seq of the newest page to evict, if any
+        row = conn.execute('SELECT seq FROM alternates WHERE feed = ? ORDER BY seq DESC LIMIT 1 OFFSET ?', (feed_name, max_alts)).fetchone()
+        if row is None: 
+            return []
+        delete_ids = [row_[0] for row_ in conn.execute('SELECT alt_id FROM alternates WHERE feed = ? AND seq <= ?', (feed_name, row[0]))]
+        conn.execute('DELETE FROM alternates WHERE feed = ? AND seq <= ?', (feed_name, row[0]))
+        return cls._unreferenced_alts(conn, delete_ids)
 
     @classmethod
-    def cleanup_feeds(cls) -> None:
-        """ Remove a feed completely from all data stores if not present in config.conf.
-        
+    def reconcile_feeds(cls, keep:Iterable[str]=()) -> None:
+        """ Remove feeds no longer present in config.yaml from all data stores, and the documents of formats a feed no longer publishes.
+
         This includes:
-            - the fg object in feeds.shelf
-            - the atom feed itself, in /static/feed
-            - the alternate ids in alternate_ids.shelf
-            - the alternate html pages themselves, in /static/alt
-            - the recieved mail uuids in mail_uuids.shelf
-
-        This is a highly expensive operation, especially since where possible it does not assume all of the above data sources 
-        are in agreement with each other and instead checks each source against the config. It is intended to be run only when the refeed is started.
+            - the feed, its entries, alternate ids, recieved mail uuids and sync checkpoints in the state store
+            - the feed documents themselves (and their precompressed variants and sidecars), in /static/feed
+            - the alternate html pages no other feed references, in /static/alt
+
+        Only feeds added, removed or changed since the last reconciliation are touched: the feeds (and formats) reconciled 
+        are recorded in the manifest table, and kept in memory so calls where config.yaml has not changed feeds return 
+        immediately. This makes it cheap enough to run at startup and after every config reload, whatever the stored history.
+
+        Feeds in keep (e.g. leased by other workers, which may be running a newer config.yaml) are left as they are, and 
+        reconciled by a later call once they are no longer kept.
         """
+        keep = frozenset(keep)
+        current = {feed_name: tuple(config.ParseFeed.formats(feed_name)) for feed_name in config.ParseFeed.names()}
+        if current == cls._manifest: 
+            return
 
-        # remove fg object, atom feed xml
-        with shelve.open(str(Path(config.paths["data"]).joinpath('feeds.shelf'))) as shelf:
-            del_feeds = []
-            for feed in shelf.keys(): 
-                if feed not in config.ParseFeed.names():
-                    del_feeds.append(feed)  # we should not remove objects from shelf as we iterate over it
-            try:
-                for feed in del_feeds:
-                    del shelf[feed]
-            except KeyError:
-                logging.error('Failed to remove feed and fg item for no longer defined feed from feeds.shelf: {}'.format(feed), exc_info=True )
-
-                
-        # remove atom feed xml 
-        for file in Path(config.paths["static"]).joinpath('feed').iterdir(): 
-            if file.is_file():
-                try:
-                    Path(config.paths["static"]).joinpath('feed', '{}'.format(file)).unlink()
-                except FileNotFoundError: 
-                    logging.error('Failed to remove feed xml file for no longer defined feed from /static/feed: {}'.format(file), exc_info=True)
-        
-        # remove alt ids and pages - this is the only place we do not check each item against config as alt page names are only matched to feed names by alternate_ids.shelf
-        with shelve.open(str(Path(config.paths["data"]).joinpath('alternate_ids.shelf'))) as shelf:
-            del_feeds = []
-            for feed, ids in shelf.items(): 
-                if feed not in config.conf.feed.names(): 
-                    del_feeds.append(feed)
-                    
-                    try: 
-                        Path(config.paths["static"]).joinpath('feed', '{}.html'.format(feed)).unlink()
-                    except FileNotFoundError:
-                        logging.error('Failed to remove feed file for no longer defined feed: {}'.format(feed), exc_info=True)
-
-                    for id_ in ids: 
-                        try:
-                            Path(config.paths["static"]).joinpath('alt', '{}.html'.format(id_)).unlink()
-                        except FileNotFoundError: 
-                            logging.error('Failed to remove feed alternate html files: {}, for no longer defined feed: {}'.format(id_, feed), exc_info=True)  
-
-            try: # just as it is a bad idea to mutate dict during iteration on it, it is probably a bad idea for shelves.
-                for feed in del_feeds:
-                    del shelf[feed]                      
-            except KeyError: 
-                logging.error('Failed to remove alt id list for no longer defined feed from alternate_ids.shelf: {}'.format(feed), exc_info=True )
-
-        # remove recieved mail uuids 
-        with shelve.open(str(Path(config.paths["data"]).joinpath('mail_uuids.shelf'))) as shelf:
-            del_feeds = []
-            for feed in shelf.keys(): 
-                if feed not in config.ParseFeed.names():
-                    del_feeds.append(feed)
-            try:
-                for feed in del_feeds:
-                    del shelf[feed]
-            except KeyError: 
-                logging.error('Failed to remove recieved mail uuid list for no longer defined feed from mail_uuids.shelf: {}'.format(feed), exc_info=True )
+        stale_documents = []
+        unreferenced = []
+        with store.get().transaction() as conn: 
+            # formats is NULL for feeds recorded before formats were, any of them may have been published
+            manifest = {row[0]: tuple(row[1].split()) if row[1] is not None else tuple(FORMATS) for row in conn.execute('SELECT feed, formats FROM manifest')}
+            kept = [feed_name for feed_name in keep if manifest.get(feed_name) != current.get(feed_name)]
+            manifest = {feed_name: formats for feed_name, formats in manifest.items() if feed_name not in keep}
+            for feed_name, formats in manifest.items(): 
+                stale_formats = [fmt for fmt in formats if fmt not in current.get(feed_name, ())]
+                stale_documents.extend((feed_name, fmt) for fmt in stale_formats)
+                if feed_name not in current: 
+                    unreferenced.extend(cls._remove_feed(conn, feed_name))
+                    logging.info('Removed no longer defined feed {} from state store'.format(feed_name))
+                elif stale_formats != []: 
+                    logging.info('Removing documents of formats {} no longer published by feed {}'.format(stale_formats, feed_name))
+            conn.executemany('DELETE FROM manifest WHERE feed = ?', ((feed_name,) for feed_name in manifest if feed_name not in current))
+            conn.executemany('INSERT OR REPLACE INTO manifest (feed, formats) VALUES (?, ?)', 
+                ((feed_name, ' '.join(formats)) for feed_name, formats in current.items() if (feed_name not in keep) and (manifest.get(feed_name) != formats)))
+
+        cls.unlink_alts(unreferenced)
+        # remove feed documents, their precompressed variants and sidecars
+        for feed_name, fmt in stale_documents: 
+            Publisher.remove(Path(config.paths["static"]).joinpath('feed', '{}{}'.format(feed_name, FORMATS[fmt])))
+        cls._manifest = current if kept == [] else None
 
     @classmethod
-    def generate_unique_alt_id(cls) -> str: 
-        """ Generate a psuedo-random 30 character alphanumeric (lower case only) id that is not in alternates.shelf
+    def _remove_feed(cls, conn:'sqlite3.Connection', feed_name:str) -> List[str]: 
+        """ Delete a feed and its alternate pages from the state store. Must be called inside a transaction, returns the alt 
+        ids no feed references any more, for unlink_alts() once it is committed.
         """
-        with shelve.open(str(Path(config.paths["data"]).joinpath('alternates.shelf'))) as shelf:
-            all_ids = []
-            try: 
-                for feed_ids in shelf.values(): 
-                    if isinstance(feed_ids, list):
-                        all_ids.extend(feed_ids)
-            except (NameError, KeyError): # probably not necessary?
-                pass
+        # remove alt pages - alt page names are only matched to feed names by the alternates table
+        alt_ids = [row[0] for row in conn.execute('SELECT alt_id FROM alternates WHERE feed = ?', (feed_name,))]
+        conn.execute('DELETE FROM alternates WHERE feed = ?', (feed_name,))
+        unreferenced = cls._unreferenced_alts(conn, alt_ids)
+        conn.execute('DELETE FROM feeds WHERE name = ?', (feed_name,))
+        conn.execute('DELETE FROM entries WHERE feed = ?', (feed_name,))
+        conn.execute('DELETE FROM seen_uids WHERE feed = ?', (feed_name,))
+        conn.execute('DELETE FROM sync_state WHERE consumer = ?', (feed_name,))
+        return unreferenced
 
-        random.seed(None, 2)
-        alternate_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=30)) 
-        while alternate_id in all_ids:
-            alternate_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=30)) 
-        return alternate_id
+    @classmethod
+    def alt_id(cls, body:str) -> str: 
+        """ Returns the 30 character (lower case hex) content address of an alternate html page.
+
+        Identical bodies get the same id, so they share a single page across entries and feeds.
+        """
+        return hashlib.sha256(body.encode('utf-8', 'surrogatepass')).hexdigest()[:30]
+
+    @classmethod
+    def alt_relpath(cls, alt_id:str) -> str: 
+        """ Returns the path of an alternate page relative to static/alt (and the alt-html url path).
+
+        Pages are sharded into two levels of hash prefix directories (alt/ab/cd/abcd....html), so no directory grows past a few hundred entries.
+        """
+        return '{}/{}/{}.html'.format(alt_id[0:2], alt_id[2:4], alt_id)
+
+    @classmethod
+    def alt_path(cls, alt_id:str) -> Path: 
+        return Path(config.paths["static"]).joinpath('alt', cls.alt_relpath(alt_id))
+
+    @classmethod
+    def migrate_alt_layout(cls) -> None: 
+        """ One-time move of alternate pages from the flat static/alt/<id>.html layout into hash prefix directories. 
+
+        Links of stored entries are rewritten to match, and their cached fragments dropped so they are rendered again. 
+        Safe to run on every startup: once migrated only the (at most 256) prefix directories are listed.
+
+        Resumable: links of a batch are rewritten before its pages are moved, and a page still at its flat path is moved on 
+        the next run (or just removed, if its sharded copy already exists, as pages are content addressed).
+        """
+        flat = [file for file in Path(config.paths["static"]).joinpath('alt').glob('*.html') if file.is_file()]
+        if flat == []: 
+            return
+        logging.warning('Migrating {} alternate pages to sharded static/alt layout'.format(len(flat)))
+
+        for batch in (flat[i:i + cls.batch_size] for i in range(0, len(flat), cls.batch_size)): 
+            # rewriting a link again is a no-op, so a batch interrupted after this transaction is simply redone
+            with store.get().transaction() as conn: 
+                for file in batch: 
+                    alt_id = file.stem
+                    conn.execute("UPDATE entries SET link = replace(link, ?, ?), atom = NULL, rss = NULL, json = NULL WHERE alt_id = ? AND link LIKE ?", 
+                        ('/alt-html/{}.html'.format(alt_id), '/alt-html/{}'.format(cls.alt_relpath(alt_id)), alt_id, '%/alt-html/{}.html'.format(alt_id)))
+            for file in batch: 
+                new_path = cls.alt_path(file.stem)
+                if new_path.exists(): 
+                    file.unlink()
+                    continue
+                new_path.parent.mkdir(parents=True, exist_ok=True)
+                file.replace(new_path)
+
+    @classmethod
+    def _unreferenced_alts(cls, conn:'sqlite3.Connection', alt_ids:List[str]) -> List[str]: 
+        """ Returns the alt_ids that no feed references any more. Must be called inside a transaction, after deleting rows.
+        """
+        unreferenced = []
+        for batch in (alt_ids[i:i + cls.batch_size] for i in range(0, len(alt_ids), cls.batch_size)): 
+            referenced = {row[0] for row in conn.execute('SELECT DISTINCT alt_id FROM alternates WHERE alt_id IN ({})'.format(', '.join('?' * len(batch))), batch)}
+            unreferenced.extend(alt_id for alt_id in batch if alt_id not in referenced)
+        return unreferenced
+
+    @classmethod
+    def unlink_alts(cls, alt_ids:Iterable[str]) -> None: 
+        """ Delete the pages of alt_ids, as returned by a committed evict_alts() or _remove_feed().
+        """
+        for alt_id in alt_ids: 
+            try:
+                Publisher.unlink(cls.alt_path(alt_id))
+            except FileNotFoundError:
+                logging.error('feed.FeedTools attempted to delete static/alt/{} and failed'.format(cls.alt_relpath(alt_id)), exc_info=True) 
@@ -0,0 +1,264 @@
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+# STDLIB
+from email.parser import BytesHeaderParser
+from email import policy
+from typing import Dict, List, Tuple, Union, Mapping, Iterable, Hashable, Sequence
+import logging
+import re
+
+# mail properties (as named by mailparser) that can be evaluated from message headers alone, and their header field
+HEADER_PROPERTIES = {
+    'from_': 'FROM',
+    'to': 'TO',
+    'cc': 'CC',
+    'bcc': 'BCC',
+    'subject': 'SUBJECT',
+    'date': 'DATE',
+    'delivered_to': 'DELIVERED-TO',
+    'reply_to': 'REPLY-TO',
+    'message_id': 'MESSAGE-ID',
+    'received': 'RECEIVED'
+}
+
+# mailparser properties that are not headers, only evaluated on whole fetched messages (see parse.parse_message)
+BODY_PROPERTIES = ('body', 'text_plain', 'text_html', 'text_not_managed', 'attachments', 'headers', 'to_domains', 'timezone', 
+    'defects', 'defects_categories', 'has_defects', 'received_raw')
+
+OPERATORS = ('EXCLUDE', 'AND', 'OR')
+
+# header properties with a dedicated IMAP SEARCH key, the others are searched with `HEADER <field> <string>`
+SEARCH_KEYS = {
+    'from_': 'FROM',
+    'to': 'TO',
+    'cc': 'CC',
+    'bcc': 'BCC',
+    'subject': 'SUBJECT'
+}
+
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]|()')
+# leading inline flags such as (?i), their effect is already in Pattern.flags
+_INLINE_FLAGS = re.compile(r'^\(\?[aiLmsux]+\)')
+# numbered or named backreferences, which would refer to other groups once patterns are merged
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+class FilterPlan():
+    """ A feed's EXCLUDE/AND/OR filters compiled once into an evaluation plan.
+
+    Rules are grouped per property and operator. All EXCLUDE regexes of a property are merged into one alternation, and so
+    are all OR regexes of a property; AND regexes must each match, so they stay separate. Evaluation short-circuits in
+    priority order: any EXCLUDE match rejects, then any AND miss rejects, then at least one OR must match (if there are any).
+
+    Messages are given as a mapping of property name to its string value, see values_from_headers() and values_from_mail().
+    Header properties always have their decoded header value, whether from fetched headers or a whole parsed message, so
+    a rule matches the same string either way.
+
+    :param filters: {property: {operator: pattern or list of patterns}}, as returned by config.ConfigData.f_filters
+    """
+    def __init__(self, filters:Union[Mapping[str, Mapping[str, Union[re.Pattern, Sequence[re.Pattern]]]], None]) -> None:
+        rules = {oper: {} for oper in OPERATORS}
+        for property_, pfilters in (filters or {}).items():
+            for oper, patterns in pfilters.items():
+                oper = str(oper).upper()
+                if oper not in OPERATORS:
+                    raise ValueError('Unknown filter operation {} for mail property {}'.format(oper, property_))
+                if (property_ not in HEADER_PROPERTIES) and (property_ not in BODY_PROPERTIES):
+                    raise ValueError('Unknown mail property {}, expected one of {}'.format(property_, tuple(HEADER_PROPERTIES) + BODY_PROPERTIES))
+                if isinstance(patterns, re.Pattern):
+                    patterns = [patterns]
+                rules[oper].setdefault(str(property_), []).extend(patterns)
+
+        self.excludes = [(property_, self._merge(patterns)) for property_, patterns in rules['EXCLUDE'].items()]
+        self.ands = [(property_, pattern) for property_, patterns in rules['AND'].items() for pattern in patterns]
+        self.ors = [(property_, self._merge(patterns)) for property_, patterns in rules['OR'].items()]
+        self.rules = rules
+        self.properties = frozenset(rules['EXCLUDE']) | frozenset(rules['AND']) | frozenset(rules['OR'])
+        self.search_criteria = self._search_criteria()
+
+    def __bool__(self) -> bool:
+        return bool(self.properties)
+
+    @classmethod
+    def _merge(cls, patterns:List[re.Pattern]) -> re.Pattern:
+        if len(patterns) == 1:
+            return patterns[0]
+        flags = {pattern.flags for pattern in patterns}
+        try:
+            if len(flags) != 1:
+                raise re.error('differing flags')
+            if any(_BACKREFERENCE.search(str(pattern.pattern)) for pattern in patterns):
+                raise re.error('backreferences would be renumbered')
+            return re.compile('|'.join('(?:{})'.format(pattern.pattern) for pattern in patterns), flags.pop())
+        except re.error:
+            # cannot be merged (e.g. inline global flags or backreferences), fall back to trying each in turn
+            return _AnyPattern(patterns)
+
+    def _search_criteria(self) -> List[Union[str, list]]:
+        """ Returns the IMAP SEARCH criteria (in imapclient form) implied by the rules that can be expressed server side.
+
+        IMAP SEARCH header keys are case insensitive substring matches, so a literal or anchored literal regex matches a
+        subset of what the server returns, and AND/OR rules only narrow the search to a superset of the passing messages,
+        which are still checked on the client. EXCLUDE is pushed down as NOT only if the regex is an unanchored, case
+        insensitive literal, where the server and the client agree exactly.
+        """
+        criteria = []
+        for property_, patterns in self.rules['EXCLUDE'].items():
+            for pattern in patterns:
+                literal = self._literal(property_, pattern)
+                if (literal is not None) and (not literal[1]) and (pattern.flags & re.IGNORECASE):
+                    criteria.extend(['NOT', self._search_key(property_, literal[0])])
+        for property_, patterns in self.rules['AND'].items():
+            for pattern in patterns:
+                literal = self._literal(property_, pattern)
+                if literal is not None:
+                    criteria.extend(self._search_key(property_, literal[0]))
+        # ORs can only be pushed down if every one of them can
+        keys = []
+        for property_, patterns in self.rules['OR'].items():
+            for pattern in patterns:
+                literal = self._literal(property_, pattern)
+                if literal is None:
+                    return criteria
+                keys.append(self._search_key(property_, literal[0]))
+        if keys != []:
+            or_criteria = keys[-1]
+            for key in reversed(keys[:-1]):
+                or_criteria = ['OR', key, or_criteria]
+            criteria.append(or_criteria)
+        return criteria
+
+    @classmethod
+    def any_search_criteria(cls, plans:Iterable['FilterPlan']) -> List[Union[str, list]]:
+        """ Returns IMAP SEARCH criteria matching every message that the search_criteria of any of plans would, for feeds
+        fetched together from one folder. Empty (no narrowing) if any plan has no criteria.
+        """
+        criteria = []
+        for plan in plans:
+            if plan.search_criteria == []:
+                return []
+            if plan.search_criteria not in criteria:
+                criteria.append(plan.search_criteria)
+        if len(criteria) < 2:
+            return criteria[0] if criteria != [] else []
+        any_criteria = criteria[-1]
+        for plan_criteria in reversed(criteria[:-1]):
+            any_criteria = ['OR', plan_criteria, any_criteria]
+        return [any_criteria]
+
+    @classmethod
+    def _literal(cls, property_:str, pattern:re.Pattern) -> Union[Tuple[str, bool], None]:
+        """ Returns (literal, anchored) if pattern, on a header property, is a plain ASCII string optionally anchored with ^ 
+        and/or $, else None.
+        """
+        if (property_ not in HEADER_PROPERTIES) or (pattern.flags & re.VERBOSE) or (not isinstance(pattern.pattern, str)):
+            return None
+        source = _INLINE_FLAGS.sub('', pattern.pattern)
+        anchored = False
+        if source.startswith('^'):
+            source, anchored = source[1:], True
+        if source.endswith('$') and not source.endswith('\\$'):
+            source, anchored = source[:-1], True
+        literal = []
+        escaped = False
+        for char in source:
+            if escaped:
+                if char.isalnum():
+                    return None # a class or escape sequence such as \d or \b
+                literal.append(char)
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char in _REGEX_SPECIAL:
+                return None
+            else:
+                literal.append(char)
+        literal = ''.join(literal)
+        if escaped or (literal == '') or (not literal.isascii()) or (not literal.isprintable()):
+            return None
+        return literal, anchored
+
+    @classmethod
+    def _search_key(cls, property_:str, literal:str) -> List[str]:
+        if property_ in SEARCH_KEYS:
+            return [SEARCH_KEYS[property_], literal]
+        return ['HEADER', HEADER_PROPERTIES[property_], literal]
+
+    def header_fields(self) -> Union[List[str], None]:
+        """ Returns the header fields needed to evaluate the plan, or None if it uses properties that are not headers.
+        """
+        try:
+            return sorted({HEADER_PROPERTIES[property_] for property_ in self.properties})
+        except KeyError:
+            return None
+
+    def matches(self, values:Mapping[str, str]) -> bool:
+        for property_, pattern in self.excludes:
+            if pattern.search(values.get(property_, '')) is not None:
+                return False
+        for property_, pattern in self.ands:
+            if pattern.search(values.get(property_, '')) is None:
+                return False
+        if self.ors == []:
+            return True
+        for property_, pattern in self.ors:
+            if pattern.search(values.get(property_, '')) is not None:
+                return True
+        return False
+
+    def select(self, messages:Iterable[Tuple[Hashable, Mapping[str, str]]]) -> List[Hashable]:
+        """ Batch evaluation: returns the keys of the (key, values) pairs that pass the plan, in order.
+        """
+        if not self:
+            return [key for key, _ in messages]
+        matches = self.matches
+        return [key for key, values in messages if matches(values)]
+
+    @classmethod
+    def values_from_headers(cls, raw_headers:bytes, properties:Iterable[str]) -> Dict[str, str]:
+        """ Returns the decoded value of each header property from raw header bytes (repeated fields joined with newlines).
+        """
+        message = _header_parser.parsebytes(raw_headers)
+        values = {}
+        for property_ in properties:
+            try:
+                values[property_] = '\n'.join(str(value) for value in message.get_all(HEADER_PROPERTIES[property_], []))
+            except Exception: # malformed headers should not stop the whole batch
+                logging.debug('Failed to decode header for filter property {}'.format(property_), exc_info=True)
+                values[property_] = ''
+        return values
+
+    @classmethod
+    def values_from_mail(cls, mail:'parse.ParsedMail', properties:Iterable[str]) -> Dict[str, str]:
+        """ Returns the value of each property of a parse.ParsedMail, as extracted by parse.parse_message().
+        """
+        return {property_: mail.filter_values.get(property_, '') for property_ in properties}
+
+    @classmethod
+    def values_from_message(cls, raw:bytes, mail:object, properties:Iterable[str]) -> Dict[str, str]:
+        """ Returns the value of each property of a whole raw message: header properties decoded from its headers as by
+        values_from_headers(), the others as the str() of the property of mail, the message parsed by mailparser.
+        """
+        values = cls.values_from_headers(raw, [property_ for property_ in properties if property_ in HEADER_PROPERTIES])
+        for property_ in properties:
+            if property_ not in HEADER_PROPERTIES:
+                try:
+                    values[property_] = str(getattr(mail, property_))
+                except Exception: # e.g. MailParserReceivedParsingError
+                    logging.debug('Failed to parse filter property {}'.format(property_), exc_info=True)
+                    values[property_] = ''
+        return values
+
+class _AnyPattern():
+    """ Duck types re.Pattern.search over several patterns that cannot be merged into one.
+    """
+    def __init__(self, patterns:List[re.Pattern]) -> None:
+        self.patterns = patterns
+
+    def search(self, string:str) -> Union[re.Match, None]:
+        for pattern in self.patterns:
+            match = pattern.search(string)
+            if match is not None:
+                return match
+        return None
+
+_header_parser = BytesHeaderParser(policy=policy.default)
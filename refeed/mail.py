@@ -4,96 +4,196 @@
 import re
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Tuple, Union, Tuple
-import shelve
+from typing import Dict, List, NamedTuple, Set, Tuple, Union, Iterator, Callable
 import logging
+import threading
+import time
+import importlib
+from collections import defaultdict
 from socket import error as SocketError, timeout as SocketTimeout
 from ssl import SSLError, CertificateError
 
 # 3RD PARTY 
-import mailparser
-from imapclient import IMAPClient, exceptions as IMAPExceptions
+# imapclient (and imaplib, ssl... under it) is only imported on first use, see _LazyModule
 
 # INTERNAL 
 """ If we use the form `import x`, we can modify x.var. 
  However, with the form `from . import x`(relative or absolute), we cannot.
  The second form, where the namespace is modifies, it is equivalent to setting 
  the value of the import attrs to a module-specific global"""
-import config 
+import config, store, parse, filters
+from metrics import Metrics
 
 """ Please ignore the following pylint errors.
     Errors due to Pylint bugs:
        ` Value 'Union' is unsubscriptable` on typehints is a python3.9 error (PyCQA/pylint#3882)
 """
 
+class _LazyModule():
+    """ Stands in for a module, which is only imported on first attribute access, so refeed starts without paying for it.
+    """
+    def __init__(self, name:str) -> None:
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr:str) -> object:
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+imapclient = _LazyModule('imapclient')
+IMAPExceptions = _LazyModule('imapclient.exceptions')
+
 class MailFetch():
     """ Provides tools to fetch mail as required using _IMAPConn
     """
+    # uids per FETCH command for header-only and full message fetches
+    header_batch_size = 500
+    body_batch_size = 50
 
     @classmethod
-    def new_mail(cls, feed_name:str, since:int) -> Union[None, Dict[int, mailparser.MailParser]]:
+    def new_mail(cls, feed_name:str, since:int) -> Dict[int, 'parse.ParsedMail']:
+        """ Returns all mail newer than the feed's sync checkpoint at once, see stream_mail().
+        """
+        new_mail = {}
+        for batch in cls.stream_mail(feed_name, since): 
+            new_mail.update(batch)
+        return new_mail
 
-        """ Returns mail with 'INTERNALTIME' ('SINCE' provides only date granularity) 'SINCE' since days ago.
-        
+    @classmethod
+    def stream_mail(cls, feed_name:str, since:int, seen:Union['store.SeenIndex', None]=None) -> Iterator[Dict[int, 'parse.ParsedMail']]:
+        """ Yields mail newer than the feed's sync checkpoint in batches of uid: parse.ParsedMail, see stream_folder().
+        """
+        for batch in cls.stream_folder([feed_name], since, {feed_name: seen} if seen is not None else None): 
+            yield batch[feed_name]
+
+    @classmethod
+    def stream_folder(cls, feed_names:List[str], since:int, seen:Union[Dict[str, 'store.SeenIndex'], None]=None) -> Iterator[Dict[str, Dict[int, 'parse.ParsedMail']]]:
+        """ Yields mail newer than each feed's sync checkpoint (see SyncState), in batches of feed_name: {uid: parse.ParsedMail}.
+
+        feed_names must all fetch from the same account and folder. Their new mail is searched for, fetched and parsed once, 
+        then handed out to every feed whose filters it passes, so N feeds splitting one folder cost one download instead of N.
+
+        Without a valid checkpoint, returns mail with 'INTERNALTIME' ('SINCE' provides only date granularity) 'SINCE' since days ago.
         IETF IMAP RFCs don't specify a TZ for 'INTERNALTIME'.
+
+        Batches hold at most body_batch_size and [app][max_in_flight_messages] messages, and at most [app][max_in_flight_bytes] 
+        of message data (or a single larger message), and the next batch is only fetched once the caller asks for it, so memory 
+        use does not grow with the size of the folder. Uids in a feed's seen index are skipped for that feed before anything is 
+        fetched. The sync checkpoints are only made pending (see take_checkpoint()) once the last batch has been consumed.
         """
 
         try: 
             # get account info
-            account_name = config.ParseFeed.account_name(feed_name)
+            account_name = config.ParseFeed.account_name(feed_names[0])
             server_options = config.ParseAccount.server_options(account_name)
             auth_type = config.ParseAccount.auth_type(account_name)
             credentials = config.ParseAccount.credentials(account_name)
             # get feed/filter info
-            filters = config.ParseFeed.filters(feed_name)
-            folder = config.ParseFeed.folder(feed_name)
-        except config.UserConfigError() as e: 
+            folder = config.ParseFeed.folder(feed_names[0])
+            for feed_name in feed_names: 
+                if (config.ParseFeed.account_name(feed_name), config.ParseFeed.folder(feed_name)) != (account_name, folder): 
+                    raise ConfigError('Feed {} does not fetch from {}/{}'.format(feed_name, account_name, folder))
+            filter_plans = {feed_name: config.ParseFeed.filter_plan(feed_name) for feed_name in feed_names}
+            max_messages = min(cls.body_batch_size, config.ParseApp.max_in_flight_messages())
+            max_bytes = config.ParseApp.max_in_flight_bytes()
+            max_part_bytes = config.ParseApp.max_part_bytes()
+        except config.UserConfigError as e: 
             raise ConfigError() from e 
 
+        # feeds filtering on headers only are filtered in phase 1, feeds filtering on other properties on the parsed messages in phase 2
+        header_feeds = {feed_name: plan for feed_name, plan in filter_plans.items() if plan and (plan.header_fields() is not None)}
+        body_feeds = {feed_name: plan for feed_name, plan in filter_plans.items() if plan and (plan.header_fields() is None)}
+        for feed_name in body_feeds: 
+            logging.debug('Filters for feed {} use mail properties that are not headers, filtering on full messages'.format(feed_name))
+        header_properties = frozenset().union(*(plan.properties for plan in header_feeds.values()))
+        body_properties = frozenset().union(*(plan.properties for plan in body_feeds.values()))
+
         with _IMAPConn(account_name, server_options, auth_type, credentials) as server: 
             try: 
                 if server.folder_exists(folder):
-                    server.select_folder(folder)
+                    if server.has_capability('CONDSTORE') and server.has_capability('ENABLE'):
+                        server.enable('CONDSTORE')
+                    with Metrics.time('refeed_imap_command_seconds', account=account_name, command='select'): 
+                        select_info = server.select_folder(folder)
                 else: 
                     logging.exception('Folder {} does not exist for account {}'.format(folder, account_name))
                     raise ConfigError('Folder {} does not exist for account {}'.format(folder, account_name))
 
-                try: 
-                    uuids = server.search([u'SINCE', (datetime.utcnow().date() - timedelta(days=since))] , 'UTF-8')
-                except IMAPExceptions.InvalidCriteriaError as e: 
-                    logging.critical('Malformed imap search criteria, refeed will never be able to fetch new mail. Something is very wrong, open a github issue', exc_info=True)
-                    raise GenericHandledException() from e
-
-                new_mail = {}
-                for uuid in uuids:
-                    uuid = int(uuid) # uuid is 32bit int, just cast to int in case IMAPClient is returning bytes. 
-                    mail = mailparser.parse_from_bytes(server.fetch([uuid], ['RFC822'])[uuid][b'RFC822'])
-                    if filters is not None: 
-                        for property_, filters in filters.items():
-                            try:
-                                property_obj = getattr(mail, field)
-                            except AttributeError:
-                                logging.exception('filters contains a mail property that is not present in parsed mail object:', exc_info=True)
-                                logging.debug('Raw mail dump: {}'.format(mail.name_raw))
-                                if (mail.defects() is not None) and (mail.defects() != []): 
-                                    logging.debug('Mail not in compliance with RFC; defects: {}'.format(mail.defects()))
-                                raise ConfigError() from e
-
-                            for oper, filter_ in filters.items():
-                                or_passing = None 
-                                re_res = filter_.search(property_obj)
-                                if (oper.casefold() == 'EXCLUDE'.casefold()) and (re_res is not None):
-                                    break 
-                                elif (oper.casefold() == 'AND'.casefold()) and (re_res is None):
-                                    break 
-                                elif (oper.casefold() == 'OR'.casefold()):
-                                    if (or_passing is None) and (re_res is None):
-                                        or_passing = False  
-                                    else:
-                                        or_passing = True 
-                            else: 
-                                if (or_passing) or (or_passing is None): 
-                                    new_mail[uuid] = mail   
+                wanted, checkpoints = SyncState.plan(server, select_info, account_name, folder, feed_names, since, 
+                    filters.FilterPlan.any_search_criteria(filter_plans.values()))
+                if seen is not None: 
+                    for feed_name, checkpoint in checkpoints.items(): 
+                        if (checkpoint['resync_uids'] is not None) and (feed_name in seen): 
+                            seen[feed_name].reset()
+                    wanted = {feed_name: {uuid for uuid in uuids if uuid not in seen[feed_name]} if feed_name in seen else uuids for feed_name, uuids in wanted.items()}
+                uuids = sorted(set().union(*wanted.values()))
+
+                # phase 1: for all candidate uids, fetch only what is needed to choose and size the messages to download: the 
+                # headers the filters need (filtering on them right away), and with partial fetch the BODYSTRUCTURE and subject
+                partial = config.ParseApp.partial_fetch() and (body_feeds == {})
+                sizes = {}
+                parts = {}  # uid: (subject header, _BodyStructure.TextPart or None) of messages to fetch the text part of
+                selected = {feed_name: set(uuids) for feed_name, uuids in wanted.items()}  # feed_name: uids it wants that passed its header filters
+                if header_feeds or partial or (len(uuids) > 1): # a single message is fetched alone whatever its size
+                    items = ['RFC822.SIZE']
+                    fields = {filters.HEADER_PROPERTIES[property_] for property_ in header_properties}
+                    if partial: 
+                        items.append('BODYSTRUCTURE')
+                        fields.add('SUBJECT')
+                    if fields: 
+                        items.append('BODY.PEEK[HEADER.FIELDS ({})]'.format(' '.join(sorted(fields))))
+                    for feed_name in header_feeds: 
+                        selected[feed_name] = set()
+                    for batch in cls._batches(uuids, cls.header_batch_size): 
+                        with Metrics.time('refeed_imap_command_seconds', account=account_name, command='fetch_headers'): 
+                            response = {int(uuid): data for uuid, data in server.fetch(batch, items).items()}
+                        Metrics.inc('refeed_imap_fetched_bytes_total', sum(len(cls._response_part(data, b'BODY[HEADER')) for data in response.values()), account=account_name)
+                        for uuid, data in response.items(): 
+                            sizes[uuid] = data.get(b'RFC822.SIZE', 0)
+                            if partial: 
+                                try: 
+                                    part = _BodyStructure.text_part(data.get(b'BODYSTRUCTURE'))
+                                except ValueError: 
+                                    logging.debug('Unusable BODYSTRUCTURE for message {} in {}/{}, fetching it whole'.format(uuid, account_name, folder), exc_info=True)
+                                    continue
+                                parts[uuid] = (cls._response_part(data, b'BODY[HEADER'), part)
+                                sizes[uuid] = cls._part_size(part, max_part_bytes)
+                        if header_feeds: 
+                            values = [(uuid, filters.FilterPlan.values_from_headers(cls._response_part(data, b'BODY[HEADER'), header_properties)) for uuid, data in response.items()]
+                            for feed_name, plan in header_feeds.items(): 
+                                selected[feed_name].update(plan.select((uuid, value) for uuid, value in values if uuid in wanted[feed_name]))
+                        for feed_name in wanted: 
+                            if feed_name not in header_feeds: # drop uids expunged since the search
+                                selected[feed_name].difference_update(uuid for uuid in batch if uuid not in response)
+                    for feed_name in header_feeds: 
+                        logging.debug('{} of {} messages passed header filters for feed {}'.format(len(selected[feed_name]), len(wanted[feed_name]), feed_name))
+                        Metrics.inc('refeed_messages_filtered_total', len(wanted[feed_name]) - len(selected[feed_name]), feed=feed_name)
+                del wanted
+                candidates = [uuid for uuid in uuids if any(uuid in uuids_ for uuids_ in selected.values())]
+
+                # phase 2: fetch and parse each remaining message (or only its text part) once, a bounded batch at a time, and hand 
+                # it to every feed that selected it and whose non-header filters it passes
+                for batch in cls._bounded_batches(candidates, sizes, max_messages, max_bytes):
+                    raws = cls._fetch_messages(server, account_name, batch, parts, max_part_bytes)
+                    uuids_batch = list(raws)
+                    mails = dict(zip(uuids_batch, parse.MailParse.parse_batch(list(raws.values()), body_properties)))
+                    del raws
+                    # once per message, however many feeds share it
+                    Metrics.inc('refeed_messages_parsed_total', len(mails), account=account_name)
+                    new_mail = {}
+                    for feed_name in feed_names: 
+                        feed_mails = {uuid: mail for uuid, mail in mails.items() if uuid in selected[feed_name]}
+                        if feed_name in body_feeds: 
+                            plan = body_feeds[feed_name]
+                            passed = {uuid: mail for uuid, mail in feed_mails.items() if plan.matches(plan.values_from_mail(mail, plan.properties))}
+                            Metrics.inc('refeed_messages_filtered_total', len(feed_mails) - len(passed), feed=feed_name)
+                            feed_mails = passed
+                        if feed_mails != {}: 
+                            new_mail[feed_name] = feed_mails
+                    del mails
+                    if new_mail != {}: 
+                        yield new_mail
 
             except (SocketTimeout, SocketError) as e: 
                 logging.exception('A network error with the socket library has caused mail._IMAPConn in mail.MailFetch.newmail() to fail/drop server connection for account {}'.format(account_name))
@@ -111,36 +211,549 @@ class MailFetch():
                 logging.exception('Unknown error occured in mail.MailFetch.new_mail')
                 raise GenericHandledException() from e
 
-            return new_mail
+            SyncState.pending.update(checkpoints)
+
+    @classmethod
+    def _fetch_messages(cls, server:'imapclient.IMAPClient', account_name:str, uuids:List[int], parts:Dict[int, Tuple[bytes, Union['_BodyStructure.TextPart', None]]], 
+            max_part_bytes:Union[int, None]) -> Dict[int, bytes]:
+        """ Returns uid: RFC822 bytes for uuids, in order. Messages in parts are rebuilt from their subject and text part (see 
+        _BodyStructure.message()), fetched with one FETCH per distinct part section, and the others are fetched whole.
+        """
+        raws = {}
+        whole = [uuid for uuid in uuids if uuid not in parts]
+        if whole != []: 
+            with Metrics.time('refeed_imap_command_seconds', account=account_name, command='fetch'): 
+                response = server.fetch(whole, ['RFC822'])
+            Metrics.inc('refeed_imap_fetched_bytes_total', sum(len(data[b'RFC822']) for data in response.values()), account=account_name)
+            # uuid is 32bit int, just cast to int in case IMAPClient is returning bytes. 
+            raws.update((int(uuid), data[b'RFC822']) for uuid, data in response.items())
+
+        sections = defaultdict(list)
+        for uuid in uuids: 
+            if uuid in parts: 
+                subject, part = parts.pop(uuid)
+                if part is None: # no text part, nothing to fetch
+                    raws[uuid] = _BodyStructure.message(subject, None, b'')
+                else: 
+                    sections[part.section].append((uuid, subject, part))
+        for section, messages in sections.items(): 
+            item = 'BODY.PEEK[{}]'.format(section) if max_part_bytes is None else 'BODY.PEEK[{}]<0.{}>'.format(section, max_part_bytes)
+            with Metrics.time('refeed_imap_command_seconds', account=account_name, command='fetch_parts'): 
+                response = {int(uuid): data for uuid, data in server.fetch([uuid for uuid, _, _ in messages], [item]).items()}
+            for uuid, subject, part in messages: 
+                if uuid not in response: # expunged since phase 1
+                    continue
+                data = cls._response_part(response[uuid], b'BODY[') or b''
+                Metrics.inc('refeed_imap_fetched_bytes_total', len(data), account=account_name)
+                if (max_part_bytes is not None) and (part.size > max_part_bytes): 
+                    data = _BodyStructure.truncate(data)
+                raws[uuid] = _BodyStructure.message(subject, part, data)
+            del response
+        return {uuid: raws[uuid] for uuid in uuids if uuid in raws}
+
+    @classmethod
+    def _part_size(cls, part:Union['_BodyStructure.TextPart', None], max_part_bytes:Union[int, None]) -> int: 
+        if part is None: 
+            return 0
+        return part.size if max_part_bytes is None else min(part.size, max_part_bytes)
+
+    @classmethod
+    def _bounded_batches(cls, uuids:List[int], sizes:Dict[int, int], max_messages:int, max_bytes:int) -> Iterator[List[int]]:
+        """ Split uuids into batches of at most max_messages, and at most max_bytes by sizes (unless a single message is larger).
+        """
+        batch = []
+        batch_bytes = 0
+        for uuid in uuids: 
+            size = int(sizes.get(uuid, 0))
+            if (batch != []) and ((len(batch) >= max_messages) or (batch_bytes + size > max_bytes)): 
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(uuid)
+            batch_bytes += size
+        if batch != []: 
+            yield batch
+
+    @classmethod
+    def _batches(cls, uuids:List[int], size:int) -> Iterator[List[int]]:
+        for i in range(0, len(uuids), size):
+            yield uuids[i:i + size]
+
+    @classmethod
+    def _response_part(cls, data:Dict[bytes, bytes], prefix:bytes) -> bytes:
+        """ Returns the first FETCH response item whose key starts with prefix (servers differ in how they echo section specs).
+        """
+        for key, value in data.items():
+            if key.upper().startswith(prefix): 
+                return value
+        return b''
+
+    @classmethod
+    def take_checkpoint(cls, feed_name:str) -> Union[Dict[str, Union[str, int, List[int], None]], None]:
+        """ Returns (and forgets) the sync checkpoint of the last successful new_mail() call for feed_name, for the caller to 
+        store with the feed (see feed.Feed.flush()), or None if there is none.
+
+        Called by tasker once the fetched mail has been added to the feed, so a failed feed generation is retried next cycle.
+        """
+        return SyncState.pending.pop(feed_name, None)
+
+    @classmethod
+    def close_connections(cls) -> None:
+        """ Log out of all pooled IMAP connections, for use on shutdown.
+        """
+        _IMAPPool.close_all()
+
+class SyncState():
+    """ An uninstanced class to manage per-(account, folder) IMAP sync checkpoints in the sync_state table of the state store.
+
+    A checkpoint stores the folder UIDVALIDITY, the highest UID seen and HIGHESTMODSEQ (if the server supports CONDSTORE), 
+    so that each cycle only has to ask the server for `UID <last_uid + 1>:*`. Checkpoints are additionally keyed by a consumer 
+    (the feed name), as feeds sharing a folder are fetched together but may fail (and be retried) independently.
+    """
+    pending = {}
+
+    @classmethod
+    def load(cls, account_name:str, folder:str, consumer:str) -> Union[Dict[str, int], None]:
+        row = store.get().connection().execute('SELECT uidvalidity, last_uid, highestmodseq FROM sync_state WHERE account = ? AND folder = ? AND consumer = ?', 
+            (account_name, folder, consumer)).fetchone()
+        if row is None: 
+            return None
+        return {'uidvalidity': row[0], 'last_uid': row[1], 'highestmodseq': row[2]}
+
+    @classmethod
+    def plan(cls, server:'imapclient.IMAPClient', select_info:Dict[bytes, object], account_name:str, folder:str, consumers:List[str], since:int, 
+            criteria:Union[List[Union[str, list]], None]=None) -> Tuple[Dict[str, Set[int]], Dict[str, Dict[str, Union[str, int]]]]:
+        """ Returns the UIDs to fetch for each consumer of the selected folder, and the checkpoint of each to commit once they are processed.
+
+        Consumers sharing the folder are planned together: one `UID <oldest last_uid + 1>:*` SEARCH covers all consumers with a 
+        valid checkpoint, and a full resync (`SINCE` since days ago) is only done for consumers with no checkpoint or when 
+        UIDVALIDITY has changed. criteria (see filters.FilterPlan.search_criteria) are added to the SEARCH so the server only 
+        returns candidate UIDs.
+        """
+        criteria = list(criteria or [])
+        uidvalidity = int(select_info[b'UIDVALIDITY'])
+        uidnext = select_info.get(b'UIDNEXT')
+        highestmodseq = select_info.get(b'HIGHESTMODSEQ')
+
+        last_uids = {}  # consumer: last_uid, for consumers with a valid checkpoint
+        incremental = []  # consumers with a valid checkpoint that may have new mail
+        invalidated = set()  # consumers whose checkpoint (and seen uids) are from another UIDVALIDITY
+        for consumer in consumers: 
+            state = cls.load(account_name, folder, consumer)
+            if (state is not None) and (state['uidvalidity'] == uidvalidity):
+                last_uids[consumer] = state['last_uid']
+                if (highestmodseq is not None) and (state.get('highestmodseq') == int(highestmodseq)):
+                    logging.debug('HIGHESTMODSEQ unchanged for {}/{} ({}), nothing to fetch'.format(account_name, folder, consumer))
+                elif (uidnext is not None) and (int(uidnext) <= state['last_uid'] + 1):
+                    logging.debug('UIDNEXT unchanged for {}/{} ({}), nothing to fetch'.format(account_name, folder, consumer))
+                else: 
+                    incremental.append(consumer)
+            elif state is not None: 
+                logging.warning('UIDVALIDITY changed for {}/{} ({}), doing a full resync'.format(account_name, folder, consumer))
+                invalidated.add(consumer)
+
+        uuids = {consumer: set() for consumer in consumers}
+        if incremental != []: 
+            oldest = min(last_uids[consumer] for consumer in incremental)
+            # `n:*` always matches at least the highest UID in the folder, even if it is below n
+            with Metrics.time('refeed_imap_command_seconds', account=account_name, command='search'): 
+                found = [int(uid) for uid in server.search([u'UID', u'{}:*'.format(oldest + 1)] + criteria)]
+            for consumer in incremental: 
+                uuids[consumer] = {uid for uid in found if uid > last_uids[consumer]}
+        resync = [consumer for consumer in consumers if consumer not in last_uids]
+        if resync != []: 
+            try: 
+                with Metrics.time('refeed_imap_command_seconds', account=account_name, command='search'): 
+                    found = {int(uid) for uid in server.search([u'SINCE', (datetime.utcnow().date() - timedelta(days=since))] + criteria, 'UTF-8')}
+            except IMAPExceptions.InvalidCriteriaError as e: 
+                logging.critical('Malformed imap search criteria, refeed will never be able to fetch new mail. Something is very wrong, open a github issue', exc_info=True)
+                raise GenericHandledException() from e
+            for consumer in resync: 
+                uuids[consumer] = found
+
+        checkpoints = {}
+        for consumer in consumers: 
+            last_uid = last_uids.get(consumer, 0)
+            # every UID below UIDNEXT existed when the folder was selected, so the search has covered it whether it matched or not
+            if uidnext is not None: 
+                last_uid = max(last_uid, int(uidnext) - 1)
+            checkpoints[consumer] = {
+                'account': account_name,
+                'folder': folder,
+                'consumer': consumer,
+                'uidvalidity': uidvalidity,
+                'last_uid': max(max(uuids[consumer], default=last_uid), last_uid),
+                'highestmodseq': int(highestmodseq) if highestmodseq is not None else None,
+                # the only uids of the seen_uids of the consumer still naming the same messages, see commit()
+                'resync_uids': sorted(uuids[consumer]) if consumer in invalidated else None
+            }
+        return uuids, checkpoints
+
+    @classmethod
+    def write(cls, conn:'sqlite3.Connection', checkpoint:Dict[str, Union[str, int, List[int], None]]) -> None: 
+        """ Store a checkpoint as returned by plan(). Must be called inside a transaction, after the consumer's seen uids are stored.
+        """
+        consumer = checkpoint['consumer']
+        if checkpoint.get('resync_uids') is not None: 
+            # after a UIDVALIDITY change, uids seen before the resync name other messages (or none), so only keep those 
+            # the resync itself found
+            keep = set(checkpoint['resync_uids'])
+            stale = [row[0] for row in conn.execute('SELECT uid FROM seen_uids WHERE feed = ?', (consumer,)) if row[0] not in keep]
+            conn.executemany('DELETE FROM seen_uids WHERE feed = ? AND uid = ?', ((consumer, uid) for uid in stale))
+            logging.info('Forgot {} uids seen by {} before UIDVALIDITY changed'.format(len(stale), consumer))
+        conn.execute('INSERT OR REPLACE INTO sync_state (account, folder, consumer, uidvalidity, last_uid, highestmodseq) VALUES (:account, :folder, :consumer, :uidvalidity, :last_uid, :highestmodseq)', 
+            checkpoint)
+        logging.info('Sync checkpoint for {}: {}'.format(consumer, {key: value for key, value in checkpoint.items() if key != 'resync_uids'}))
+
+class _BodyStructure():
+    """ An uninstanced class to choose the part of a message to fetch from its BODYSTRUCTURE (RFC 3501 7.4.2), and to rebuild 
+    a message that mailparser can read from that part alone.
+
+    The part chosen is the first inline text/html part, or failing that the first inline text/plain part, outside of any 
+    attached message/rfc822. Feeds only use the subject and body of a message, so attachments and inline images are never fetched.
+    """
+
+    class TextPart(NamedTuple): 
+        section: str  # part specifier for BODY[<section>], e.g. '1' or '2.1'
+        content_type: str
+        params: Tuple[Tuple[str, str], ...]
+        encoding: str
+        size: int  # encoded size in bytes
+
+    preference = ('text/html', 'text/plain')
+
+    @classmethod
+    def text_part(cls, bodystructure:Union[tuple, None]) -> Union[TextPart, None]:
+        """ Returns the part to fetch, or None if the message has no text part. Raises ValueError if bodystructure is unusable.
+        """
+        if not bodystructure: 
+            raise ValueError('No BODYSTRUCTURE')
+        try: 
+            found = {}
+            for section, body in cls._leaves(bodystructure, ''): 
+                content_type = '{}/{}'.format(cls._str(body[0]), cls._str(body[1])).lower()
+                if (content_type in cls.preference) and (content_type not in found) and (not cls._is_attachment(body)): 
+                    params = body[2] or ()
+                    found[content_type] = cls.TextPart(section, content_type, tuple((cls._str(params[i]), cls._str(params[i + 1])) for i in range(0, len(params) - 1, 2)), 
+                        cls._str(body[5] or '7bit'), int(body[6] or 0))
+        except (IndexError, TypeError, ValueError, AttributeError) as e: 
+            raise ValueError('Malformed BODYSTRUCTURE {!r}'.format(bodystructure)) from e
+        for content_type in cls.preference: 
+            if content_type in found: 
+                return found[content_type]
+        return None
+
+    @classmethod
+    def _leaves(cls, body:tuple, section:str) -> Iterator[Tuple[str, tuple]]:
+        if isinstance(body[0], (list, tuple)): # multipart, numbered from 1 below section
+            for i, child in enumerate(body[0], start=1): 
+                yield from cls._leaves(child, '{}.{}'.format(section, i) if section != '' else str(i))
+        else: # a single part message is its own part 1
+            yield (section if section != '' else '1'), body
+
+    @classmethod
+    def _is_attachment(cls, body:tuple) -> bool: 
+        # text parts have the number of lines after the basic fields, then MD5, then the disposition
+        disposition = body[9] if len(body) > 9 else None
+        return isinstance(disposition, (list, tuple)) and (len(disposition) > 0) and (cls._str(disposition[0]).lower() == 'attachment')
+
+    @classmethod
+    def _str(cls, value:Union[bytes, str]) -> str: 
+        return value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+
+    @classmethod
+    def message(cls, subject:bytes, part:Union[TextPart, None], data:bytes) -> bytes:
+        """ Returns a single part RFC822 message made of the subject header (as fetched with BODY[HEADER.FIELDS (SUBJECT)]), 
+        the part's content headers and the part's encoded content.
+        """
+        lines = [subject.rstrip(b'\r\n')] if subject.strip() != b'' else []
+        lines.append(b'MIME-Version: 1.0')
+        if part is not None: 
+            params = ''.join('; {}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in part.params)
+            lines.append('Content-Type: {}{}'.format(part.content_type, params).encode('utf-8'))
+            lines.append('Content-Transfer-Encoding: {}'.format(part.encoding).encode('utf-8'))
+        return b'\r\n'.join(lines) + b'\r\n\r\n' + data
+
+    @classmethod
+    def truncate(cls, data:bytes) -> bytes: 
+        """ Cut a partially fetched part back to its last whole line, so base64 or quoted-printable content still decodes.
+        """
+        end = data.rfind(b'\n')
+        return data[:end + 1] if end != -1 else data
+
+class MailIdle(threading.Thread):
+    """ A thread holding an IMAP IDLE session open on one (account, folder), calling on_new_mail(feed_names) when mail arrives.
+
+    IDLE is renewed every renew_after seconds, as servers may drop IDLE sessions after 30 minutes (RFC 2177). 
+    If the server does not support IDLE, the thread calls on_fallback(feed_names) and exits, so the feeds can go back to polling.
+    While the session is down (from the first failed connect, until it is back), the thread calls on_fallback(feed_names) too 
+    so the feeds are polled meanwhile, and on_resume(feed_names) once IDLE is re-established. Neither is called once stop() 
+    has returned.
+
+    :param account_name: a account name present in config.ParseAccount
+    :param folder: the folder on the account to watch
+    :param feed_names: feeds which fetch from account_name/folder
+    """
+    renew_after = 25 * 60
+    check_timeout = 30
+    # seconds to wait before reconnecting after a dropped connection, doubled per consecutive failure
+    retry_after = 10
+    max_retry_after = 15 * 60
+
+    def __init__(self, account_name:str, folder:str, feed_names:List[str], on_new_mail:Callable[[List[str]], None], on_fallback:Callable[[List[str]], None], 
+            on_resume:Callable[[List[str]], None]) -> None: 
+        super().__init__(name='idle-{}-{}'.format(account_name, folder), daemon=True)
+        self.account_name = account_name
+        self.folder = folder
+        self.feed_names = feed_names
+        self.on_new_mail = on_new_mail
+        self.on_fallback = on_fallback
+        self.on_resume = on_resume
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._watching = True  # whether the feeds are left to this thread, as they are when it starts
+
+    def stop(self) -> None: 
+        with self._lock: 
+            self.stopped.set()
+
+    def run(self) -> None: 
+        retry_after = self.retry_after
+        while not self.stopped.is_set(): 
+            try: 
+                server_options = config.ParseAccount.server_options(self.account_name)
+                auth_type = config.ParseAccount.auth_type(self.account_name)
+                credentials = config.ParseAccount.credentials(self.account_name)
+                with _IMAPConn(self.account_name, server_options, auth_type, credentials, pooled=False) as server: 
+                    if not server.has_capability('IDLE'): 
+                        logging.warning('IMAP server for account {} does not support IDLE, falling back to polling for feeds {}'.format(self.account_name, self.feed_names))
+                        self._set_watching(False)
+                        return
+                    server.select_folder(self.folder, readonly=True)
+                    if self._set_watching(True): 
+                        logging.info('IDLE session for {}/{} re-established, feeds {} are no longer polled'.format(self.account_name, self.folder, self.feed_names))
+                    # catch up on anything that arrived while we were not watching
+                    self.on_new_mail(self.feed_names)
+                    retry_after = self.retry_after
+                    self._idle_loop(server)
+            except config.UserConfigError: 
+                logging.exception('Bad config for account {}, falling back to polling for feeds {}'.format(self.account_name, self.feed_names))
+                self._set_watching(False)
+                return
+            except Exception: 
+                logging.exception('IDLE session for {}/{} dropped, polling feeds {} and reconnecting in {} seconds'.format(self.account_name, self.folder, 
+                    self.feed_names, retry_after))
+                self._set_watching(False)
+                self.stopped.wait(retry_after)
+                retry_after = min(retry_after * 2, self.max_retry_after)
+
+    def _set_watching(self, watching:bool) -> bool: 
+        """ Hand the feeds to polling (watching False) or back to this thread, calling on_fallback or on_resume. Returns 
+        whether they changed hands.
+        """
+        with self._lock: 
+            if self.stopped.is_set() or (self._watching == watching): 
+                return False
+            self._watching = watching
+            (self.on_resume if watching else self.on_fallback)(self.feed_names)
+            return True
+
+    def _idle_loop(self, server:'imapclient.IMAPClient') -> None: 
+        while not self.stopped.is_set(): 
+            server.idle()
+            started = time.monotonic()
+            new_mail = False
+            try: 
+                while (not self.stopped.is_set()) and (not new_mail) and (time.monotonic() - started < self.renew_after): 
+                    for response in server.idle_check(timeout=self.check_timeout): 
+                        if (len(response) > 1) and (response[1] == b'EXISTS'): 
+                            new_mail = True
+            finally: 
+                server.idle_done()
+
+            if new_mail: 
+                logging.info('IDLE: new mail in {}/{}, updating feeds {}'.format(self.account_name, self.folder, self.feed_names))
+                self.on_new_mail(self.feed_names)
 
 class _IMAPConn():
 
     """ Class for MailFetch which defines connection + auth to IMAP server.
-    Separated from MailFetch in order to implement as a context manager, so we don't leave the server connection open for the life of MailFetch()
+    Separated from MailFetch in order to implement as a context manager. Connections are checked out from and returned to _IMAPPool,
+    so they are reused across feeds and cycles instead of doing TLS + login every time. Use pooled=False for a private connection. 
     """
 
-    def __init__(self, account_name:str, server_options:Dict[str, Union[str, bool, int]], auth_type:str, credentials:Tuple[str, str]) -> None:  
+    def __init__(self, account_name:str, server_options:Dict[str, Union[str, bool, int]], auth_type:str, credentials:Tuple[str, str], pooled:bool=True) -> None:  
         self.server_options = server_options
         self.account_name = account_name
+        self.pooled = pooled
+
+        if self.pooled: 
+            self.pool_key = _IMAPPool.key(account_name, server_options, auth_type, credentials)
+            self.server = _IMAPPool.checkout(account_name, server_options, auth_type, credentials)
+        else: 
+            self.server = _IMAPPool.connect(server_options, auth_type, credentials)
+
+    def __enter__(self) -> 'imapclient.IMAPClient':
+        return self.server
+
+    def __exit__(self, exc_type, exc_value, exc_traceback) -> None:
+        # a connection that raised may be in any state (errors are often re-raised wrapped, e.g. as GenericHandledException), 
+        # don't hand it to the next user. GeneratorExit only means a streaming caller stopped early, between commands.
+        healthy = (exc_type is None) or issubclass(exc_type, GeneratorExit)
+        if self.pooled: 
+            _IMAPPool.checkin(self.pool_key, self.server_options, self.server, healthy)
+        else: 
+            _IMAPPool.disconnect(self.server)
+
+
+class _IMAPPool():
 
-        #connect
-        self.server = IMAPClient(use_uid=True, timeout=None, **server_options)  
-        
-        # login
+    """ An uninstanced class holding logged in IMAPClient connections, for the life of the process. Connections are keyed by 
+    account name and the server options and credentials they were opened with (see key()), so once a config reload changes 
+    an account, its idle connections are closed rather than reused.
+
+    Idle connections are health checked with NOOP before reuse and reconnected on failure. At most max_per_server
+    connections (idle or in use, across all accounts) are kept open to a single host.
+    """
+    max_per_server = 4
+    # the IMAPClient class to connect with, imapclient.IMAPClient unless replaced (e.g. by bench/fakeimap.py)
+    client = None
+    # seconds a connection may sit idle before it is health checked with NOOP on checkout, or dropped altogether
+    noop_after = 30
+    max_idle = 600
+
+    _lock = threading.Condition()
+    _idle = defaultdict(list)  # key(): [(IMAPClient, last used monotonic time)]
+    _open = defaultdict(int)  # host: number of open connections
+
+    @classmethod
+    def connect(cls, server_options:Dict[str, Union[str, bool, int]], auth_type:str, credentials:Tuple[str, str]) -> 'imapclient.IMAPClient': 
+        Metrics.inc('refeed_imap_connects_total', host=server_options['host'])
+        server = (cls.client or imapclient.IMAPClient)(use_uid=True, timeout=None, **server_options)  
         try: 
-            getattr(self.server, auth_type)(*credentials)
+            with Metrics.time('refeed_imap_command_seconds', host=server_options['host'], command='login'): 
+                getattr(server, auth_type)(*credentials)
         except (NameError, TypeError) as e: 
-            logging.exception('No (or wrong type of) credentials were passed to mail._IMAPConn for imap server {} from config.conf, are you sure this is correct? '.format(self.server_options['host']), exc_info=True)
+            logging.exception('No (or wrong type of) credentials were passed to mail._IMAPConn for imap server {} from config.conf, are you sure this is correct? '.format(server_options['host']), exc_info=True)
+            cls.disconnect(server)
             raise IMAPExceptions.LoginError() from e
+        except Exception: 
+            cls.disconnect(server)
+            raise
+        return server
 
-    def __enter__(self) -> IMAPClient:
-        return self.server
+    @classmethod
+    def disconnect(cls, server:'imapclient.IMAPClient') -> None: 
+        try: 
+            server.logout()
+        except Exception: 
+            try: 
+                server.shutdown()  #try this if above fails for some reason
+            except Exception: 
+                pass
+
+    @classmethod
+    def key(cls, account_name:str, server_options:Dict[str, Union[str, bool, int]], auth_type:str, credentials:Tuple[str, str]) -> Tuple: 
+        """ Returns the pool key of a connection to account_name opened with server_options, auth_type and credentials.
+        """
+        return (account_name, tuple(sorted(server_options.items())), auth_type, tuple(credentials))
+
+    @classmethod
+    def checkout(cls, account_name:str, server_options:Dict[str, Union[str, bool, int]], auth_type:str, credentials:Tuple[str, str]) -> 'imapclient.IMAPClient':
+        """ Returns an idle connection with the same key(), or a new one. Check it back in with checkin() under that key.
+        """
+        host = server_options['host']
+        key = cls.key(account_name, server_options, auth_type, credentials)
+        stale = []
+        with cls._lock: 
+            while True: 
+                # collected over every pass, the lock is released while waiting
+                stale.extend(cls._drop_stale(key))
+                if cls._idle[key]: 
+                    server, last_used = cls._idle[key].pop()
+                    break
+                elif cls._open[host] < cls.max_per_server: 
+                    server, last_used = None, None
+                    cls._open[host] += 1
+                    break
+                elif cls._evict_other(host, key): 
+                    continue
+                else: 
+                    cls._lock.wait()
+
+        for old in stale: 
+            cls.disconnect(old)
+
+        if server is not None: 
+            if time.monotonic() - last_used < cls.noop_after: 
+                return server
+            try: 
+                server.noop()
+                return server
+            except Exception: 
+                logging.info('Pooled IMAP connection for account {} failed health check, reconnecting'.format(account_name), exc_info=True)
+                cls.disconnect(server)
 
-    def __exit__(self, exc_type, exc_value, exc_traceback) -> None:
         try: 
-            self.server.logout()
-        except IMAPExceptions.IMAPClientError: 
-            self.server.shutdown()  #try this if above fails for some reason
+            return cls.connect(server_options, auth_type, credentials)
+        except Exception: 
+            cls._release(host)
+            raise
+
+    @classmethod
+    def checkin(cls, key:Tuple, server_options:Dict[str, Union[str, bool, int]], server:'imapclient.IMAPClient', healthy:bool=True) -> None: 
+        if healthy: 
+            with cls._lock: 
+                cls._idle[key].append((server, time.monotonic()))
+                cls._lock.notify()
+        else: 
+            cls.disconnect(server)
+            cls._release(server_options['host'])
+
+    @classmethod
+    def close_all(cls) -> None: 
+        with cls._lock: 
+            idle = [server for servers in cls._idle.values() for (server, _) in servers]
+            cls._idle.clear()
+            # connections checked out now stay counted until they are checked in
+            for server in idle: 
+                cls._open[server.host] -= 1
+            cls._lock.notify_all()
+        for server in idle: 
+            cls.disconnect(server)
+
+    @classmethod
+    def _release(cls, host:str) -> None: 
+        with cls._lock: 
+            cls._open[host] -= 1
+            cls._lock.notify()
+
+    @classmethod
+    def _drop_stale(cls, key:Tuple) -> List['imapclient.IMAPClient']: 
+        """ Must be called holding _lock. Removes the connections of key idle longer than max_idle, and the idle connections of 
+        its account opened with other settings, from the pool and returns them.
+        """
+        now = time.monotonic()
+        stale = [server for (server, last_used) in cls._idle[key] if now - last_used > cls.max_idle]
+        if stale != []: 
+            cls._idle[key] = [(server, last_used) for (server, last_used) in cls._idle[key] if now - last_used <= cls.max_idle]
+        for other in [other for other in cls._idle if (other[0] == key[0]) and (other != key)]: 
+            stale.extend(server for (server, _) in cls._idle.pop(other))
+        for server in stale: 
+            cls._open[server.host] -= 1
+        return stale
+
+    @classmethod
+    def _evict_other(cls, host:str, key:Tuple) -> bool: 
+        """ Must be called holding _lock. Closes an idle connection under another key on host to make room, if there is one.
+        """
+        for other, servers in cls._idle.items(): 
+            if (other != key) and servers and (servers[0][0].host == host): 
+                server, _ = servers.pop(0)
+                cls._open[host] -= 1
+                cls.disconnect(server)
+                return True
+        return False
 
 
 class ConfigError(Exception):
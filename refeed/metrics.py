@@ -0,0 +1,182 @@
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+# STDLIB
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterator, Tuple, Union
+import threading
+import logging
+import time
+
+# INTERNAL
+""" If we use the form `import x`, we can modify x.var.
+ However, with the form `from . import x`(relative or absolute), we cannot.
+ The second form, where the namespace is modified, is equivalent to setting
+ the value of the import attrs to a module-specific global"""
+from publish import Publisher
+
+# name: (type, help). Only metrics defined here can be recorded, so a typo fails loudly instead of exporting a new series.
+METRICS = {
+    'refeed_cycle_seconds': ('histogram', 'Duration of a polling cycle over all polled feeds'),
+    'refeed_feed_seconds': ('histogram', 'Duration of fetching new mail for and regenerating a feed'),
+    'refeed_feed_generations_total': ('counter', 'Feed generations, by result'),
+    'refeed_feed_last_success_timestamp_seconds': ('gauge', 'Unix time of the last successful generation of a feed'),
+    'refeed_feed_interval_seconds': ('gauge', 'Delay until the next poll of a feed, after adaptive backoff and jitter'),
+    'refeed_shard_workers': ('gauge', 'Live workers sharing the feeds, as seen by this worker'),
+    'refeed_shard_feeds': ('gauge', 'Feeds this worker holds a lease on'),
+    'refeed_imap_connects_total': ('counter', 'New IMAP connections, by server host'),
+    'refeed_imap_command_seconds': ('histogram', 'IMAP command round trip time, by account (or server host, for logins) and command'),
+    'refeed_imap_fetched_bytes_total': ('counter', 'Bytes of message data fetched, by account'),
+    'refeed_messages_parsed_total': ('counter', 'Messages downloaded and parsed, by account (once per message, however many feeds get it)'),
+    'refeed_messages_filtered_total': ('counter', 'Messages rejected by the filters of a feed'),
+    'refeed_entries_added_total': ('counter', 'Entries added to a feed'),
+    'refeed_feed_write_seconds': ('histogram', 'Time to render and publish the documents and alternate pages of a feed'),
+    'refeed_http_requests_total': ('counter', 'Requests to the built-in feed HTTP server, by status code'),
+    'refeed_http_cache_bytes': ('gauge', 'Bytes of documents held in memory by the built-in feed HTTP server'),
+    'refeed_store_transaction_seconds': ('histogram', 'State store write transaction time, including waiting for the write lock'),
+    'refeed_errors_total': ('counter', 'Errors that ended a feed generation, by feed and stage')
+}
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+class Metrics():
+    """ An uninstanced, thread safe registry of counters, gauges and histograms, exposed in the Prometheus text format.
+
+    Series are identified by a metric name from METRICS and keyword labels, e.g. Metrics.inc('refeed_entries_added_total', feed='news').
+    The exposition is written to a text file (for the node exporter textfile collector) by write_textfile(), and/or served
+    over HTTP by serve().
+    """
+    _lock = threading.Lock()
+    _values = {}  # (name, labels): float, for counters and gauges
+    _histograms = {}  # (name, labels): [bucket counts..., sum, count]
+    _server = None
+
+    @classmethod
+    def _key(cls, name:str, labels:Dict[str, object]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+        if name not in METRICS:
+            raise KeyError('Unknown metric {}'.format(name))
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    @classmethod
+    def inc(cls, name:str, value:float=1, **labels:object) -> None:
+        key = cls._key(name, labels)
+        with cls._lock:
+            cls._values[key] = cls._values.get(key, 0) + value
+
+    @classmethod
+    def set(cls, name:str, value:float, **labels:object) -> None:
+        key = cls._key(name, labels)
+        with cls._lock:
+            cls._values[key] = value
+
+    @classmethod
+    def observe(cls, name:str, value:float, **labels:object) -> None:
+        key = cls._key(name, labels)
+        with cls._lock:
+            histogram = cls._histograms.get(key)
+            if histogram is None:
+                histogram = cls._histograms[key] = [0] * (len(BUCKETS) + 2)
+            i = bisect_left(BUCKETS, value)
+            if i < len(BUCKETS): # else only counted in the +Inf bucket
+                histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @classmethod
+    @contextmanager
+    def time(cls, name:str, **labels:object) -> Iterator[None]:
+        """ Observe the duration of the block, whether it raises or not.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.observe(name, time.perf_counter() - started, **labels)
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls._lock:
+            cls._values = {}
+            cls._histograms = {}
+
+    @classmethod
+    def exposition(cls) -> str:
+        """ Returns all series in the Prometheus text exposition format (version 0.0.4).
+        """
+        with cls._lock:
+            values = dict(cls._values)
+            histograms = {key: list(histogram) for key, histogram in cls._histograms.items()}
+
+        lines = []
+        for name, (type_, help_) in METRICS.items():
+            series = sorted((labels, value) for (name_, labels), value in (histograms if type_ == 'histogram' else values).items() if name_ == name)
+            if series == []:
+                continue
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} {}'.format(name, type_))
+            for labels, value in series:
+                if type_ != 'histogram':
+                    lines.append('{}{} {}'.format(name, cls._labels(labels), cls._number(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS, value):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, cls._labels(labels + (('le', cls._number(bound)),)), cumulative))
+                lines.append('{}_bucket{} {}'.format(name, cls._labels(labels + (('le', '+Inf'),)), value[-1]))
+                lines.append('{}_sum{} {}'.format(name, cls._labels(labels), cls._number(value[-2])))
+                lines.append('{}_count{} {}'.format(name, cls._labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def _labels(cls, labels:Tuple[Tuple[str, str], ...]) -> str:
+        if labels == ():
+            return ''
+        escaped = ('{}="{}"'.format(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, value in labels)
+        return '{{{}}}'.format(','.join(escaped))
+
+    @classmethod
+    def _number(cls, value:float) -> str:
+        return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+    @classmethod
+    def write_textfile(cls, path:Union[str, Path]) -> None:
+        """ Atomically write the exposition to path, which should end in .prom for the node exporter textfile collector.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        Publisher.write_atomic(path, cls.exposition().encode('utf-8'))
+
+    @classmethod
+    def serve(cls, port:int, host:str='127.0.0.1') -> None:
+        """ Serve the exposition on http://host:port/metrics from a daemon thread. Does nothing if already serving.
+        """
+        if cls._server is not None:
+            return
+        cls._server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        cls._server.daemon_threads = True
+        threading.Thread(target=cls._server.serve_forever, name='metrics-http', daemon=True).start()
+        logging.info('Serving metrics on http://{}:{}/metrics'.format(host, port))
+
+    @classmethod
+    def stop(cls) -> None:
+        if cls._server is not None:
+            cls._server.shutdown()
+            cls._server.server_close()
+            cls._server = None
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = Metrics.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format:str, *args:object) -> None:
+        logging.debug('metrics-http: {}'.format(format % args))
@@ -0,0 +1,117 @@
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+# STDLIB
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+from typing import Dict, Iterable, List, Tuple, Union
+import logging
+import multiprocessing
+import threading
+
+# 3RD PARTY
+# mailparser is imported by parse_message() on first use, so refeed starts without paying for it
+
+# INTERNAL
+""" If we use the form `import x`, we can modify x.var.
+ However, with the form `from . import x`(relative or absolute), we cannot.
+ The second form, where the namespace is modified, is equivalent to setting
+ the value of the import attrs to a module-specific global"""
+import config, filters
+
+# mailparser properties every feed needs, see feed.Feed.add_entry
+FEED_PROPERTIES = ('subject', 'body')
+
+class ParsedMail():
+    """ The few fields of a parsed message that refeed uses, small and cheap to pickle back from a worker process.
+
+    Fields are read as attributes like a mailparser.MailParser (mail.subject, mail.body). Fields that could not be
+    extracted raise AttributeError, as they would on the MailParser. The string values of the properties filters match
+    on are kept apart in filter_values, see filters.FilterPlan.values_from_message().
+    """
+    __slots__ = ('fields', 'filter_values')
+
+    def __init__(self, fields:Dict[str, str], filter_values:Union[Dict[str, str], None]=None) -> None:
+        self.fields = fields
+        self.filter_values = filter_values or {}
+
+    def __getattr__(self, name:str) -> str:
+        if name in self.__slots__:
+            raise AttributeError(name)
+        try:
+            return self.fields[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __reduce__(self) -> Tuple[type, Tuple[Dict[str, str], Dict[str, str]]]:
+        return (ParsedMail, (self.fields, self.filter_values))
+
+def parse_message(raw:bytes, properties:Tuple[str, ...]=()) -> ParsedMail:
+    """ Parse a RFC822 message and extract FEED_PROPERTIES, and the filter values of properties. Module level, so it can 
+    run in a worker process.
+    """
+    import mailparser
+    mail = mailparser.parse_from_bytes(raw)
+    fields = {}
+    for property_ in FEED_PROPERTIES:
+        try:
+            fields[property_] = getattr(mail, property_)
+        except Exception: # e.g. MailParserReceivedParsingError, left for the caller to handle as a missing field
+            continue
+    return ParsedMail(fields, filters.FilterPlan.values_from_message(raw, mail, properties))
+
+class MailParse():
+    """ An uninstanced class to parse fetched messages, in a process pool for large batches.
+
+    MIME parsing is pure Python and CPU bound, so with several feeds (or a first sync) a single core would otherwise be the
+    bottleneck. Batches smaller than [app][parse_serial_below] messages are parsed in the calling thread, as are all
+    batches if [app][parse_workers] is 0. The pool is started on first use, and restarted if parse_workers changes.
+
+    Worker processes are started by a fork server (or spawned where there is none) rather than forked from refeed, as
+    forking a process with running threads (IMAP watchers, HTTP server, pool connections) can copy locks that are held.
+    """
+    _lock = threading.Lock()
+    _executor = None
+    _workers = 0
+
+    @classmethod
+    def parse_batch(cls, raws:List[bytes], properties:Iterable[str]=()) -> List[ParsedMail]:
+        """ Returns a ParsedMail per message of raws, in order.
+        """
+        properties = tuple(properties)
+        executor = cls._pool() if len(raws) >= config.ParseApp.parse_serial_below() else None
+        if executor is not None:
+            try:
+                chunksize = max(1, len(raws) // (max(1, config.ParseApp.parse_workers()) * 4))
+                return list(executor.map(parse_message, raws, repeat(properties), chunksize=chunksize))
+            except BrokenProcessPool:
+                logging.error('Mail parsing process pool broke, parsing batch serially', exc_info=True)
+                cls.shutdown()
+            except RuntimeError: # the pool was shut down (or restarted with a new size) by another thread
+                logging.info('Mail parsing process pool was shut down, parsing batch serially')
+        return [parse_message(raw, properties) for raw in raws]
+
+    @classmethod
+    def _pool(cls) -> 'ProcessPoolExecutor':
+        workers = config.ParseApp.parse_workers()
+        with cls._lock:
+            if (cls._executor is not None) and (cls._workers != workers):
+                cls._executor.shutdown(wait=False)
+                cls._executor = None
+            if (cls._executor is None) and (workers > 0):
+                cls._executor = ProcessPoolExecutor(max_workers=workers, mp_context=cls._context())
+                cls._workers = workers
+                logging.info('Started mail parsing process pool with {} workers'.format(workers))
+            return cls._executor
+
+    @classmethod
+    def _context(cls) -> 'multiprocessing.context.BaseContext':
+        return multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+    @classmethod
+    def shutdown(cls) -> None:
+        with cls._lock:
+            if cls._executor is not None:
+                cls._executor.shutdown(wait=False)
+            cls._executor = None
+            cls._workers = 0
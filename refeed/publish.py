@@ -0,0 +1,116 @@
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+# STDLIB
+from pathlib import Path
+from email.utils import formatdate
+from typing import Dict, Union
+import hashlib
+import gzip
+import json
+import os
+import tempfile
+import logging
+
+# 3RD PARTY (optional)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class Publisher():
+    """ An uninstanced class to publish files into config.paths["static"] so that the web server never sees a half written file.
+
+    Files are written to a temporary file in the same directory and renamed over the live path. Published documents also get
+    precompressed <name>.gz (and <name>.br, if the brotli package is installed) siblings, and a <name>.meta.json sidecar with a
+    strong ETag and Last-Modified, for web servers to answer conditional requests and serve precompressed bytes with no work.
+    Nothing is written at all if the content hash matches the sidecar.
+
+    Callables in watchers are called as watcher(path, content, meta) for every file written or removed (e.g. 
+    serve.FeedServer.update): content is the bytes now at path (None if it was removed), and meta the sidecar of a published
+    document (None for other files).
+    """
+    watchers = []
+
+    @classmethod
+    def publish(cls, path:Path, content:bytes, content_type:str) -> bool:
+        """ Returns True if path was (re)written, False if its content was unchanged.
+        """
+        path = Path(path)
+        etag = '"{}"'.format(hashlib.sha256(content).hexdigest()[:32])
+        meta = cls.meta(path)
+        if (meta is not None) and (meta.get('etag') == etag) and path.exists():
+            logging.debug('{} unchanged, not republishing'.format(path))
+            return False
+
+        cls.write_atomic(path.with_name(path.name + '.gz'), gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            cls.write_atomic(path.with_name(path.name + '.br'), brotli.compress(content, quality=11))
+        cls.write_atomic(path, content, notify=False)
+        meta = {
+            'etag': etag,
+            'last_modified': formatdate(usegmt=True),
+            'content_type': content_type,
+            'length': len(content)
+        }
+        cls.write_atomic(cls._meta_path(path), json.dumps(meta).encode('utf-8'))
+        cls._notify(path, content, meta)
+        logging.info('Published {} ({})'.format(path, etag))
+        return True
+
+    @classmethod
+    def meta(cls, path:Path) -> Union[Dict[str, Union[str, int]], None]:
+        try:
+            with cls._meta_path(path).open() as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @classmethod
+    def write_atomic(cls, path:Path, content:bytes, notify:bool=True) -> None:
+        path = Path(path)
+        fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix='.{}.'.format(path.name), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o644) # mkstemp creates 0600, the web server needs to read this
+            os.replace(tmp_path, str(path))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        if notify: 
+            cls._notify(path, content)
+
+    @classmethod
+    def unlink(cls, path:Path) -> None:
+        """ Remove a single file, raises FileNotFoundError if it does not exist.
+        """
+        path = Path(path)
+        try:
+            path.unlink()
+        finally:
+            cls._notify(path)
+
+    @classmethod
+    def remove(cls, path:Path) -> None:
+        """ Remove a published file along with its precompressed siblings and sidecar.
+        """
+        path = Path(path)
+        for file in (path, path.with_name(path.name + '.gz'), path.with_name(path.name + '.br'), cls._meta_path(path)):
+            try:
+                cls.unlink(file)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def _notify(cls, path:Path, content:Union[bytes, None]=None, meta:Union[Dict[str, Union[str, int]], None]=None) -> None:
+        for watcher in cls.watchers:
+            watcher(path, content, meta)
+
+    @classmethod
+    def _meta_path(cls, path:Path) -> Path:
+        return path.with_name(path.name + '.meta.json')
@@ -0,0 +1,153 @@
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+# STDLIB
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from xml.sax.saxutils import escape, quoteattr
+from typing import Dict, List, Union
+import json
+import re
+
+# Output formats, and the suffix of their file in static/feed
+FORMATS = {
+    'atom': '.xml',
+    'rss': '.rss',
+    'json': '.json'
+}
+
+CONTENT_TYPES = {
+    'atom': 'application/atom+xml',
+    'rss': 'application/rss+xml',
+    'json': 'application/feed+json'
+}
+
+# characters XML 1.0 does not allow, even escaped: C0 controls other than tab, newline and carriage return, lone surrogates 
+# and the U+FFFE/U+FFFF noncharacters
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+def _escape(value:str) -> str:
+    return escape(_XML_INVALID.sub('', value))
+
+def _quoteattr(value:str) -> str:
+    return quoteattr(_XML_INVALID.sub('', value))
+
+# lone surrogates cannot be encoded as UTF-8, in JSON documents either
+_SURROGATES = re.compile('[\ud800-\udfff]')
+
+def _json_dumps(value:Dict[str, object]) -> str:
+    return _SURROGATES.sub('', json.dumps(value, ensure_ascii=False))
+
+class FeedRender():
+    """ An uninstanced class to render feeds as Atom, RSS 2.0 and JSON Feed 1.1 documents.
+
+    Entries are rendered once to a fragment per format (see fragments()), which are cached alongside the entry.
+    A document is then a freshly rendered header with the cached fragments of its entries spliced in.
+
+    Entries are any object with the attributes of feed.Entry. Headers are dicts with the keys:
+        id, title, subtitle, author, language, logo (may be None), updated (unix time), links (format: self href)
+    """
+    @classmethod
+    def fragments(cls, entry:'Entry') -> Dict[str, str]:
+        return {fmt: getattr(cls, '_{}_entry'.format(fmt))(entry) for fmt in FORMATS}
+
+    @classmethod
+    def document(cls, fmt:str, header:Dict[str, Union[str, float, None]], fragments:List[str]) -> str:
+        return getattr(cls, '_{}_document'.format(fmt))(header, fragments)
+
+    @classmethod
+    def _iso(cls, timestamp:float) -> str:
+        return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+    @classmethod
+    def _atom_entry(cls, entry:'Entry') -> str:
+        parts = [
+            '<entry>',
+            '<id>{}</id>'.format(_escape(entry.entry_id)),
+            '<title>{}</title>'.format(_escape(entry.title)),
+            '<updated>{}</updated>'.format(cls._iso(entry.updated))
+        ]
+        if entry.link is not None:
+            parts.append('<link rel="alternate" type="text/html" href={}/>'.format(_quoteattr(entry.link)))
+        parts.append('<content type={}>{}</content>'.format(_quoteattr(entry.content_type), _escape(entry.content)))
+        parts.append('</entry>')
+        return ''.join(parts)
+
+    @classmethod
+    def _rss_entry(cls, entry:'Entry') -> str:
+        parts = [
+            '<item>',
+            '<guid isPermaLink="false">{}</guid>'.format(_escape(entry.entry_id)),
+            '<title>{}</title>'.format(_escape(entry.title)),
+            '<pubDate>{}</pubDate>'.format(format_datetime(datetime.fromtimestamp(entry.updated, timezone.utc)))
+        ]
+        if entry.link is not None:
+            parts.append('<link>{}</link>'.format(_escape(entry.link)))
+        parts.append('<description>{}</description>'.format(_escape(entry.content)))
+        parts.append('</item>')
+        return ''.join(parts)
+
+    @classmethod
+    def _json_entry(cls, entry:'Entry') -> str:
+        item = {
+            'id': entry.entry_id,
+            'title': entry.title,
+            'date_modified': cls._iso(entry.updated)
+        }
+        if entry.link is not None:
+            item['url'] = entry.link
+        item['content_html' if entry.content_type == 'html' else 'content_text'] = entry.content
+        return _json_dumps(item)
+
+    @classmethod
+    def _atom_document(cls, header:Dict[str, Union[str, float, None]], fragments:List[str]) -> str:
+        parts = [
+            "<?xml version='1.0' encoding='UTF-8'?>\n",
+            '<feed xmlns="http://www.w3.org/2005/Atom" xml:lang={}>'.format(_quoteattr(header['language'])),
+            '<id>{}</id>'.format(_escape(header['id'])),
+            '<title>{}</title>'.format(_escape(header['title'])),
+            '<subtitle>{}</subtitle>'.format(_escape(header['subtitle'])),
+            '<updated>{}</updated>'.format(cls._iso(header['updated'])),
+            '<author><name>{}</name></author>'.format(_escape(header['author'])),
+            '<link rel="self" type="application/atom+xml" href={}/>'.format(_quoteattr(header['links']['atom'])),
+            '<generator>refeed</generator>'
+        ]
+        if header['logo'] is not None:
+            parts.append('<logo>{}</logo>'.format(_escape(header['logo'])))
+        parts.extend(fragments)
+        parts.append('</feed>\n')
+        return ''.join(parts)
+
+    @classmethod
+    def _rss_document(cls, header:Dict[str, Union[str, float, None]], fragments:List[str]) -> str:
+        parts = [
+            "<?xml version='1.0' encoding='UTF-8'?>\n",
+            '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom"><channel>',
+            '<title>{}</title>'.format(_escape(header['title'])),
+            '<link>{}</link>'.format(_escape(header['links']['rss'])),
+            '<description>{}</description>'.format(_escape(header['subtitle'])),
+            '<language>{}</language>'.format(_escape(header['language'])),
+            '<lastBuildDate>{}</lastBuildDate>'.format(format_datetime(datetime.fromtimestamp(header['updated'], timezone.utc))),
+            '<atom:link rel="self" type="application/rss+xml" href={}/>'.format(_quoteattr(header['links']['rss'])),
+            '<generator>refeed</generator>'
+        ]
+        if header['logo'] is not None:
+            parts.append('<image><url>{url}</url><title>{title}</title><link>{link}</link></image>'.format(
+                url=_escape(header['logo']), title=_escape(header['title']), link=_escape(header['links']['rss'])))
+        parts.extend(fragments)
+        parts.append('</channel></rss>\n')
+        return ''.join(parts)
+
+    @classmethod
+    def _json_document(cls, header:Dict[str, Union[str, float, None]], fragments:List[str]) -> str:
+        feed = {
+            'version': 'https://jsonfeed.org/version/1.1',
+            'title': header['title'],
+            'feed_url': header['links']['json'],
+            'description': header['subtitle'],
+            'language': header['language'],
+            'authors': [{'name': header['author']}]
+        }
+        if header['logo'] is not None:
+            feed['icon'] = header['logo']
+        # splice the cached items into the closing brace of the header object
+        return '{}, "items": [{}]}}\n'.format(_json_dumps(feed)[:-1], ', '.join(fragments))
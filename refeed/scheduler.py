@@ -0,0 +1,113 @@
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+# STDLIB
+from typing import Callable, Iterable, List, Tuple, Union
+import heapq
+import logging
+import random
+import time
+
+# INTERNAL
+""" If we use the form `import x`, we can modify x.var.
+ However, with the form `from . import x`(relative or absolute), we cannot.
+ The second form, where the namespace is modified, is equivalent to setting
+ the value of the import attrs to a module-specific global"""
+import config
+from metrics import Metrics
+
+class FeedScheduler():
+    """ Instanceable scheduler tracking when each feed is next due to be polled, in a heap ordered by due time.
+
+    Each feed is polled every [feeds][feed_name][interval] minutes. Polls that add no entries, or fail, stretch the feed's
+    interval by [app][schedule][backoff] each time, up to [app][schedule][max_backoff] times the configured interval, and
+    a poll that adds entries brings it straight back. Every delay is jittered by up to [app][schedule][jitter] of itself.
+
+    Feeds sharing an account and folder are fetched together (see tasker._Tasks.generate_folder()), so when a feed is due,
+    the others in its folder are polled along with it if they would be due within coalesce of their own interval anyway.
+
+    :param clock: a monotonic clock in seconds
+    """
+    coalesce = 0.25
+
+    def __init__(self, clock:Callable[[], float]=time.monotonic) -> None:
+        self.clock = clock
+        self._heap = []  # (due, feed_name), possibly stale: only the entry matching _due[feed_name] counts
+        self._due = {}  # feed_name: due time
+        self._idle = {}  # feed_name: consecutive polls that added no entries or failed
+        self._running = set()  # feeds popped by pop_due() and not yet done()
+
+    def __contains__(self, feed_name:str) -> bool:
+        return (feed_name in self._due) or (feed_name in self._running)
+
+    def sync(self, feed_names:Iterable[str]) -> None:
+        """ Schedule exactly feed_names: new feeds become due within the jitter of their interval, removed feeds are dropped.
+        """
+        feed_names = set(feed_names)
+        for feed_name in [feed_name for feed_name in self._due if feed_name not in feed_names]:
+            del self._due[feed_name]
+            self._idle.pop(feed_name, None)
+        self._running &= feed_names
+        now = self.clock()
+        for feed_name in sorted(feed_names - set(self._due) - self._running):
+            jitter = config.ParseApp.schedule()['jitter']
+            self._push(feed_name, now + random.uniform(0, jitter) * self.interval(feed_name))
+            self._idle[feed_name] = 0
+
+    def next_due(self) -> Union[float, None]:
+        """ Returns the clock time at which the next feed is due, or None if no feeds are scheduled.
+        """
+        while (self._heap != []) and (self._due.get(self._heap[0][1]) != self._heap[0][0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap != [] else None
+
+    def pop_due(self) -> List[str]:
+        """ Returns the feeds due now (and the folder mates joining them, see coalesce), removing them from the schedule until done() is called.
+        """
+        now = self.clock()
+        due = []
+        while (self.next_due() is not None) and (self._heap[0][0] <= now):
+            _, feed_name = heapq.heappop(self._heap)
+            del self._due[feed_name]
+            due.append(feed_name)
+        if due == []:
+            return due
+
+        folders = {self._folder(feed_name) for feed_name in due}
+        for feed_name, feed_due in list(self._due.items()):
+            if (self._folder(feed_name) in folders) and (feed_due - now <= self.coalesce * self.interval(feed_name) * self._stretch(feed_name)):
+                del self._due[feed_name]
+                due.append(feed_name)
+        self._running.update(due)
+        return due
+
+    def done(self, feed_name:str, ok:bool, added:int) -> float:
+        """ Reschedule a feed popped by pop_due() after its poll, returns the delay until it is next due in seconds.
+        """
+        self._running.discard(feed_name)
+        if ok and (added > 0):
+            self._idle[feed_name] = 0
+        else:
+            self._idle[feed_name] = min(self._idle.get(feed_name, 0) + 1, 64) # past max_backoff anyway, and backoff ** idle stays finite
+        delay = self.interval(feed_name) * self._stretch(feed_name)
+        jitter = config.ParseApp.schedule()['jitter']
+        delay *= 1 + random.uniform(-jitter, jitter)
+        self._push(feed_name, self.clock() + delay)
+        Metrics.set('refeed_feed_interval_seconds', delay, feed=feed_name)
+        logging.debug('Feed {} next due in {:.0f} seconds'.format(feed_name, delay))
+        return delay
+
+    def interval(self, feed_name:str) -> float:
+        """ Returns the configured interval of a feed in seconds.
+        """
+        return config.ParseFeed.interval(feed_name) * 60.0
+
+    def _stretch(self, feed_name:str) -> float:
+        schedule = config.ParseApp.schedule()
+        return min(schedule['backoff'] ** self._idle.get(feed_name, 0), schedule['max_backoff'])
+
+    def _folder(self, feed_name:str) -> Tuple[str, str]:
+        return config.ParseFeed.account_name(feed_name), config.ParseFeed.folder(feed_name)
+
+    def _push(self, feed_name:str, due:float) -> None:
+        self._due[feed_name] = due
+        heapq.heappush(self._heap, (due, feed_name))
@@ -0,0 +1,413 @@
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+# STDLIB
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Tuple, Union
+from urllib.parse import unquote
+import asyncio
+import gzip
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+# INTERNAL
+""" If we use the form `import x`, we can modify x.var.
+ However, with the form `from . import x`(relative or absolute), we cannot.
+ The second form, where the namespace is modified, is equivalent to setting
+ the value of the import attrs to a module-specific global"""
+import config, feed
+from metrics import Metrics
+from publish import Publisher
+from render import FORMATS, CONTENT_TYPES
+
+_FEED_PATH = re.compile(r'^/feeds/([^/]+)$')
+_ALT_PATH = re.compile(r'^/alt-html/(?:([0-9a-f]{2})/([0-9a-f]{2})/)?([0-9a-f]{30})\.html$')
+_FORMATS_BY_SUFFIX = {suffix: fmt for fmt, suffix in FORMATS.items()}
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+class Document(NamedTuple):
+    """ A published file as held in memory by FeedServer, never modified: a changed file is replaced by a new Document.
+    """
+    body: bytes
+    gzipped: Union[bytes, None]  # None if gzip would not make it smaller
+    etag: str
+    last_modified: str
+    modified: float  # last_modified as a timestamp, for If-Modified-Since
+    content_type: str
+    cache_control: str
+    stat: Tuple[int, int, int]  # (inode, size, mtime_ns) of the file it was read from
+    checked: float  # time.monotonic() when stat was last compared to the file
+
+class FeedServer():
+    """ An uninstanced, embedded asyncio HTTP/1.1 server for the published feeds and alternate pages.
+
+    Serves GET and HEAD of /feeds/<feed name><.xml|.rss|.json> (for feeds and formats in config.yaml) and
+    /alt-html/<xx>/<yy>/<alt id>.html (or /alt-html/<alt id>.html), from an in-memory cache of Documents of at most
+    [app][http][cache_bytes], least recently used first out. Publisher hands the server the content of the files this
+    process writes, and the cached documents are swapped for new ones (see update()), so published feeds are never read
+    back. Other files are read from config.paths["static"] on a cache miss, and files changed by other processes are noticed
+    by comparing a stat of the file every [app][http][revalidate] seconds. Files are only read and stat'ed in the default
+    executor of the event loop, never on the loop itself.
+
+    ETags are strong, the content hash Publisher writes into the sidecar (with a -gzip suffix for the gzip encoding, as it
+    is a different representation), so conditional requests are answered with 304 from memory. Feeds are sent with
+    Cache-Control no-cache so readers revalidate, alternate pages (content addressed, so never changed) as immutable.
+    """
+    keepalive_timeout = 15
+    max_header_bytes = 16384
+    _loop = None
+    _server = None
+    _thread = None
+    _documents = OrderedDict()  # path: Document, only modified on the event loop thread
+    _bytes = 0
+    _updates = 0  # documents swapped by update(), so a slower read of a file does not replace a newer document
+    _date = (0, '')  # (second, Date header value) of the last response
+
+    @classmethod
+    def serve(cls, port:int, host:str='127.0.0.1') -> None:
+        """ Serve on http://host:port/ from an event loop in a daemon thread. Does nothing if already serving.
+
+        Raises OSError if the address cannot be bound.
+        """
+        if cls._server is not None:
+            return
+        loop = asyncio.new_event_loop()
+        try:
+            server = loop.run_until_complete(asyncio.start_server(cls._handle, host, port, limit=cls.max_header_bytes, reuse_address=True))
+        except BaseException:
+            loop.close()
+            raise
+        cls._loop, cls._server = loop, server
+        Publisher.watchers.append(cls.update)
+        cls._thread = threading.Thread(target=loop.run_forever, name='feed-http', daemon=True)
+        cls._thread.start()
+        logging.info('Serving feeds on http://{}:{}/feeds/'.format(host, port))
+
+    @classmethod
+    def stop(cls) -> None:
+        if cls._server is None:
+            return
+        if cls.update in Publisher.watchers:
+            Publisher.watchers.remove(cls.update)
+        loop, server = cls._loop, cls._server
+        cls._loop = cls._server = None
+
+        async def close() -> None:
+            server.close()
+            # idle keep-alive connections would otherwise hold the server open
+            handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in handlers:
+                task.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await server.wait_closed()
+        try:
+            asyncio.run_coroutine_threadsafe(close(), loop).result(timeout=5)
+        except Exception:
+            logging.exception('Failed to close feed HTTP server cleanly')
+        loop.call_soon_threadsafe(loop.stop)
+        cls._thread.join(timeout=5)
+        loop.close()
+        cls._thread = None
+        cls.clear()
+
+    @classmethod
+    def clear(cls) -> None:
+        cls._documents = OrderedDict()
+        cls._bytes = 0
+
+    @classmethod
+    def update(cls, path:Path, content:Union[bytes, None]=None, meta:Union[Dict[str, Union[str, int]], None]=None) -> None:
+        """ Swap the cached document of path for content, as written by Publisher (see Publisher.watchers). Documents are
+        built in the calling thread and are cached if path is a published feed (meta is given) or was cached already, 
+        else the cached document (if any) is dropped. Safe to call from any thread.
+        """
+        path = Path(path)
+        document = None
+        # only a hint off the event loop, _swap() checks again
+        if (content is not None) and ((meta is not None) or (str(path) in cls._documents)):
+            try:
+                document = cls._build(path, content, os.stat(str(path)), meta)
+            except (OSError, KeyError): # removed again since, or a file that is not served
+                document = None
+        loop = cls._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(cls._swap, str(path), document, meta is not None)
+        else:
+            cls._swap(str(path), document, meta is not None)
+
+    @classmethod
+    def _swap(cls, key:str, document:Union[Document, None], published:bool) -> None:
+        cls._updates += 1
+        if (document is not None) and (published or (key in cls._documents)):
+            cls._store(key, document)
+        else:
+            cls._drop(key)
+
+    @classmethod
+    async def _handle(cls, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), cls.keepalive_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    writer.write(cls._response('HTTP/1.1', 400, [('Connection', 'close')], b''))
+                    return
+
+                request = cls._parse(head)
+                if request is None:
+                    writer.write(cls._response('HTTP/1.1', 400, [('Connection', 'close')], b''))
+                    return
+                method, target, version, headers = request
+                status, response_headers, body = await cls._respond(method, target, headers)
+                # requests with a body are not expected, and the connection cannot be reused without reading it
+                keep_alive = (version == 'HTTP/1.1') and (headers.get('connection', '').lower() != 'close') and \
+                    (headers.get('content-length', '0') == '0') and ('transfer-encoding' not in headers)
+                if not keep_alive:
+                    response_headers.append(('Connection', 'close'))
+                writer.write(cls._response(version, status, response_headers, body, send_body=(method != 'HEAD')))
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.CancelledError): # cancelled by stop()
+            return
+        except Exception:
+            logging.exception('Unhandled error in feed HTTP server')
+        finally:
+            writer.close()
+
+    @classmethod
+    def _parse(cls, head:bytes) -> Union[Tuple[str, str, str, Dict[str, str]], None]:
+        """ Returns (method, target, version, {lower case header name: value}) of a request head, or None if malformed.
+        """
+        try:
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            return None
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if line == '':
+                continue
+            name, sep, value = line.partition(':')
+            if sep == '':
+                return None
+            name = name.strip().lower()
+            # repeated fields are equivalent to one comma separated field (RFC 7230 3.2.2)
+            headers[name] = '{}, {}'.format(headers[name], value.strip()) if name in headers else value.strip()
+        return method, target, version, headers
+
+    @classmethod
+    def respond(cls, method:str, target:str, headers:Dict[str, str]) -> Tuple[int, List[Tuple[str, str]], bytes]:
+        """ Returns (status, headers, body) for a request, headers as given by _parse(). Files are read in the calling thread, 
+        see _respond() for the event loop.
+        """
+        if method not in ('GET', 'HEAD'):
+            return cls._reply(method, None, headers)
+        path = cls._path(target.split('?', 1)[0])
+        document = None
+        if path is not None:
+            document = cls._cached(str(path))
+            if document is None:
+                document = cls._read(path, cls._documents.get(str(path)))
+                cls._keep(str(path), document)
+        return cls._reply(method, document, headers)
+
+    @classmethod
+    async def _respond(cls, method:str, target:str, headers:Dict[str, str]) -> Tuple[int, List[Tuple[str, str]], bytes]:
+        """ respond() on the event loop, with files read in its default executor so other connections are not held up.
+        """
+        if method not in ('GET', 'HEAD'):
+            return cls._reply(method, None, headers)
+        path = cls._path(target.split('?', 1)[0])
+        document = None
+        if path is not None:
+            document = cls._cached(str(path))
+            if document is None:
+                updates = cls._updates
+                document = await asyncio.get_running_loop().run_in_executor(None, cls._read, path, cls._documents.get(str(path)))
+                if cls._updates == updates:
+                    cls._keep(str(path), document)
+        return cls._reply(method, document, headers)
+
+    @classmethod
+    def _reply(cls, method:str, document:Union[Document, None], headers:Dict[str, str]) -> Tuple[int, List[Tuple[str, str]], bytes]:
+        if method not in ('GET', 'HEAD'):
+            Metrics.inc('refeed_http_requests_total', status=405)
+            return 405, [('Allow', 'GET, HEAD')], b''
+        if document is None:
+            Metrics.inc('refeed_http_requests_total', status=404)
+            return 404, [('Content-Type', 'text/plain; charset=utf-8')], b'Not Found\n'
+
+        gzipped = (document.gzipped is not None) and cls._accepts_gzip(headers.get('accept-encoding', ''))
+        etag = document.etag[:-1] + '-gzip"' if gzipped else document.etag
+        response_headers = [('ETag', etag), ('Last-Modified', document.last_modified), ('Cache-Control', document.cache_control),
+            ('Vary', 'Accept-Encoding')]
+        if cls._not_modified(document, headers):
+            Metrics.inc('refeed_http_requests_total', status=304)
+            return 304, response_headers, b''
+
+        response_headers.append(('Content-Type', document.content_type))
+        if gzipped:
+            response_headers.append(('Content-Encoding', 'gzip'))
+        Metrics.inc('refeed_http_requests_total', status=200)
+        return 200, response_headers, document.gzipped if gzipped else document.body
+
+    @classmethod
+    def _path(cls, url_path:str) -> Union[Path, None]:
+        """ Returns the file in config.paths["static"] that url_path is served from, or None if url_path is not served.
+        """
+        match = _ALT_PATH.match(url_path)
+        if match is not None:
+            prefix_1, prefix_2, alt_id = match.groups()
+            if (prefix_1 is not None) and (prefix_1 + prefix_2 != alt_id[:4]):
+                return None
+            return feed.FeedTools.alt_path(alt_id)
+
+        match = _FEED_PATH.match(url_path)
+        if match is None:
+            return None
+        name = unquote(match.group(1))
+        if ('/' in name) or ('\\' in name) or ('\0' in name):
+            return None
+        suffix = os.path.splitext(name)[1]
+        feed_config = config.snapshot().feeds.get(name[:-len(suffix)]) if suffix in _FORMATS_BY_SUFFIX else None
+        if (feed_config is None) or (_FORMATS_BY_SUFFIX[suffix] not in feed_config.formats):
+            return None
+        return Path(config.paths["static"]).joinpath('feed', name)
+
+    @classmethod
+    def _cached(cls, key:str) -> Union[Document, None]:
+        """ Returns the cached Document of key if it was compared to its file recently enough, else None.
+        """
+        document = cls._documents.get(key)
+        if (document is not None) and (time.monotonic() - document.checked < config.ParseApp.http()['revalidate']):
+            cls._documents.move_to_end(key)
+            return document
+        return None
+
+    @classmethod
+    def _keep(cls, key:str, document:Union[Document, None]) -> None:
+        if document is None:
+            cls._drop(key)
+        else:
+            cls._store(key, document)
+
+    @classmethod
+    def _read(cls, path:Path, document:Union[Document, None]) -> Union[Document, None]:
+        """ Returns document if path is unchanged since it was read, else a new Document of path, or None if it cannot be read. 
+        Does not touch the cache, so it can run in any thread.
+        """
+        try:
+            stat = os.stat(str(path))
+            if (document is not None) and (document.stat == (stat.st_ino, stat.st_size, stat.st_mtime_ns)):
+                return document._replace(checked=time.monotonic())
+            with path.open('rb') as f:
+                stat = os.fstat(f.fileno())
+                body = f.read()
+        except OSError:
+            return None
+        meta = Publisher.meta(path)
+        if (meta is not None) and (meta.get('etag') != cls._etag(body)): # the sidecar is being rewritten
+            meta = None
+        return cls._build(path, body, stat, meta)
+
+    @classmethod
+    def _build(cls, path:Path, body:bytes, stat:os.stat_result, meta:Union[Dict[str, Union[str, int]], None]) -> Document:
+        """ Returns the Document of body, the content of path with stat, and its Publisher sidecar meta if any. Raises 
+        KeyError if path is not a file served.
+        """
+        if path.suffix == '.html':
+            content_type, cache_control = 'text/html; charset=utf-8', 'public, max-age=31536000, immutable'
+        else:
+            content_type, cache_control = '{}; charset=utf-8'.format(CONTENT_TYPES[_FORMATS_BY_SUFFIX[path.suffix]]), 'no-cache'
+        if meta is not None:
+            etag, last_modified = meta['etag'], meta['last_modified']
+        else: # an alternate page, or the sidecar is being rewritten
+            etag, last_modified = cls._etag(body), formatdate(stat.st_mtime, usegmt=True)
+        gzipped = gzip.compress(body, compresslevel=6, mtime=0)
+        return Document(body, gzipped if len(gzipped) < len(body) else None, etag, last_modified,
+            parsedate_to_datetime(last_modified).timestamp(), content_type, cache_control, (stat.st_ino, stat.st_size, stat.st_mtime_ns), 
+            time.monotonic())
+
+    @classmethod
+    def _etag(cls, body:bytes) -> str:
+        # the same hash as Publisher, so ETags match the sidecar and survive restarts
+        return '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+
+    @classmethod
+    def _store(cls, key:str, document:Document) -> None:
+        cls._drop(key)
+        size = len(document.body) + len(document.gzipped or b'')
+        if size > config.ParseApp.http()['cache_bytes']:
+            return
+        cls._documents[key] = document
+        cls._bytes += size
+        while cls._bytes > config.ParseApp.http()['cache_bytes']:
+            cls._drop(next(iter(cls._documents)))
+        Metrics.set('refeed_http_cache_bytes', cls._bytes)
+
+    @classmethod
+    def _drop(cls, key:str) -> None:
+        document = cls._documents.pop(key, None)
+        if document is not None:
+            cls._bytes -= len(document.body) + len(document.gzipped or b'')
+            Metrics.set('refeed_http_cache_bytes', cls._bytes)
+
+    @classmethod
+    def _not_modified(cls, document:Document, headers:Dict[str, str]) -> bool:
+        """ Whether a conditional GET is answered with 304 (RFC 7232 6: If-Modified-Since is ignored if If-None-Match is sent).
+        """
+        if_none_match = headers.get('if-none-match')
+        if if_none_match is not None:
+            tags = {tag.strip() for tag in if_none_match.split(',')}
+            if '*' in tags:
+                return True
+            # weak comparison, with the ETag of either encoding
+            tags = {tag[2:] if tag.startswith('W/') else tag for tag in tags}
+            return (document.etag in tags) or (document.etag[:-1] + '-gzip"' in tags)
+
+        if_modified_since = headers.get('if-modified-since')
+        if if_modified_since is None:
+            return False
+        try:
+            return document.modified <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    @classmethod
+    def _accepts_gzip(cls, accept_encoding:str) -> bool:
+        qualities = {}
+        for coding in accept_encoding.lower().split(','):
+            name, _, params = coding.partition(';')
+            quality = 1.0
+            for param in params.split(';'):
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            qualities[name.strip()] = quality
+        return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+    @classmethod
+    def _response(cls, version:str, status:int, headers:List[Tuple[str, str]], body:bytes, send_body:bool=True) -> bytes:
+        # a 304 has no body, a HEAD response the Content-Length of the body a GET would get
+        second = int(time.time())
+        if cls._date[0] != second:
+            cls._date = (second, formatdate(second, usegmt=True))
+        lines = ['{} {} {}'.format(version, status, REASONS[status]), 'Date: {}'.format(cls._date[1]), 'Server: refeed']
+        lines.extend('{}: {}'.format(name, value) for name, value in headers)
+        if status != 304:
+            lines.append('Content-Length: {}'.format(len(body)))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body if send_body else b'')
@@ -0,0 +1,193 @@
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+# STDLIB
+from bisect import bisect
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Union
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+
+# INTERNAL
+""" If we use the form `import x`, we can modify x.var.
+ However, with the form `from . import x`(relative or absolute), we cannot.
+ The second form, where the namespace is modified, is equivalent to setting
+ the value of the import attrs to a module-specific global"""
+import config, store
+from metrics import Metrics
+
+# the lease key of the one worker that reconciles stored feeds with config.yaml, see tasker._Tasks.reconcile_feeds()
+RECONCILE = '\0reconcile'
+
+class LeaseLost(Exception):
+    """ Raised when a worker is about to store state of a feed it no longer holds the lease on.
+    """
+    pass
+
+class HashRing():
+    """ Instanceable consistent hash ring of worker ids, each placed at vnodes points so keys spread evenly.
+
+    Adding or removing a worker only moves the keys of the ring segments it gains or loses, about 1/n of them.
+
+    :param workers: ids of the workers on the ring
+    """
+    vnodes = 64
+
+    def __init__(self, workers:Iterable[str]) -> None:
+        points = sorted((self._hash('{}#{}'.format(worker, i)), worker) for worker in set(workers) for i in range(self.vnodes))
+        self._hashes = [point[0] for point in points]
+        self._workers = [point[1] for point in points]
+
+    def owner(self, key:str) -> Union[str, None]:
+        """ Returns the worker owning key, or None if the ring is empty.
+        """
+        if self._hashes == []:
+            return None
+        return self._workers[bisect(self._hashes, self._hash(key)) % len(self._hashes)]
+
+    @classmethod
+    def _hash(cls, value:str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+class ShardLeases(threading.Thread):
+    """ A thread keeping this worker registered in the state store and holding leases on its share of the feeds.
+
+    Workers must be processes on one host: the state store is SQLite in WAL mode, which does not work over a network filesystem.
+
+    Every lease/3 seconds (see beat()), the worker renews its row in the workers table, forgets workers that stopped renewing
+    theirs, and assigns each feed folder (account and folder, as feeds of a folder are fetched together) to a live worker
+    on a HashRing. It then renews its leases on the feeds of its folders, takes over leases that other workers released or
+    let expire, and releases the leases on feeds that now belong to another worker. Feeds being generated (see generating())
+    are never released mid generation, they are handed over on the next beat after.
+
+    :param worker_id: a unique id for this worker, default from [app][shard][worker_id] or <hostname>-<pid>
+    :param state: the state store shared by the workers, default store.get()
+    :param clock: wall clock in seconds
+    :param on_change: called (from this thread) after this worker gains or loses leases
+    """
+    # seconds between beats while a handover is pending, so rebalancing does not wait a whole lease/3
+    handover_retry = 1
+
+    def __init__(self, worker_id:Union[str, None]=None, state:Union['store.StateStore', None]=None, clock:Callable[[], float]=time.time, 
+            on_change:Union[Callable[[], None], None]=None) -> None:
+        super().__init__(name='shard-leases', daemon=True)
+        self.worker_id = worker_id or config.ParseApp.shard()['worker_id'] or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.state = state
+        self.clock = clock
+        self.on_change = on_change
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._owned = set()
+        self._busy = set()
+        self._valid_until = 0.0
+
+    def owns(self, feed_name:str) -> bool:
+        """ Whether this worker holds the lease on feed_name, renewed recently enough that no other worker can take it yet.
+        """
+        with self._lock:
+            return (feed_name in self._owned) and (self.clock() < self._valid_until)
+
+    def holds(self, conn:'sqlite3.Connection', feed_name:str) -> bool:
+        """ Whether the leases table gives this worker feed_name for now. Use inside the transaction writing the feed's state.
+        """
+        row = conn.execute('SELECT expires FROM leases WHERE feed = ? AND worker = ?', (feed_name, self.worker_id)).fetchone()
+        return (row is not None) and (row[0] > self.clock())
+
+    def leased_elsewhere(self) -> Set[str]:
+        """ Returns the feeds other workers hold unexpired leases on.
+        """
+        rows = (self.state or store.get()).connection().execute('SELECT feed FROM leases WHERE worker != ? AND expires > ?', (self.worker_id, self.clock()))
+        return {row[0] for row in rows} - {RECONCILE}
+
+    @contextmanager
+    def generating(self, feed_names:Iterable[str]) -> Iterator[List[str]]:
+        """ Yields the feeds of feed_names this worker owns, whose leases are then kept until the block exits.
+        """
+        with self._lock:
+            owned = [feed_name for feed_name in feed_names if (feed_name in self._owned) and (self.clock() < self._valid_until)]
+            self._busy.update(owned)
+        try:
+            yield owned
+        finally:
+            with self._lock:
+                self._busy.difference_update(owned)
+
+    def run(self) -> None:
+        wait = 0
+        while not self.stopped.wait(wait):
+            try:
+                pending = self.beat()
+            except Exception:
+                logging.exception('Failed to renew feed leases of worker {}, will retry'.format(self.worker_id))
+                pending = True
+            wait = self.handover_retry if pending else config.ParseApp.shard()['lease'] / 3
+
+    def beat(self) -> bool:
+        """ Renew this worker and its leases, and rebalance. Returns True if some of this worker's feeds are still leased by
+        other workers (or their generation here has to finish first), i.e. a handover is pending.
+        """
+        state = self.state or store.get()
+        lease = config.ParseApp.shard()['lease']
+        folders = self._folders(config.ParseFeed.names())
+        now = self.clock()
+        with state.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO workers (worker, expires) VALUES (?, ?)', (self.worker_id, now + lease))
+            conn.execute('DELETE FROM workers WHERE expires < ?', (now,))
+            workers = [row[0] for row in conn.execute('SELECT worker FROM workers')]
+            ring = HashRing(workers)
+            wanted = {feed_name for key, feed_names in folders.items() if ring.owner(key) == self.worker_id for feed_name in feed_names}
+            if ring.owner(RECONCILE) == self.worker_id: 
+                wanted.add(RECONCILE)
+            with self._lock:
+                busy = set(self._busy)
+
+            held = {row[0] for row in conn.execute('SELECT feed FROM leases WHERE worker = ?', (self.worker_id,))}
+            release = held - wanted - busy
+            conn.executemany('DELETE FROM leases WHERE feed = ? AND worker = ?', ((feed_name, self.worker_id) for feed_name in release))
+            conn.executemany('INSERT INTO leases (feed, worker, expires) VALUES (?, ?, ?) ON CONFLICT (feed) DO UPDATE SET worker = excluded.worker, '
+                'expires = excluded.expires WHERE (leases.worker = excluded.worker) OR (leases.expires < ?)',
+                ((feed_name, self.worker_id, now + lease, now) for feed_name in sorted(wanted | (held & busy))))
+            owned = {row[0] for row in conn.execute('SELECT feed FROM leases WHERE worker = ?', (self.worker_id,))}
+
+        with self._lock:
+            gained, lost = owned - self._owned, self._owned - owned
+            self._owned = owned
+            # stop starting generations well before other workers could take the leases over
+            self._valid_until = now + lease * 2 / 3
+        if gained or lost:
+            logging.info('Worker {} of {} took over feeds {}, handed over {}'.format(self.worker_id, len(workers), sorted(gained), sorted(lost)))
+            if self.on_change is not None:
+                self.on_change()
+        Metrics.set('refeed_shard_workers', len(workers))
+        Metrics.set('refeed_shard_feeds', len(owned - {RECONCILE}))
+        return owned != wanted
+
+    def stop(self) -> None:
+        """ Stop renewing, and release this worker's leases so the other workers take its feeds over on their next beat. Leases 
+        on feeds still being generated are left to expire.
+        """
+        self.stopped.set()
+        with self._lock:
+            self._owned = set()
+            self._valid_until = 0.0
+            busy = set(self._busy)
+        try:
+            with (self.state or store.get()).transaction() as conn:
+                held = [row[0] for row in conn.execute('SELECT feed FROM leases WHERE worker = ?', (self.worker_id,))]
+                conn.executemany('DELETE FROM leases WHERE feed = ? AND worker = ?', ((feed_name, self.worker_id) for feed_name in held if feed_name not in busy))
+                conn.execute('DELETE FROM workers WHERE worker = ?', (self.worker_id,))
+        except Exception:
+            logging.exception('Failed to release feed leases of worker {}, they expire on their own'.format(self.worker_id))
+
+    @classmethod
+    def _folders(cls, feed_names:Iterable[str]) -> Dict[str, Set[str]]:
+        """ Returns feed_names by the ring key of the account and folder they fetch from.
+        """
+        folders = {}
+        for feed_name in feed_names:
+            key = '{}\0{}'.format(config.ParseFeed.account_name(feed_name), config.ParseFeed.folder(feed_name))
+            folders.setdefault(key, set()).add(feed_name)
+        return folders
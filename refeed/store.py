@@ -0,0 +1,302 @@
+# Author: 'Ethan Djeric <me@ethandjeric.com>'
+
+# STDLIB
+import sqlite3
+import shelve
+import pickle
+import json
+import threading
+import logging
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Iterator
+
+# INTERNAL
+""" If we use the form `import x`, we can modify x.var.
+ However, with the form `from . import x`(relative or absolute), we cannot.
+ The second form, where the namespace is modified, is equivalent to setting
+ the value of the import attrs to a module-specific global"""
+import config
+from metrics import Metrics
+
+def _import_feed_generator(conn:sqlite3.Connection, feed_name:str, fg:'FeedGenerator', feeds_table:str='feeds') -> None: 
+    """ Store a FeedGenerator as saved by older versions of refeed as a feeds row plus a row per entry.
+    """
+    updated = fg.updated().timestamp() if fg.updated() is not None else 0
+    conn.execute('INSERT OR REPLACE INTO {} (name, feed_id, updated) VALUES (?, ?, ?)'.format(feeds_table), (feed_name, fg.id(), updated))
+    # feedgen keeps entries newest first, insert oldest first so seq follows insertion order
+    for i, fe in enumerate(reversed(fg.entry())): 
+        link = next((link['href'] for link in fe.link() if link.get('rel') == 'alternate'), None)
+        alt_id = link.rsplit('/', 1)[-1][:-len('.html')] if link is not None else None
+        content = fe.content() or {}
+        try: 
+            uid = int(fe.id().rsplit(':', 1)[-1])
+        except ValueError: 
+            uid = -(i + 1)
+        conn.execute('INSERT OR IGNORE INTO entries (feed, uid, entry_id, title, alt_id, link, content, content_type, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', 
+            (feed_name, uid, fe.id(), fe.title(), alt_id, link, content.get('content', ''), 'html' if link is not None else 'text', 
+                fe.updated().timestamp() if fe.updated() is not None else updated))
+
+def _migrate_feed_entries(conn:sqlite3.Connection) -> None:
+    """ Replace the pickled FeedGenerator per feed with a row per entry. 
+    """
+    conn.execute("""
+        CREATE TABLE entries (
+            seq INTEGER PRIMARY KEY,
+            feed TEXT NOT NULL,
+            uid INTEGER NOT NULL,
+            entry_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            alt_id TEXT,
+            link TEXT,
+            content TEXT NOT NULL,
+            content_type TEXT NOT NULL,
+            updated REAL NOT NULL,
+            UNIQUE (feed, uid)
+        )""")
+    conn.execute('CREATE INDEX entries_feed_updated ON entries (feed, updated)')
+    conn.execute('CREATE TABLE feeds_new (name TEXT PRIMARY KEY, feed_id TEXT NOT NULL, updated REAL NOT NULL)')
+
+    for feed_name, fg_blob in conn.execute('SELECT name, fg FROM feeds').fetchall(): 
+        _import_feed_generator(conn, feed_name, pickle.loads(fg_blob), 'feeds_new')
+
+    conn.execute('DROP TABLE feeds')
+    conn.execute('ALTER TABLE feeds_new RENAME TO feeds')
+
+# Each entry upgrades the schema from version (index) to version (index + 1), see PRAGMA user_version.
+# Entries are either SQL scripts or callables taking the connection.
+_MIGRATIONS = [
+    """
+    CREATE TABLE feeds (
+        name TEXT PRIMARY KEY,
+        fg BLOB NOT NULL
+    );
+    CREATE TABLE seen_uids (
+        feed TEXT NOT NULL,
+        uid INTEGER NOT NULL,
+        PRIMARY KEY (feed, uid)
+    ) WITHOUT ROWID;
+    CREATE TABLE alternates (
+        alt_id TEXT PRIMARY KEY,
+        feed TEXT NOT NULL,
+        seq INTEGER NOT NULL
+    );
+    CREATE INDEX alternates_feed_seq ON alternates (feed, seq);
+    CREATE TABLE sync_state (
+        account TEXT NOT NULL,
+        folder TEXT NOT NULL,
+        consumer TEXT NOT NULL,
+        uidvalidity INTEGER NOT NULL,
+        last_uid INTEGER NOT NULL,
+        highestmodseq INTEGER,
+        PRIMARY KEY (account, folder, consumer)
+    );
+    """,
+    _migrate_feed_entries,
+    """
+    ALTER TABLE entries ADD COLUMN atom TEXT;
+    ALTER TABLE entries ADD COLUMN rss TEXT;
+    ALTER TABLE entries ADD COLUMN json TEXT;
+    """,
+    # alternate pages are content addressed and may be shared between feeds
+    """
+    CREATE TABLE alternates_new (
+        alt_id TEXT NOT NULL,
+        feed TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        PRIMARY KEY (feed, alt_id)
+    );
+    INSERT INTO alternates_new (alt_id, feed, seq) SELECT alt_id, feed, seq FROM alternates;
+    DROP TABLE alternates;
+    ALTER TABLE alternates_new RENAME TO alternates;
+    CREATE INDEX alternates_feed_seq ON alternates (feed, seq);
+    CREATE INDEX alternates_alt_id ON alternates (alt_id);
+    """,
+    # the feeds (and their formats) that stored state was last reconciled with, see feed.FeedTools.reconcile_feeds()
+    """
+    CREATE TABLE manifest (
+        feed TEXT PRIMARY KEY,
+        formats TEXT
+    );
+    INSERT OR IGNORE INTO manifest (feed) SELECT name FROM feeds;
+    INSERT OR IGNORE INTO manifest (feed) SELECT DISTINCT feed FROM entries;
+    INSERT OR IGNORE INTO manifest (feed) SELECT DISTINCT feed FROM alternates;
+    INSERT OR IGNORE INTO manifest (feed) SELECT DISTINCT feed FROM seen_uids;
+    INSERT OR IGNORE INTO manifest (feed) SELECT DISTINCT consumer FROM sync_state;
+    """,
+    # workers sharing the feeds of one config.yaml, and which of them may generate each feed, see shard.ShardLeases
+    """
+    CREATE TABLE workers (
+        worker TEXT PRIMARY KEY,
+        expires REAL NOT NULL
+    );
+    CREATE TABLE leases (
+        feed TEXT PRIMARY KEY,
+        worker TEXT NOT NULL,
+        expires REAL NOT NULL
+    );
+    CREATE INDEX leases_worker ON leases (worker);
+    """,
+    # fragments cached before characters XML does not allow were dropped when rendering, see feed.Feed.entries()
+    """
+    UPDATE entries SET atom = NULL, rss = NULL, json = NULL;
+    """,
+]
+
+class StateStore():
+    """ Instanceable class wrapping the SQLite (WAL mode) database holding all refeed state.
+
+    Connections are per thread, so a StateStore may be shared between the threads of tasker._Tasks.
+
+    :param path: path to the database file, created (and its schema migrated) if needed
+    """
+    def __init__(self, path:Path) -> None:
+        self.path = Path(path)
+        self._local = threading.local()
+        with self.transaction() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for i, script in enumerate(_MIGRATIONS[version:], start=version):
+                logging.info('Migrating state store {} to schema version {}'.format(self.path, i + 1))
+                if callable(script):
+                    script(conn)
+                else:
+                    for statement in script.split(';'):
+                        if statement.strip() != '':
+                            conn.execute(statement)
+                conn.execute('PRAGMA user_version = {}'.format(i + 1))
+
+    def connection(self) -> sqlite3.Connection:
+        try:
+            return self._local.conn
+        except AttributeError:
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+            return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """ Run the block in a single write transaction, committed on exit or rolled back if the block raises.
+        """
+        conn = self.connection()
+        with Metrics.time('refeed_store_transaction_seconds'):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+
+    def migrate_shelves(self, data_path:Path) -> None:
+        """ One-shot import of the shelve files used by older versions of refeed. Imported shelves are renamed to *.migrated.
+        """
+        data_path = Path(data_path)
+        shelves = {
+            'feeds': self._migrate_feeds,
+            'mail_uuids': self._migrate_mail_uuids,
+            'alternate_ids': self._migrate_alternates,
+            'alternates': self._migrate_alternates,
+            'sync_state': self._migrate_sync_state
+        }
+        for name, migrate in shelves.items():
+            # the dbm files of the shelf (name.shelf, or name.shelf.db / .dat / .dir / .bak), not ones already migrated
+            files = [file for file in data_path.glob('{}.shelf*'.format(name)) if not file.name.endswith('.migrated')]
+            if files == []:
+                continue
+            logging.warning('Migrating {}.shelf into state store {}'.format(name, self.path))
+            with shelve.open(str(data_path.joinpath('{}.shelf'.format(name))), flag='r') as shelf, self.transaction() as conn:
+                migrate(conn, shelf)
+            for file in files:
+                file.rename(file.with_name(file.name + '.migrated'))
+
+    def _migrate_feeds(self, conn:sqlite3.Connection, shelf:shelve.Shelf) -> None:
+        for feed_name, fg in shelf.items():
+            _import_feed_generator(conn, feed_name, fg)
+
+    def _migrate_mail_uuids(self, conn:sqlite3.Connection, shelf:shelve.Shelf) -> None:
+        for feed_name, uids in shelf.items():
+            conn.executemany('INSERT OR IGNORE INTO seen_uids (feed, uid) VALUES (?, ?)', ((feed_name, int(uid)) for uid in (uids or [])))
+
+    def _migrate_alternates(self, conn:sqlite3.Connection, shelf:shelve.Shelf) -> None:
+        for feed_name, alt_ids in shelf.items():
+            for alt_id in (alt_ids or []):
+                conn.execute('INSERT OR IGNORE INTO alternates (alt_id, feed, seq) VALUES (?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM alternates WHERE feed = ?))', (alt_id, feed_name, feed_name))
+
+    def _migrate_sync_state(self, conn:sqlite3.Connection, shelf:shelve.Shelf) -> None:
+        for key, checkpoint in shelf.items():
+            # keys are json [account, folder, consumer], see mail.SyncState
+            account_name, folder, consumer = json.loads(key)
+            conn.execute('INSERT OR REPLACE INTO sync_state (account, folder, consumer, uidvalidity, last_uid, highestmodseq) VALUES (?, ?, ?, ?, ?, ?)',
+                (account_name, folder, consumer, checkpoint['uidvalidity'], checkpoint['last_uid'], checkpoint.get('highestmodseq')))
+
+class SeenIndex():
+    """ Instanceable in-memory index of the mail uids already added to a feed, loaded once per feed per cycle.
+
+    Membership checks are O(1) set lookups. Feeds with more than compact_after stored uids keep their history in a
+    sorted array of 64 bit ints instead (O(log n) lookups, 8 bytes per uid), with only newly added uids in the set.
+    New uids are persisted incrementally by flush().
+
+    :param feed_name: the feed whose seen_uids to load
+    :param conn: a connection to the state store
+    """
+    compact_after = 100000
+
+    def __init__(self, feed_name:str, conn:sqlite3.Connection) -> None:
+        self.feed_name = feed_name
+        uids = array('q', (row[0] for row in conn.execute('SELECT uid FROM seen_uids WHERE feed = ? ORDER BY uid', (feed_name,))))
+        if len(uids) > self.compact_after:
+            self._history = uids
+            self._uids = set()
+        else:
+            self._history = None
+            self._uids = set(uids)
+        self._new = []
+
+    def __contains__(self, uid:int) -> bool:
+        if uid in self._uids:
+            return True
+        if self._history is not None:
+            i = bisect_left(self._history, uid)
+            return (i < len(self._history)) and (self._history[i] == uid)
+        return False
+
+    def __len__(self) -> int:
+        return len(self._uids) + (len(self._history) if self._history is not None else 0)
+
+    def add(self, uid:int) -> None:
+        if uid not in self:
+            self._uids.add(uid)
+            self._new.append(uid)
+
+    def reset(self) -> None:
+        """ Forget every uid, after the folder's UIDVALIDITY changed. The stored ones are deleted with the new sync checkpoint, 
+        see mail.SyncState.write().
+        """
+        self._history = None
+        self._uids = set()
+        self._new = []
+
+    def flush(self, conn:sqlite3.Connection) -> None:
+        """ Write uids added since the last flush to the seen_uids table, inside the caller's transaction.
+        """
+        conn.executemany('INSERT OR IGNORE INTO seen_uids (feed, uid) VALUES (?, ?)', ((self.feed_name, uid) for uid in self._new))
+        self._new = []
+
+_store = None
+_store_lock = threading.Lock()
+
+def get() -> StateStore:
+    """ Returns the process-wide StateStore in config.paths["data"], opening it (and importing any old shelves) on first use.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            data_path = Path(config.paths["data"])
+            _store = StateStore(data_path.joinpath('state.sqlite3'))
+            _store.migrate_shelves(data_path)
+        return _store
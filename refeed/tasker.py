@@ -7,103 +7,411 @@ import time
 from pathlib import Path
 import signal
 import sys   
-
-# 3RD PARTY 
-import schedule
+import threading
+from collections import defaultdict, deque
+from typing import List, Dict, Union
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack
 
 # INTERNAL 
 """ If we use the form `import x`, we can modify x.var. 
  However, with the form `from . import x`(relative or absolute), we cannot.
  The second form, where the namespace is modified, is equivalent to setting 
  the value of the import attrs to a module-specific global"""
-import feed, mail, config
+import feed, mail, config, parse
+from scheduler import FeedScheduler
+from shard import ShardLeases, LeaseLost, RECONCILE
+from serve import FeedServer
+from metrics import Metrics
 
 class Run():
     """ The main logic and scheduling for refeed.
         Run from refeed.main().
     """
+    # seconds between checks of config.yaml for changes while waiting for the next feed to be due
+    config_check_interval = 5
+
     def __init__(self) -> None:
-        _startup()
-        _main() 
+        self._startup()
+        self._main() 
 
 
-    def  _startup(self) -> None 
+    def _startup(self) -> None: 
         config.PullConfig()   
         # start root logger (TODO: Add loggers per module) 
-        logging.basicConfig(filename=str(refeed.config.paths["log"]), level=conf.log_level(), filemode='a', format='%(asctime)s %(message)s')
+        logging.basicConfig(filename=str(config.paths["log"]), level=config.ParseApp.log_level(), filemode='a', format='%(asctime)s %(message)s')
 
-        # handle SIGHUP and SIGTERM
-        signal.signal(signal.SIGHUP, self._sig_handle)
+        # SIGHUP reloads config.yaml, SIGTERM exits
+        self.reload_requested = False
+        self.stopped = False
+        self.wake = threading.Event()
+        signal.signal(signal.SIGHUP, self._sighup_handle)
         signal.signal(signal.SIGTERM, self._sig_handle)
 
-        # setup scheduler 
-        self.run = schedule.Scheduler()
-        self.run.every(conf.wait_to_update()).minutes.do(_Tasks.generate_feeds_from_new_mail)
-        self.run.every(1).week.do(_Tasks.cleanup_feeds)
+        # setup scheduler, feeds are added to it by _main()
+        self.scheduler = FeedScheduler()
 
         # Startup jobs 
-        _Tasks.cleanup_feeds() 
         _Tasks.make_run_dirs()
+        feed.FeedTools.migrate_alt_layout()
+        _Tasks.reconcile_feeds() 
+
+        # worker mode: only generate the feeds this worker holds leases on, see shard.ShardLeases
+        if config.ParseApp.shard()['enabled']: 
+            _Tasks.leases = ShardLeases(on_change=self.wake.set)
+            try: 
+                _Tasks.leases.beat()
+            except Exception: 
+                logging.exception('Failed to take feed leases of worker {}, will retry'.format(_Tasks.leases.worker_id))
+            _Tasks.leases.start()
+            logging.info('Running as shard worker {}'.format(_Tasks.leases.worker_id))
+            if config.ParseApp.push(): 
+                logging.warning('[app][push] is ignored while [app][shard] is enabled, feeds are polled')
+
+        # push mode: IDLE watchers update their feeds as mail arrives, polling remains for the others
+        elif config.ParseApp.push():
+            _Tasks.sync_push()
+
+        if config.ParseApp.metrics()['port'] is not None: 
+            try: 
+                Metrics.serve(config.ParseApp.metrics()['port'], config.ParseApp.metrics()['host'])
+            except OSError: 
+                logging.exception('Failed to start metrics HTTP endpoint, metrics are not served')
+
+        if config.ParseApp.http()['port'] is not None: 
+            try: 
+                FeedServer.serve(config.ParseApp.http()['port'], config.ParseApp.http()['host'])
+            except OSError: 
+                logging.exception('Failed to start feed HTTP server, feeds are only published to {}'.format(config.paths["static"]))
 
     def _main(self) -> None: 
-        while self.run.jobs != []: 
-            self.run.run_pending()
-            time.sleep(1)
-            config.PullConfig() # allow user to update config.yaml without restarting the process
-            time.sleep(1)
+        while not self.stopped: 
+            # allow user to update config.yaml without restarting the process; this only stats the file unless it changed
+            try: 
+                config.PullConfig(force=self.reload_requested) 
+            except config.UserConfigError: 
+                logging.exception('Failed to reload config.yaml, keeping current config')
+            # only touches the state store if the reload added or removed feeds
+            _Tasks.reconcile_feeds()
+            if _Tasks.leases is None: 
+                _Tasks.sync_push()
+            self.reload_requested = False
+            self.scheduler.sync(feed_name for feed_name in config.ParseFeed.names() if (feed_name not in _Tasks.pushed_feeds) and _Tasks.owns(feed_name))
+
+            due = self.scheduler.pop_due()
+            if due != []: 
+                self._poll(due)
+                continue
+
+            # sleep until the next feed is due, waking early to check config.yaml or on a signal
+            next_due = self.scheduler.next_due()
+            timeout = self.config_check_interval
+            if next_due is not None: 
+                timeout = min(max(0, next_due - self.scheduler.clock()), timeout)
+            self.wake.wait(timeout)
+            self.wake.clear()
 
-        logging.critical("Job list has somehow become empty without manual clearing; exiting") 
-        sys.exit("Exiting due to empty Job List")
+    def _poll(self, feed_names:List[str]) -> None: 
+        results = {}
+        try: 
+            if _Tasks.leases is None: 
+                results = _Tasks.generate_feeds_from_new_mail(feed_names)
+            else: 
+                # feeds handed over since they were scheduled are dropped by the next sync
+                with _Tasks.leases.generating(feed_names) as owned: 
+                    results = _Tasks.generate_feeds_from_new_mail(owned)
+        finally: 
+            names = config.ParseFeed.names()
+            for feed_name in feed_names: 
+                added = _Tasks.entries_added.pop(feed_name, 0)
+                if feed_name in names: # else removed from config.yaml while it was generated
+                    self.scheduler.done(feed_name, results.get(feed_name) is True, added)
 
 
-    def _sig_handle(self) -> None:
-        logging.critical('Either SIGHUP/SIGTERM sent to refeed; exiting by clearing job list - any job currently in progress will complete. ')
-        self.run.clear()
-        sys.exit("Exiting due to SIGHUP/SIGTERM")
+    def _sighup_handle(self, signum, frame) -> None:
+        logging.warning('SIGHUP sent to refeed; reloading config.yaml')
+        self.reload_requested = True
+        self.wake.set()
+
+    def _sig_handle(self, signum, frame) -> None:
+        logging.critical('SIGTERM sent to refeed; exiting - any feed generation currently in progress will complete. ')
+        self.stopped = True
+        self.wake.set()
+        _Tasks.stop_push()
+        if _Tasks.leases is not None: 
+            _Tasks.leases.stop()
+        mail.MailFetch.close_connections()
+        parse.MailParse.shutdown()
+        Metrics.stop()
+        FeedServer.stop()
+        sys.exit("Exiting due to SIGTERM")
 
 class _Tasks():
+    # feeds currently updated by a mail.MailIdle watcher instead of the polling job
+    pushed_feeds = set()
+    # feed_name: entries added by its last generation, for the scheduler
+    entries_added = {}
+    # a shard.ShardLeases in worker mode
+    leases = None
+    # whether this worker held the shard.RECONCILE lease at the last reconcile_feeds()
+    _reconciler = False
+    watchers = []
+    _locks_lock = threading.Lock()
+    _feed_locks = defaultdict(threading.Lock)
+
     @classmethod
-    def generate_feeds_from_new_mail(cls) -> None:
+    def generate_feeds_from_new_mail(cls, feed_names:Union[List[str], None]=None) -> Dict[str, Union[bool, Exception]]:
+        """ Generate feed_names (default: all polled feeds) concurrently, at most [app][max_workers] folders at once and 
+        [app][max_workers_per_account] per account. 
+
+        Feeds fetching from the same account and folder are generated together, see generate_folder(). Folders are only
+        submitted to the pool once their account has a free slot, taking accounts in turn, so no pool thread sits waiting 
+        on a busy account while folders of other accounts are queued.
+        Returns the result of generate_folder (or the exception it raised) per feed.
+        """
         logging.info('Mail fetch and feed generation job starting')
-        for feed_name in config.ParseFeed.names():
-            logging.info('feed_name_tasks: {}'.format(feed_name))
-            with feed.Feed(feed_name) as f:
+        if feed_names is None: 
+            feed_names = config.ParseFeed.names()
+        feed_names = [feed_name for feed_name in feed_names if feed_name not in cls.pushed_feeds]
+        results = {}
+        started = time.perf_counter()
+        max_workers = config.ParseApp.max_workers()
+        max_per_account = config.ParseApp.max_workers_per_account()
+        queued = {}  # account_name: deque of its folder groups not yet submitted
+        for group in cls.folder_groups(feed_names): 
+            queued.setdefault(config.ParseFeed.account_name(group[0]), deque()).append(group)
+        running = defaultdict(int)  # account_name: its folder groups submitted and not done
+        futures = {}  # future: (account_name, group)
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='feed') as executor: 
+            while (queued != {}) or (futures != {}): 
+                submitted = True
+                while submitted and (len(futures) < max_workers): 
+                    submitted = False
+                    for account_name in list(queued): 
+                        if (len(futures) < max_workers) and (running[account_name] < max_per_account): 
+                            # the account goes last in turn, or leaves the queue once all its groups are submitted
+                            groups = queued.pop(account_name)
+                            group = groups.popleft()
+                            if groups: 
+                                queued[account_name] = groups
+                            futures[executor.submit(cls.generate_folder, group)] = (account_name, group)
+                            running[account_name] += 1
+                            submitted = True
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done: 
+                    account_name, group = futures.pop(future)
+                    running[account_name] -= 1
+                    try: 
+                        results.update(future.result())
+                    except Exception as e: 
+                        logging.error('Unhandled error generating feeds {}'.format(group), exc_info=True)
+                        results.update((feed_name, e) for feed_name in group)
+
+        Metrics.observe('refeed_cycle_seconds', time.perf_counter() - started)
+        cls.write_metrics()
+
+        failed = [feed_name for feed_name, result in results.items() if result is not True]
+        logging.info('Mail fetch and feed generation job finished: {} feeds generated, {} failed {}'.format(len(results) - len(failed), len(failed), failed))
+        return results
+
+    @classmethod
+    def owns(cls, feed_name:str) -> bool: 
+        """ Whether this process should generate feed_name: always, unless in worker mode and another worker holds its lease.
+        """
+        return (cls.leases is None) or cls.leases.owns(feed_name)
+
+    @classmethod
+    def folder_groups(cls, feed_names:List[str]) -> List[List[str]]: 
+        """ Returns feed_names grouped by the (account, folder) they fetch from, in order of first appearance.
+        """
+        groups = defaultdict(list)
+        for feed_name in feed_names: 
+            groups[(config.ParseFeed.account_name(feed_name), config.ParseFeed.folder(feed_name))].append(feed_name)
+        return list(groups.values())
+
+    @classmethod
+    def generate_feeds(cls, feed_names:List[str]) -> None: 
+        for group in cls.folder_groups(feed_names): 
+            cls.generate_folder(group)
+        cls.write_metrics()
+
+    @classmethod
+    def generate_feed(cls, feed_name:str) -> bool:
+        """ Fetch new mail for and regenerate a single feed. Returns False if the job was skipped due to an error.
+        """
+        return cls.generate_folder([feed_name])[feed_name]
+
+    @classmethod
+    def generate_folder(cls, feed_names:List[str]) -> Dict[str, bool]:
+        """ Fetch new mail once for, and regenerate, feeds sharing an account and folder. Returns per feed False if its job was 
+        skipped due to an error.
+        
+        Serialised per feed, as this can be called from both the polling job and mail.MailIdle threads. 
+        """
+        with cls._locks_lock: 
+            feed_locks = [cls._feed_locks[feed_name] for feed_name in sorted(feed_names)]
+        with ExitStack() as stack: 
+            for feed_lock in feed_locks: 
+                stack.enter_context(feed_lock)
+            started = time.perf_counter()
+            try: 
+                results = cls._generate_folder(feed_names)
+            except Exception: 
+                for feed_name in feed_names: 
+                    Metrics.inc('refeed_errors_total', feed=feed_name, stage='unhandled')
+                    Metrics.inc('refeed_feed_generations_total', feed=feed_name, result='error')
+                raise
+            finally: 
+                for feed_name in feed_names: 
+                    Metrics.observe('refeed_feed_seconds', time.perf_counter() - started, feed=feed_name)
+        for feed_name, result in results.items(): 
+            Metrics.inc('refeed_feed_generations_total', feed=feed_name, result='ok' if result else 'error')
+            if result: 
+                Metrics.set('refeed_feed_last_success_timestamp_seconds', time.time(), feed=feed_name)
+        return results
+
+    @classmethod
+    def _generate_folder(cls, feed_names:List[str]) -> Dict[str, bool]: 
+        logging.info('feed_name_tasks: {}'.format(feed_names))
+        failed = set()
+        added = defaultdict(int)
+        with ExitStack() as stack:
+            feeds = {feed_name: stack.enter_context(feed.Feed(feed_name, cls.leases)) for feed_name in feed_names}
+            # IMAP doesnt specify TZ for 'INTERNALDATE', so 2 days is the smallest value I'm happy with.
+            # Mail is fetched once for all the feeds and streamed in bounded batches, and each feed stores its new entries as 
+            # they pile up, see feed.Feed.flush().
+            batches = mail.MailFetch.stream_folder(feed_names, 2, seen={feed_name: f.seen for feed_name, f in feeds.items()})
+            while True: 
                 try:
-                    # IMAP doesnt specify TZ for 'INTERNALDATE', so 2 days is the smallest value I'm happy with.
-                    new_mail = mail.MailFetch.new_mail(feed_name, 2)
-                    if mail is None: 
-                        logging.warning('mail.MailFetch.new_mail returned None. Either there have been no emails recieved at server matching filter for 2 days or an unhandled error occured. Ending feed generation job for {}'.format(feed_name) )
-                        return schedule.CancelJob
+                    new_mail = next(batches, None)
                 except (mail.ConfigError, mail.GenericHandledException):
-                    logging.exception('Handled exception raised in mail.MailFetch.new_mail({f}). Ending feed generation job for {f}'.format(f=feed_name))
-                    return schedule.CancelJob
+                    logging.exception('Handled exception raised in mail.MailFetch.stream_folder({f}). Ending feed generation job for {f}'.format(f=feed_names))
+                    for feed_name in feed_names: 
+                        if feed_name not in failed: 
+                            Metrics.inc('refeed_errors_total', feed=feed_name, stage='fetch')
+                    return {feed_name: False for feed_name in feed_names}
+                if new_mail is None: 
+                    break
 
-                try: 
-                    f.add_entries_from_dict_if_new(new_mail)
-                except Exception:
-                    logging.exception('Unknown error occured in feed.Feed.add_entries_from_dict_if_new(). Skipping feed generation for {}'.format(feed_name))
-                    return schedule.CancelJob
+                for feed_name, mails in new_mail.items(): 
+                    if feed_name in failed: 
+                        continue
+                    try: 
+                        added[feed_name] += feeds[feed_name].add_entries_from_dict_if_new(mails)
+                    except LeaseLost: 
+                        logging.error('Lease on feed {} lost during generation, not storing it'.format(feed_name))
+                        Metrics.inc('refeed_errors_total', feed=feed_name, stage='lease')
+                        feeds[feed_name].discard()
+                        failed.add(feed_name)
+                    except Exception:
+                        logging.exception('Unknown error occured in feed.Feed.add_entries_from_dict_if_new(). Skipping feed generation for {}'.format(feed_name))
+                        Metrics.inc('refeed_errors_total', feed=feed_name, stage='build')
+                        failed.add(feed_name)
+                if len(failed) == len(feed_names): 
+                    batches.close()
+                    return {feed_name: False for feed_name in feed_names}
 
+            for feed_name, f in feeds.items(): 
+                if feed_name in failed: 
+                    continue
+                if not cls.owns(feed_name): 
+                    # the lease was lost (e.g. renewals failed) while fetching, so another worker may be writing this feed
+                    logging.error('Lease on feed {} lost during generation, not storing or publishing it'.format(feed_name))
+                    Metrics.inc('refeed_errors_total', feed=feed_name, stage='lease')
+                    f.discard()
+                    failed.add(feed_name)
+                    continue
                 try: 
                     f.generate_feed()
+                    # stored with the feed's last flush on exit, so the mail is not fetched again unless the feed was stored
+                    f.checkpoint = mail.MailFetch.take_checkpoint(feed_name)
                 except Exception:
                     logging.exception('Unknown error occured in feed.Feed.generate_feed(). Skipping feed generation for {}'.format(feed_name))
-                    return schedule.CancelJob
-                    
-            logging.info('Feed Generated')
+                    Metrics.inc('refeed_errors_total', feed=feed_name, stage='write')
+                    failed.add(feed_name)
+                
+        # feeds whose lease was lost while storing them on exit are discarded, their mail is left to the new owner
+        failed.update(feed_name for feed_name, f in feeds.items() if f.discarded)
+        for feed_name in feed_names: 
+            cls.entries_added[feed_name] = added[feed_name]
+        logging.info('Feeds Generated: {}'.format([feed_name for feed_name in feed_names if feed_name not in failed]))
+        return {feed_name: feed_name not in failed for feed_name in feed_names}
+
+    @classmethod
+    def sync_push(cls) -> None: 
+        """ Keep a mail.MailIdle watcher running per (account, folder) in use by any feed, if [app][push] is set. Watchers 
+        whose feeds changed (e.g. on a config.yaml reload) are replaced, and those of folders no feed uses any more stopped. 
+        
+        Watched feeds are skipped by generate_feeds_from_new_mail while their watcher has not fallen back to polling.
+        """
+        wanted = {tuple(feed_names) for feed_names in cls.folder_groups(config.ParseFeed.names())} if config.ParseApp.push() else set()
+        for watcher in [watcher for watcher in cls.watchers if tuple(watcher.feed_names) not in wanted]: 
+            watcher.stop()
+            cls.watchers.remove(watcher)
+            cls.pushed_feeds.difference_update(watcher.feed_names)
+            logging.info('Stopped IDLE watcher for {}/{}: {}'.format(watcher.account_name, watcher.folder, watcher.feed_names))
+
+        watched = {tuple(watcher.feed_names) for watcher in cls.watchers}
+        for feed_names in sorted(wanted - watched): 
+            account_name, folder = config.ParseFeed.account_name(feed_names[0]), config.ParseFeed.folder(feed_names[0])
+            watcher = mail.MailIdle(account_name, folder, list(feed_names), cls.generate_feeds, cls._push_fallback, cls._push_resume)
+            cls.pushed_feeds.update(feed_names)
+            cls.watchers.append(watcher)
+            watcher.start()
+            logging.info('Started IDLE watcher for {}/{}: {}'.format(account_name, folder, list(feed_names)))
 
     @classmethod
-    def cleanup_feeds(cls) -> None:
-        logging.info('Cleaning up unwanted feeds')
-        feed.FeedTools.cleanup_feeds()
+    def stop_push(cls) -> None: 
+        for watcher in cls.watchers: 
+            watcher.stop()
+        cls.watchers = []
+        cls.pushed_feeds.clear()
+
+    @classmethod
+    def _push_fallback(cls, feed_names:List[str]) -> None: 
+        cls.pushed_feeds.difference_update(feed_names)
+
+    @classmethod
+    def _push_resume(cls, feed_names:List[str]) -> None: 
+        cls.pushed_feeds.update(feed_names)
+
+    @classmethod
+    def write_metrics(cls) -> None: 
+        textfile = config.ParseApp.metrics()['textfile']
+        if textfile is None: 
+            return
+        try: 
+            Metrics.write_textfile(textfile)
+        except OSError: 
+            logging.exception('Failed to write metrics to {}'.format(textfile))
+
+    @classmethod
+    def reconcile_feeds(cls) -> None:
+        """ Reconcile stored feeds with config.yaml. In worker mode, only the worker holding the RECONCILE lease does, and 
+        feeds leased by other workers (which may be on another version of config.yaml) are left alone.
+        """
+        try: 
+            if cls.leases is None: 
+                feed.FeedTools.reconcile_feeds()
+            elif cls.leases.owns(RECONCILE): 
+                if not cls._reconciler: # another worker may have changed the manifest since this one last reconciled
+                    feed.FeedTools._manifest = None
+                    cls._reconciler = True
+                feed.FeedTools.reconcile_feeds(keep=cls.leases.leased_elsewhere())
+            else: 
+                cls._reconciler = False
+        except Exception: 
+            logging.exception('Failed to reconcile stored feeds with config.yaml, will retry')
 
     @classmethod 
     def make_run_dirs(cls) -> None:
-        for name, path in config.paths.values():
-            if config.paths_flag_dir[name]:
-                try: 
-                    path.mkdir(parents=True)
-                except FileExistsError:
-                    logging.info("Directory {} from config.paths[{}] not created as it already exists.".format(str(path), name))
-                else:
-                    logging.info("Directory {} created".format(str(path))
+        dirs = [Path(path) for name, path in config.paths.items() if config.paths_flag_dir.get(name, False)]
+        dirs.append(Path(config.paths["log"]).parent)
+        dirs.extend(Path(config.paths["static"]).joinpath(sub) for sub in ('feed', 'alt'))
+        for path in dirs:
+            try: 
+                path.mkdir(parents=True)
+            except FileExistsError:
+                logging.info("Directory {} not created as it already exists.".format(str(path)))
+            else:
+                logging.info("Directory {} created".format(str(path)))
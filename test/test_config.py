@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import sys
 import refeed
 from pathlib import Path 
 import yaml
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('refeed')))
+
+import config
+
 test_config_path = Path(__file__).parent.joinpath('data', 'public', 'config.yaml').resolve() 
 
 def test_conf_path():
@@ -22,3 +27,25 @@ def test_PullConfig():
                 }
     refeed.config.PullConfig()
     assert refeed.config.loaded_yaml == yaml_dict
+
+def test_invalid_reload_keeps_snapshot(monkeypatch, tmp_path):
+    valid = {'accounts': {'acct': {'server': {'host': 'mail.example.com'}, 'auth': {'user': 'u', 'password': 'p'}}}, 
+        'feeds': {'news': {'account_name': 'acct'}}}
+    path = tmp_path.joinpath('config.yaml')
+    path.write_text(yaml.safe_dump(valid))
+    monkeypatch.setattr(config, 'paths', {**config.paths, 'config': path, 'data': tmp_path, 'static': tmp_path})
+    monkeypatch.setattr(config, '_snapshot', None)
+    monkeypatch.setattr(config, '_fingerprint', None)
+    assert config.PullConfig()
+    snapshot = config.snapshot()
+
+    malformed = [{'feeds': {'news': None}}, {'feeds': {'news': {'filters': ['a']}}}, {'feeds': {'news': {'feed_info': [1]}}}, 
+        {'feeds': {'news': {'alternate_cache': 'abc'}}}, {'app': [1]}]
+    for changes in malformed: 
+        raw = {**valid, **changes}
+        for feed in raw['feeds'].values(): 
+            if isinstance(feed, dict): 
+                feed.setdefault('account_name', 'acct')
+        path.write_text(yaml.safe_dump(raw))
+        assert not config.PullConfig(force=True)
+        assert config.snapshot() is snapshot
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('refeed')))
+
+from filters import FilterPlan
+
+raw_headers = b'From: =?utf-8?q?J=C3=B6rg?= <jorg@example.com>\r\nSubject: Weekly digest\r\nReceived: from a\r\nReceived: from b\r\n\r\n'
+
+def plan(filters):
+    return FilterPlan({property_: {oper: [re.compile(regex) for regex in regexes] for oper, regexes in pfilters.items()} 
+        for property_, pfilters in filters.items()})
+
+def test_priority():
+    filter_plan = plan({'from_': {'AND': ['example\\.com'], 'EXCLUDE': ['spam']}, 'subject': {'OR': ['digest', 'news']}})
+    assert filter_plan.matches({'from_': 'a@example.com', 'subject': 'news'})
+    assert not filter_plan.matches({'from_': 'spam@example.com', 'subject': 'news'})
+    assert not filter_plan.matches({'from_': 'a@example.org', 'subject': 'news'})
+    assert not filter_plan.matches({'from_': 'a@example.com', 'subject': 'hello'})
+
+def test_select_and_empty_plan():
+    messages = [(1, {'subject': 'a'}), (2, {'subject': 'b'})]
+    assert plan({'subject': {'or': ['b']}}).select(messages) == [2]
+    assert FilterPlan(None).select(messages) == [1, 2]
+
+def test_unmergeable_patterns():
+    filter_plan = FilterPlan({'subject': {'OR': [re.compile('(?i)digest'), re.compile('news')]}})
+    assert filter_plan.matches({'subject': 'DIGEST'})
+    assert filter_plan.matches({'subject': 'news'})
+
+def test_backreferences_not_merged():
+    filter_plan = plan({'subject': {'OR': ['(a)\\1', '(b)\\1']}})
+    assert filter_plan.matches({'subject': 'bb'})
+    assert not filter_plan.matches({'subject': 'ab'})
+
+def test_unknown_property():
+    try:
+        plan({'form_': {'AND': ['x']}})
+    except ValueError:
+        pass
+    else:
+        assert False, 'misspelled properties should be rejected'
+
+def test_values_from_headers():
+    filter_plan = plan({'from_': {'AND': ['Jörg <jorg@']}, 'received': {'AND': ['from b']}})
+    assert filter_plan.header_fields() == ['FROM', 'RECEIVED']
+    values = FilterPlan.values_from_headers(raw_headers, filter_plan.properties)
+    assert values['received'] == 'from a\nfrom b'
+    assert filter_plan.matches(values)
+
+def test_search_criteria():
+    filter_plan = FilterPlan({
+        'from_': {'AND': [re.compile('^news@example\\.com$')], 'EXCLUDE': [re.compile('(?i)spam'), re.compile('Ads')]},
+        'subject': {'OR': [re.compile('digest')]},
+        'date': {'OR': [re.compile('Mon')]}})
+    assert filter_plan.search_criteria == ['NOT', ['FROM', 'spam'], 'FROM', 'news@example.com', 
+        ['OR', ['SUBJECT', 'digest'], ['HEADER', 'DATE', 'Mon']]]
+
+def test_search_criteria_regexes_stay_client_side():
+    filter_plan = plan({'subject': {'AND': ['\\d+ new'], 'OR': ['a|b']}, 'to': {'OR': ['me']}})
+    assert filter_plan.search_criteria == []
+
+def test_any_search_criteria():
+    news = plan({'from_': {'AND': ['news@']}})
+    digest = plan({'subject': {'AND': ['digest']}})
+    assert FilterPlan.any_search_criteria([news]) == ['FROM', 'news@']
+    assert FilterPlan.any_search_criteria([news, news, digest]) == [['OR', ['FROM', 'news@'], ['SUBJECT', 'digest']]]
+    assert FilterPlan.any_search_criteria([news, FilterPlan(None)]) == []
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('refeed')))
+
+from imapclient.response_types import BodyData
+
+import store
+from mail import SyncState, _BodyStructure
+from parse import parse_message
+
+PLAIN = (b'TEXT', b'PLAIN', (b'CHARSET', b'us-ascii'), None, None, b'7BIT', 25, 1, None, None, None, None)
+HTML = (b'TEXT', b'HTML', (b'CHARSET', b'utf-8'), None, None, b'QUOTED-PRINTABLE', 40, 3, None, None, None, None)
+PDF = (b'APPLICATION', b'PDF', None, None, None, b'BASE64', 900000, None, (b'ATTACHMENT', (b'FILENAME', b'a.pdf')), None, None)
+
+def test_text_part_prefers_html():
+    structure = BodyData.create(((PLAIN, HTML, b'ALTERNATIVE', None, None, None, None), PDF, b'MIXED', None, None, None, None))
+    part = _BodyStructure.text_part(structure)
+    assert part.section == '1.2'
+    assert part.content_type == 'text/html'
+    assert part.params == (('CHARSET', 'utf-8'),)
+    assert part.encoding == 'QUOTED-PRINTABLE'
+
+def test_text_part_single_part_and_none():
+    assert _BodyStructure.text_part(BodyData.create(PLAIN)).section == '1'
+    assert _BodyStructure.text_part(BodyData.create(PDF)) is None
+
+def test_text_part_skips_text_attachments():
+    attached = PLAIN[:9] + ((b'ATTACHMENT', (b'FILENAME', b'notes.txt')),) + PLAIN[10:]
+    structure = BodyData.create((attached, HTML, b'MIXED', None, None, None, None))
+    assert _BodyStructure.text_part(structure).section == '2'
+
+def test_text_part_malformed():
+    try:
+        _BodyStructure.text_part(None)
+    except ValueError:
+        pass
+    else:
+        assert False, 'a missing BODYSTRUCTURE should raise ValueError'
+
+def test_message_parses():
+    part = _BodyStructure.TextPart('1.2', 'text/html', (('charset', 'utf-8'),), 'quoted-printable', 40)
+    raw = _BodyStructure.message(b'Subject: =?utf-8?q?caf=C3=A9?=\r\n\r\n', part, b'<p>caf=C3=A9 =\r\nau lait</p>\r\n')
+    mail = parse_message(raw)
+    assert mail.subject == 'café'
+    assert '<p>café au lait</p>' in mail.body
+
+def test_truncate():
+    assert _BodyStructure.truncate(b'line one\r\nline tw') == b'line one\r\n'
+    assert _BodyStructure.truncate(b'no newline') == b'no newline'
+
+class FakeServer():
+    def __init__(self, uids):
+        self.uids = uids
+
+    def search(self, criteria, charset=None):
+        return self.uids
+
+def test_uidvalidity_change_forgets_seen_uids(monkeypatch, tmp_path):
+    state = store.StateStore(tmp_path.joinpath('state.sqlite3'))
+    monkeypatch.setattr(store, 'get', lambda: state)
+    with state.transaction() as conn:
+        conn.execute("INSERT INTO sync_state (account, folder, consumer, uidvalidity, last_uid, highestmodseq) VALUES ('acct', 'INBOX', 'a', 1, 9, NULL)")
+        conn.executemany("INSERT INTO seen_uids (feed, uid) VALUES ('a', ?)", ((uid,) for uid in (3, 4, 9)))
+    uuids, checkpoints = SyncState.plan(FakeServer([3, 5]), {b'UIDVALIDITY': 2, b'UIDNEXT': 6}, 'acct', 'INBOX', ['a'], 2)
+    assert uuids == {'a': {3, 5}}
+    with state.transaction() as conn:
+        SyncState.write(conn, checkpoints['a'])
+    assert [row[0] for row in state.connection().execute("SELECT uid FROM seen_uids WHERE feed = 'a' ORDER BY uid")] == [3]
+    assert SyncState.load('acct', 'INBOX', 'a') == {'uidvalidity': 2, 'last_uid': 5, 'highestmodseq': None}
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pickle
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('refeed')))
+
+from filters import FilterPlan
+from parse import ParsedMail, parse_message
+from test_feed import MULTIPART_MESSAGE
+
+def test_parse_message_fields():
+    mail = parse_message(MULTIPART_MESSAGE.encode('utf-8'), ('from_', 'subject'))
+    assert mail.subject == 'A multipart message'
+    assert mail.filter_values == FilterPlan.values_from_headers(MULTIPART_MESSAGE.encode('utf-8'), ('from_', 'subject'))
+    assert mail.filter_values['from_'].startswith('Bob Smith')
+    assert 'Here is the first part.' in mail.body
+
+def test_parsed_mail_pickles():
+    mail = pickle.loads(pickle.dumps(ParsedMail({'subject': 'hi'}, {'from_': 'a@example.com'})))
+    assert mail.subject == 'hi'
+    assert mail.filter_values == {'from_': 'a@example.com'}
+    try:
+        mail.body
+    except AttributeError:
+        pass
+    else:
+        assert False, 'missing fields should raise AttributeError'
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from xml.dom import minidom
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('refeed')))
+
+from render import FeedRender
+
+entry = SimpleNamespace(entry_id='tag:example.com,2021-01-01/feeds/test.xml:1', title='A <multipart> & message', alt_id='abc', 
+    link='https://example.com/alt-html/abc.html', content='<html><body>Here is the first part.</body></html>', content_type='html', updated=1610000000.0)
+header = {'id': 'tag:example.com,2021-01-01/feeds/test.xml', 'title': 'test', 'subtitle': 'sub', 'author': 'John Doe', 'language': 'en', 
+    'logo': None, 'updated': 1610000000.0, 'links': {fmt: 'https://example.com/feeds/test.{}'.format(fmt) for fmt in ('atom', 'rss', 'json')}}
+
+def test_fragments_all_formats():
+    assert set(FeedRender.fragments(entry).keys()) == {'atom', 'rss', 'json'}
+
+def test_xml_documents_parse():
+    fragments = FeedRender.fragments(entry)
+    for fmt in ('atom', 'rss'):
+        dom = minidom.parseString(FeedRender.document(fmt, header, [fragments[fmt]] * 2).encode('utf-8'))
+        assert len(dom.getElementsByTagName('entry' if fmt == 'atom' else 'item')) == 2
+
+def test_json_document():
+    fragments = FeedRender.fragments(entry)
+    doc = json.loads(FeedRender.document('json', header, [fragments['json']]))
+    assert doc['items'][0]['title'] == entry.title
+    assert doc['items'][0]['content_html'] == entry.content
+
+def test_characters_xml_does_not_allow():
+    bad = SimpleNamespace(**{**vars(entry), 'title': 'Escape \x1b[1m here', 'content': 'Form\x0cfeed \ud800 and\ttab'})
+    fragments = FeedRender.fragments(bad)
+    for fmt in ('atom', 'rss'):
+        dom = minidom.parseString(FeedRender.document(fmt, {**header, 'title': 'test\x00'}, [fragments[fmt]]).encode('utf-8'))
+        assert dom.getElementsByTagName('title')[-1].firstChild.data == 'Escape [1m here'
+    doc = json.loads(FeedRender.document('json', header, [fragments['json']]).encode('utf-8'))
+    assert doc['items'][0]['content_html'] == 'Form\x0cfeed  and\ttab'
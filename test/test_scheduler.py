@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('refeed')))
+
+import config
+from scheduler import FeedScheduler
+
+FOLDERS = {'a': ('acct', 'INBOX'), 'b': ('acct', 'INBOX'), 'c': ('acct', 'Lists')}
+
+def scheduler(monkeypatch, now):
+    monkeypatch.setattr(config.ParseFeed, 'interval', lambda feed_name: 10)
+    monkeypatch.setattr(config.ParseFeed, 'account_name', lambda feed_name: FOLDERS[feed_name][0])
+    monkeypatch.setattr(config.ParseFeed, 'folder', lambda feed_name: FOLDERS[feed_name][1])
+    monkeypatch.setattr(config.ParseApp, 'schedule', lambda: {'backoff': 2.0, 'max_backoff': 4.0, 'jitter': 0.0})
+    return FeedScheduler(clock=lambda: now[0])
+
+def test_backoff_and_reset(monkeypatch):
+    now = [0.0]
+    feeds = scheduler(monkeypatch, now)
+    feeds.sync(['a'])
+    assert feeds.pop_due() == ['a']
+    assert [feeds.done('a', True, 0) for _ in range(3)] == [1200, 2400, 2400]
+    assert feeds.done('a', True, 5) == 600
+    assert feeds.done('a', False, 0) == 1200
+
+def test_folder_coalescing(monkeypatch):
+    now = [0.0]
+    feeds = scheduler(monkeypatch, now)
+    feeds.sync(['a', 'b', 'c'])
+    assert sorted(feeds.pop_due()) == ['a', 'b', 'c']
+    feeds.done('a', True, 1)
+    now[0] = 100.0
+    feeds.done('b', True, 1)
+    feeds.done('c', True, 1)
+    now[0] = 600.0
+    # b is due 100 seconds later, within a quarter of its interval, c is in another folder
+    assert sorted(feeds.pop_due()) == ['a', 'b']
+    assert feeds.next_due() == 700.0
+    # a and b are still being polled, so a config reload neither reschedules them nor loses them
+    feeds.sync(['a', 'b'])
+    assert ('a' in feeds) and ('c' not in feeds)
+    assert feeds.next_due() is None
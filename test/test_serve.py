@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import gzip
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('refeed')))
+
+import config
+from publish import Publisher
+from serve import FeedServer
+
+def setup(monkeypatch, tmp_path):
+    monkeypatch.setitem(config.paths, 'static', tmp_path)
+    monkeypatch.setattr(config, 'snapshot', lambda: SimpleNamespace(feeds={'news': SimpleNamespace(formats=('atom',))}))
+    monkeypatch.setattr(config.ParseApp, 'http', lambda: {'port': None, 'host': '127.0.0.1', 'cache_bytes': 1 << 20, 'revalidate': 60})
+    monkeypatch.setattr(Publisher, 'watchers', [FeedServer.update])
+    FeedServer.clear()
+    tmp_path.joinpath('feed').mkdir()
+    return tmp_path.joinpath('feed', 'news.xml')
+
+def test_conditional_get_and_gzip(monkeypatch, tmp_path):
+    path = setup(monkeypatch, tmp_path)
+    Publisher.publish(path, b'<feed>' + b'entry ' * 100 + b'</feed>', 'application/atom+xml')
+    status, headers, body = FeedServer.respond('GET', '/feeds/news.xml', {})
+    headers = dict(headers)
+    assert (status, headers['ETag']) == (200, Publisher.meta(path)['etag'])
+    assert FeedServer.respond('GET', '/feeds/news.xml', {'if-none-match': 'W/"x", ' + headers['ETag']})[0] == 304
+    assert FeedServer.respond('GET', '/feeds/news.xml', {'if-modified-since': headers['Last-Modified']})[0] == 304
+
+    status, gzip_headers, gzip_body = FeedServer.respond('GET', '/feeds/news.xml', {'accept-encoding': 'br, gzip;q=0.5'})
+    assert dict(gzip_headers)['Content-Encoding'] == 'gzip'
+    assert (gzip.decompress(gzip_body) == body) and (dict(gzip_headers)['ETag'] != headers['ETag'])
+    assert 'Content-Encoding' not in dict(FeedServer.respond('GET', '/feeds/news.xml', {'accept-encoding': 'gzip;q=0'})[1])
+
+    # republishing replaces the cached document
+    Publisher.publish(path, b'<feed></feed>', 'application/atom+xml')
+    status, _, body = FeedServer.respond('GET', '/feeds/news.xml', {'if-none-match': headers['ETag']})
+    assert (status, body) == (200, b'<feed></feed>')
+
+def test_not_served(monkeypatch, tmp_path):
+    path = setup(monkeypatch, tmp_path)
+    Publisher.publish(path.with_name('news.rss'), b'<rss/>', 'application/rss+xml')
+    for target in ('/feeds/news.rss', '/feeds/news.xml', '/feeds/..%2Fnews.xml', '/feeds/news.xml.meta.json', '/alt-html/zz.html'):
+        assert FeedServer.respond('GET', target, {})[0] == 404
+    assert FeedServer.respond('POST', '/feeds/news.xml', {})[0] == 405
+
+def test_published_documents_are_not_read_back(monkeypatch, tmp_path):
+    path = setup(monkeypatch, tmp_path)
+    Publisher.publish(path, b'<feed>one</feed>', 'application/atom+xml')
+    # the document was handed over by Publisher, so the server does not need the file until it revalidates
+    os.unlink(str(path))
+    status, headers, body = asyncio.run(FeedServer._respond('GET', '/feeds/news.xml', {}))
+    assert (status, body, dict(headers)['ETag']) == (200, b'<feed>one</feed>', Publisher.meta(path)['etag'])
+    Publisher.remove(path)
+    assert asyncio.run(FeedServer._respond('GET', '/feeds/news.xml', {}))[0] == 404
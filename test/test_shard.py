@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('refeed')))
+
+import config
+from shard import HashRing, ShardLeases
+from store import StateStore
+
+FEEDS = {'feed-{}'.format(i): ('acct', 'folder-{}'.format(i // 2)) for i in range(40)}
+
+def test_ring_moves_only_the_new_workers_keys():
+    keys = ['key-{}'.format(i) for i in range(1000)]
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b', 'c', 'd'])
+    moved = [key for key in keys if before.owner(key) != after.owner(key)]
+    assert all(after.owner(key) == 'd' for key in moved)
+    assert 100 < len(moved) < 400
+    assert HashRing([]).owner('key') is None
+
+def test_leases_rebalance(monkeypatch, tmp_path):
+    monkeypatch.setattr(config.ParseFeed, 'names', lambda: list(FEEDS))
+    monkeypatch.setattr(config.ParseFeed, 'account_name', lambda feed_name: FEEDS[feed_name][0])
+    monkeypatch.setattr(config.ParseFeed, 'folder', lambda feed_name: FEEDS[feed_name][1])
+    monkeypatch.setattr(config.ParseApp, 'shard', lambda: {'enabled': True, 'worker_id': None, 'lease': 60})
+    now = [1000.0]
+    state = StateStore(tmp_path.joinpath('state.sqlite3'))
+    a = ShardLeases('a', state, clock=lambda: now[0])
+    b = ShardLeases('b', state, clock=lambda: now[0])
+
+    assert not a.beat()
+    assert all(a.owns(feed_name) for feed_name in FEEDS)
+    # b joins: a hands b's folders over on its next beat, but not while it is generating them
+    with a.generating(FEEDS):
+        assert b.beat()
+        assert not any(b.owns(feed_name) for feed_name in FEEDS)
+        assert a.beat()
+        assert all(a.owns(feed_name) for feed_name in FEEDS)
+    a.beat()
+    assert not b.beat()
+    moved = [feed_name for feed_name in FEEDS if b.owns(feed_name)]
+    assert 0 < len(moved) < len(FEEDS)
+    assert all(a.owns(feed_name) != b.owns(feed_name) for feed_name in FEEDS)
+    # folder mates stay together
+    assert all(a.owns(feed_name) == a.owns(other) for feed_name in FEEDS for other in FEEDS if FEEDS[feed_name] == FEEDS[other])
+
+    # a stops renewing: b takes everything over once a's worker row and leases expire
+    now[0] += 61
+    assert not b.beat()
+    assert all(b.owns(feed_name) for feed_name in FEEDS)
+    assert not any(a.owns(feed_name) for feed_name in FEEDS)
+    with state.transaction() as conn:
+        assert b.holds(conn, moved[0]) and not a.holds(conn, moved[0])
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import shelve
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('refeed')))
+
+from store import StateStore
+
+def test_migrate_shelves_once(tmp_path):
+    with shelve.open(str(tmp_path.joinpath('mail_uuids.shelf'))) as shelf:
+        shelf['news'] = [1, 2]
+    StateStore(tmp_path.joinpath('state.sqlite3')).migrate_shelves(tmp_path)
+    assert not any(tmp_path.glob('mail_uuids.shelf')) and any(tmp_path.glob('mail_uuids.shelf*.migrated'))
+
+    # the next start finds only migrated shelves
+    state = StateStore(tmp_path.joinpath('state.sqlite3'))
+    state.migrate_shelves(tmp_path)
+    assert [row[0] for row in state.connection().execute("SELECT uid FROM seen_uids WHERE feed = 'news' ORDER BY uid")] == [1, 2]